@@ -11,31 +11,28 @@ import gym
 # noinspection PyUnresolvedReferences
 import gym_gui_environments
 import numpy as np
-from PIL import Image
 
+from data.observation_writer import (
+    ObservationWriter, create_observation_writer, DEFAULT_PNG_COMPRESSION_LEVEL, DEFAULT_CONTAINER_COMPRESSION_LEVEL,
+    OBSERVATION_OUTPUT_FORMATS
+)
 from utils.setup_utils import initialize_logger
 
 RANDOM_CLICK_MONKEY_TYPE = "random-clicks"
 RANDOM_WIDGET_MONKEY_TYPE = "random-widgets"
 
 
-def _save_observation(observation: np.ndarray, iteration: int, observations_directory: str):
-    im = Image.fromarray(observation)
-    # Add leading zeros to the filename so that they are properly sorted
-    file_name = f"{iteration}".zfill(8)
-    im.save(os.path.join(observations_directory, f"{file_name}.png"))
-
-
 def _store_data(data: dict, iteration: int, action: Tuple[int, int], reward: float):
     data[iteration] = {"action": action, "reward": reward}
 
     return data
 
 
-def _rollout_one_iteration(env, current_iteration: int, observations_directory: str,
-                           reward_sum: float, rewards: list, actions: list) -> Tuple[float, list, list]:
+def _rollout_one_iteration(env, current_iteration: int, observation_writer: ObservationWriter,
+                           reward_sum: float, rewards: list, actions: list,
+                           start_time: float) -> Tuple[float, list, list]:
     observation, reward, done, info = env.step(True)
-    _save_observation(observation, current_iteration, observations_directory)
+    observation_writer.write(observation, current_iteration)
 
     # Transform to [0, 1] range
     reward /= 100.0
@@ -43,7 +40,9 @@ def _rollout_one_iteration(env, current_iteration: int, observations_directory:
 
     if current_iteration % 500 == 0:
         logging.info(
-            f"{current_iteration}: Current reward '{reward_sum}'"
+            f"{current_iteration}: Current reward '{reward_sum}' - "
+            f"{current_iteration / (time.time() - start_time):.2f} steps/s - "
+            f"Waited for observation writers {observation_writer.blocked_time:.2f} s"
         )
 
     rewards += [reward]
@@ -52,7 +51,7 @@ def _rollout_one_iteration(env, current_iteration: int, observations_directory:
     return reward_sum, rewards, actions
 
 
-def _time_mode_rollout(amount: int, env, observations_directory: str) -> Tuple[float, list, list]:
+def _time_mode_rollout(amount: int, env, observation_writer: ObservationWriter) -> Tuple[float, list, list]:
     i = 1
     reward_sum = 0
     rewards = []
@@ -61,33 +60,58 @@ def _time_mode_rollout(amount: int, env, observations_directory: str) -> Tuple[f
     start_time = time.time()
 
     while time.time() < start_time + amount:
-        reward_sum, rewards, actions = _rollout_one_iteration(env, i, observations_directory, reward_sum, rewards,
-                                                              actions)
+        reward_sum, rewards, actions = _rollout_one_iteration(env, i, observation_writer, reward_sum, rewards,
+                                                              actions, start_time)
         i += 1
 
     return reward_sum, rewards, actions
 
 
-def _iteration_mode_rollout(amount: int, env, observations_directory: str) -> Tuple[float, list, list]:
+def _iteration_mode_rollout(amount: int, env,
+                            observation_writer: ObservationWriter) -> Tuple[float, list, list]:
     reward_sum = 0
     rewards = []
     actions = []
 
+    start_time = time.time()
+
     for i in range(1, amount + 1):
-        reward_sum, rewards, actions = _rollout_one_iteration(env, i, observations_directory, reward_sum, rewards,
-                                                              actions)
+        reward_sum, rewards, actions = _rollout_one_iteration(env, i, observation_writer, reward_sum, rewards,
+                                                              actions, start_time)
 
     return reward_sum, rewards, actions
 
 
-def start_monkey_tester(env: gym.Env, stop_mode: str, amount: int, chosen_directory: str, observations_directory: str):
-    observation = env.reset()
-    _save_observation(observation, iteration=0, observations_directory=observations_directory)
+def start_monkey_tester(env: gym.Env, stop_mode: str, amount: int, chosen_directory: str,
+                        output_format: str = "png", png_compression_level: int = DEFAULT_PNG_COMPRESSION_LEVEL,
+                        container_compression_level: int = DEFAULT_CONTAINER_COMPRESSION_LEVEL,
+                        number_of_observation_writers: int = 2, max_pending_observations: int = 64):
+    # The observations are encoded and written in background threads, such that the GUI does not wait for the
+    # compression
+    observation_writer = create_observation_writer(
+        output_format,
+        chosen_directory,
+        png_compression_level=png_compression_level,
+        container_compression_level=container_compression_level,
+        number_of_threads=number_of_observation_writers,
+        max_pending_observations=max_pending_observations
+    )
 
-    if stop_mode == "time":
-        reward_sum, rewards, actions = _time_mode_rollout(amount, env, observations_directory)
-    else:
-        reward_sum, rewards, actions = _iteration_mode_rollout(amount, env, observations_directory)
+    start_time = time.time()
+
+    try:
+        observation = env.reset()
+        observation_writer.write(observation, iteration=0)
+
+        if stop_mode == "time":
+            reward_sum, rewards, actions = _time_mode_rollout(amount, env, observation_writer)
+        else:
+            reward_sum, rewards, actions = _iteration_mode_rollout(amount, env, observation_writer)
+
+        rollout_time = time.time() - start_time
+    finally:
+        # Flush the observations that are still queued
+        observation_writer.close()
 
     rewards = np.array(rewards, dtype=np.float32)
 
@@ -99,7 +123,10 @@ def start_monkey_tester(env: gym.Env, stop_mode: str, amount: int, chosen_direct
         actions=np.array(actions, dtype=np.int32)
     )
 
-    logging.info(f"Finished data generation with a summed up reward of {reward_sum}")
+    logging.info(f"Finished data generation with a summed up reward of {reward_sum} - "
+                 f"{len(rewards) / rollout_time:.2f} steps/s - "
+                 f"Waited for observation writers {observation_writer.blocked_time:.2f} s - "
+                 f"Flushing the observation writers took {time.time() - start_time - rollout_time:.2f} s")
     env.close()
 
 
@@ -120,6 +147,24 @@ def data_generation_options(function):
                             help="If true set logging level to debug and log to a file")(function)
     function = click.option("--html-report/--no-html-report", type=bool, default=True,
                             help="If true, save the HTML Report of the coverage")(function)
+    function = click.option("--png-compression-level", type=click.IntRange(0, 9),
+                            default=DEFAULT_PNG_COMPRESSION_LEVEL, show_default=True,
+                            help="zlib compression level of the observation PNG files")(function)
+    function = click.option("--output-format", type=click.Choice(OBSERVATION_OUTPUT_FORMATS), default="png",
+                            show_default=True,
+                            help="Store the observations as one PNG file per step, or in one chunked HDF5 container "
+                                 "per sequence")(function)
+    function = click.option("--container-compression-level", type=click.IntRange(0, 9),
+                            default=DEFAULT_CONTAINER_COMPRESSION_LEVEL, show_default=True,
+                            help="gzip compression level of the HDF5 observations container")(function)
+    function = click.option("--observation-writers", "number_of_observation_writers", type=click.IntRange(1, None),
+                            default=2, show_default=True,
+                            help="Number of background threads that write the PNG files, has no effect for "
+                                 "--output-format hdf5, which always uses one writer thread")(function)
+    function = click.option("--max-pending-observations", type=click.IntRange(1, None), default=64,
+                            show_default=True,
+                            help="Maximum number of observations that wait for a writer thread, after that the "
+                                 "data generation waits for the writers")(function)
     return function
 
 
@@ -131,7 +176,9 @@ def data_generation_options(function):
                    "as with --root-dir")
 @data_generation_options
 def main(root_dir: str, directory: str,
-         stop_mode: str, amount: int, monkey_type: str, random_click_prob: float, log: bool, html_report: bool):
+         stop_mode: str, amount: int, monkey_type: str, random_click_prob: float, log: bool, html_report: bool,
+         png_compression_level: int, output_format: str, container_compression_level: int,
+         number_of_observation_writers: int, max_pending_observations: int):
     if directory is not None:
         chosen_directory = directory
     else:
@@ -144,9 +191,6 @@ def main(root_dir: str, directory: str,
 
     os.makedirs(chosen_directory, exist_ok=True)
 
-    observations_directory = os.path.join(chosen_directory, "observations")
-    os.makedirs(observations_directory, exist_ok=True)
-
     logger, formatter = initialize_logger()
 
     log_file_path = None
@@ -178,7 +222,12 @@ def main(root_dir: str, directory: str,
 
     env = gym.make(env_id, **env_kwargs)
 
-    start_monkey_tester(env, stop_mode, amount, chosen_directory, observations_directory)
+    start_monkey_tester(env, stop_mode, amount, chosen_directory,
+                        output_format=output_format,
+                        png_compression_level=png_compression_level,
+                        container_compression_level=container_compression_level,
+                        number_of_observation_writers=number_of_observation_writers,
+                        max_pending_observations=max_pending_observations)
 
     chosen_options = {
         "env-used": env_id,
@@ -189,7 +238,10 @@ def main(root_dir: str, directory: str,
         "explicit-dir": directory,
         "random-click-probability": random_click_prob,
         "log": log,
-        "html-report": html_report
+        "html-report": html_report,
+        "png-compression-level": png_compression_level,
+        "output-format": output_format,
+        "container-compression-level": container_compression_level
     }
 
     with open(os.path.join(chosen_directory, "data_generation_options.json"), "w", encoding="utf-8") as f:
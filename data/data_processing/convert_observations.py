@@ -0,0 +1,101 @@
+import logging
+import os
+import shutil
+
+import click
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from data.observation_container import (
+    close_observation_containers, get_observations_container_path, has_observations_container,
+    list_sequence_observations, load_observation, OBSERVATIONS_CONTAINER_DATASET_NAME
+)
+from data.observation_writer import (
+    HDF5ObservationWriter, save_observation, DEFAULT_CONTAINER_COMPRESSION_LEVEL, DEFAULT_PNG_COMPRESSION_LEVEL
+)
+from utils.setup_utils import initialize_logger
+
+
+def convert_to_container(sequence_dir: str, compression_level: int, keep_original: bool):
+    observations_dir = os.path.join(sequence_dir, "observations")
+    observation_references = list_sequence_observations(sequence_dir)
+
+    observation_writer = HDF5ObservationWriter(sequence_dir, compression_level=compression_level)
+
+    try:
+        for i, observation_reference in enumerate(observation_references):
+            observation_writer.write(load_observation(observation_reference), i)
+    finally:
+        observation_writer.close()
+
+    with h5py.File(get_observations_container_path(sequence_dir), "r") as f:
+        observations = f[OBSERVATIONS_CONTAINER_DATASET_NAME]
+        assert (observations.shape[0] == len(observation_references)
+                and np.array_equal(observations[-1], load_observation(observation_references[-1]))), \
+            f"Conversion of '{sequence_dir}' failed"
+
+    if not keep_original:
+        shutil.rmtree(observations_dir)
+
+
+def convert_to_png(sequence_dir: str, compression_level: int, keep_original: bool):
+    observations_dir = os.path.join(sequence_dir, "observations")
+    os.makedirs(observations_dir, exist_ok=True)
+
+    for i, observation_reference in enumerate(list_sequence_observations(sequence_dir)):
+        save_observation(load_observation(observation_reference), i, observations_dir, compression_level)
+
+    close_observation_containers()
+
+    if not keep_original:
+        os.remove(get_observations_container_path(sequence_dir))
+
+
+def find_sequence_directories(root_dir: str):
+    for current_dir, _, files in os.walk(root_dir):
+        if "data.npz" in files:
+            yield current_dir
+
+
+@click.command()
+@click.option("-d", "--root-dir", type=str, required=True,
+              help="Directory that is searched for data sequences (directories with a data.npz file)")
+@click.option("--to-container/--to-png", type=bool, default=True,
+              help="Convert the observations folders to observation containers or the other way around")
+@click.option("--compression-level", type=click.IntRange(0, 9),
+              help="gzip level of the containers or zlib level of the PNG files, defaults to the level of the data "
+                   "generation")
+@click.option("--keep-original/--no-keep-original", type=bool, default=False,
+              help="Keep the observations in the original format after the conversion")
+def main(root_dir: str, to_container: bool, compression_level: int, keep_original: bool):
+    """
+    Converts the observations of the generated data sequences between one PNG file per observation (observations
+    folder) and one chunked HDF5 container per sequence (see data/observation_container.py). Sequences that are already
+    in the target format are skipped.
+    """
+    logger, _ = initialize_logger()
+    logger.setLevel(logging.INFO)
+
+    if compression_level is None:
+        compression_level = DEFAULT_CONTAINER_COMPRESSION_LEVEL if to_container else DEFAULT_PNG_COMPRESSION_LEVEL
+
+    converted_sequences = 0
+
+    for sequence_dir in tqdm(sorted(find_sequence_directories(root_dir))):
+        if to_container:
+            if has_observations_container(sequence_dir):
+                continue
+            convert_to_container(sequence_dir, compression_level, keep_original)
+        else:
+            if not has_observations_container(sequence_dir):
+                continue
+            convert_to_png(sequence_dir, compression_level, keep_original)
+
+        converted_sequences += 1
+
+    logging.info(f"Converted {converted_sequences} sequences to {'containers' if to_container else 'PNG files'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,29 @@ import os
 import shutil
 
 import click
+from PIL import Image
 from tqdm import tqdm
 
+from data.observation_container import (
+    has_observations_container, list_sequence_observations, load_observation
+)
+from data.observation_writer import get_observation_file_name
+
 MIXED_FOLDER_NAME = "mixed"
 
 
 def copy_observations_in_one_folder(root_dir: str, mixed_dir: str):
     for sequence_dir in os.listdir(root_dir):
         current_dir = os.path.join(root_dir, sequence_dir)
+
+        if has_observations_container(current_dir):
+            # The mixed folder contains only images, therefore write the observations of the container as PNG files
+            for i, observation_reference in enumerate(tqdm(list_sequence_observations(current_dir))):
+                Image.fromarray(load_observation(observation_reference)).save(
+                    f"{mixed_dir}/{os.path.basename(root_dir)}-{sequence_dir}-{get_observation_file_name(i)}"
+                )
+            continue
+
         observations_dir = os.path.join(current_dir, "observations")
 
         for file in tqdm(os.listdir(observations_dir)):
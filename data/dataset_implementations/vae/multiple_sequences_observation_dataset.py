@@ -1,9 +1,9 @@
 import os
 
-from PIL import Image
 from torch.utils.data import Dataset
 
 from data.dataset_implementations.possible_splits import POSSIBLE_SPLITS, get_start_and_end_indices_from_split
+from data.observation_container import list_sequence_observations, load_observation_image
 
 
 class GUIMultipleSequencesObservationDataset(Dataset):
@@ -20,12 +20,9 @@ class GUIMultipleSequencesObservationDataset(Dataset):
 
         self.observation_images = []
 
+        # Sequences can either have an observations folder or an observations container
         for sequence_sub_dir in sorted(os.listdir(self.root_dir))[self.start_index:self.end_index]:
-            sequence_images_list = sorted(os.listdir(os.path.join(self.root_dir, sequence_sub_dir, "observations")))
-
-            self.observation_images.extend(
-                [os.path.join(self.root_dir, sequence_sub_dir, "observations", x) for x in sequence_images_list]
-            )
+            self.observation_images.extend(list_sequence_observations(os.path.join(self.root_dir, sequence_sub_dir)))
 
         self.number_of_observations = len(self.observation_images)
 
@@ -33,4 +30,4 @@ class GUIMultipleSequencesObservationDataset(Dataset):
         return self.number_of_observations
 
     def __getitem__(self, index):
-        return self.transform(Image.open(self.observation_images[index]))
\ No newline at end of file
+        return self.transform(load_observation_image(self.observation_images[index]))
\ No newline at end of file
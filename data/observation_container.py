@@ -0,0 +1,86 @@
+import os
+from collections import OrderedDict
+from typing import List, Tuple, Union
+
+import h5py
+import numpy as np
+from PIL import Image
+
+# Alternative to the observations folder of a data sequence: All observations in one chunked, compressed HDF5 dataset of
+# shape (number_of_observations, height, width, 3), row i is the observation of iteration i
+OBSERVATIONS_CONTAINER_FILE_NAME = "observations.hdf5"
+OBSERVATIONS_CONTAINER_DATASET_NAME = "observations"
+
+# Either the path of a PNG file, or the path of an observations container and the row of the observation
+ObservationReference = Union[str, Tuple[str, int]]
+
+# Maximum number of containers that load_observation() keeps open per process, the least recently used one is closed if
+# another one is opened. Datasets of many sequences would otherwise exhaust the file handles
+MAX_OPEN_CONTAINERS = 32
+
+# Open containers of this process, the file handles of h5py cannot be shared with forked DataLoader workers. Ordered
+# from the least to the most recently used
+_open_containers = OrderedDict()
+
+
+def get_observations_container_path(sequence_dir: str) -> str:
+    return os.path.join(sequence_dir, OBSERVATIONS_CONTAINER_FILE_NAME)
+
+
+def has_observations_container(sequence_dir: str) -> bool:
+    return os.path.exists(get_observations_container_path(sequence_dir))
+
+
+def list_sequence_observations(sequence_dir: str) -> List[ObservationReference]:
+    """
+    Returns references to the observations of a data sequence, sorted by iteration. Sequences stored with an
+    observations container are preferred over the observations folder.
+    """
+    if has_observations_container(sequence_dir):
+        container_path = get_observations_container_path(sequence_dir)
+
+        with h5py.File(container_path, "r") as f:
+            number_of_observations = f[OBSERVATIONS_CONTAINER_DATASET_NAME].shape[0]
+
+        return [(container_path, i) for i in range(number_of_observations)]
+
+    observations_dir = os.path.join(sequence_dir, "observations")
+
+    return [os.path.join(observations_dir, x) for x in sorted(os.listdir(observations_dir))]
+
+
+def load_observation(observation_reference: ObservationReference) -> np.ndarray:
+    if isinstance(observation_reference, str):
+        return np.asarray(Image.open(observation_reference))
+
+    container_path, index = observation_reference
+    key = (os.getpid(), container_path)
+
+    if key in _open_containers:
+        _open_containers.move_to_end(key)
+    else:
+        own_keys = [k for k in _open_containers if k[0] == key[0]]
+        if len(own_keys) >= MAX_OPEN_CONTAINERS:
+            _open_containers.pop(own_keys[0]).close()
+
+        _open_containers[key] = h5py.File(container_path, "r")
+
+    return _open_containers[key][OBSERVATIONS_CONTAINER_DATASET_NAME][index]
+
+
+def load_observation_image(observation_reference: ObservationReference) -> Image.Image:
+    """
+    Loads the observation as PIL image, such that it can be used with the transformation functions of the V model.
+    """
+    if isinstance(observation_reference, str):
+        return Image.open(observation_reference)
+
+    return Image.fromarray(load_observation(observation_reference))
+
+
+def close_observation_containers():
+    """
+    Closes the containers that load_observation() opened in this process.
+    """
+    for key in [k for k in _open_containers if k[0] == os.getpid()]:
+        _open_containers.pop(key).close()
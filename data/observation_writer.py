@@ -0,0 +1,257 @@
+import math
+import os
+import queue
+import threading
+import time
+from typing import Union
+
+import h5py
+import numpy as np
+from PIL import Image
+
+from data.observation_container import get_observations_container_path, OBSERVATIONS_CONTAINER_DATASET_NAME
+
+# zlib level that PIL uses for PNG files if none is given
+DEFAULT_PNG_COMPRESSION_LEVEL = 6
+
+DEFAULT_CONTAINER_COMPRESSION_LEVEL = 4
+DEFAULT_CONTAINER_CHUNK_SIZE = 64
+
+# Interval in seconds after which a blocked write of the HDF5 writer checks if its thread is still running
+HDF5_WRITER_LIVENESS_CHECK_INTERVAL = 1.0
+
+OBSERVATION_OUTPUT_FORMATS = ["png", "hdf5"]
+
+
+def get_observation_file_name(iteration: int) -> str:
+    # Add leading zeros to the filename so that they are properly sorted
+    return f"{iteration}".zfill(8) + ".png"
+
+
+def save_observation(observation: np.ndarray, iteration: int, observations_directory: str,
+                     compression_level: int = DEFAULT_PNG_COMPRESSION_LEVEL):
+    im = Image.fromarray(observation)
+    im.save(os.path.join(observations_directory, get_observation_file_name(iteration)),
+            compress_level=compression_level)
+
+
+class PNGObservationWriter:
+    """
+    Writes the observations of a data sequence as PNG files into observations_directory, in number_of_threads
+    background threads. PIL releases the GIL while encoding, such that the environment can continue while the
+    screenshots are compressed.
+
+    At most max_pending_observations are queued. If the writers cannot keep up, write() blocks until there is space
+    again (back-pressure), the time spent waiting is accumulated in blocked_time. close() waits until all queued
+    observations are written. An error in a writer thread is raised again in the next call of write() or close().
+    """
+
+    def __init__(self, observations_directory: str, compression_level: int = DEFAULT_PNG_COMPRESSION_LEVEL,
+                 number_of_threads: int = 2, max_pending_observations: int = 64):
+        assert 0 <= compression_level <= 9, "The PNG compression level must be between 0 and 9"
+        assert number_of_threads > 0, "At least one writer thread is required"
+        assert max_pending_observations > 0, "At least one observation must be able to wait for a writer thread"
+
+        self.observations_directory = observations_directory
+        self.compression_level = compression_level
+
+        self.observation_queue = queue.Queue(maxsize=max_pending_observations)
+        self.error = None
+        self.blocked_time = 0.0
+
+        self.threads = [
+            threading.Thread(target=self._writer_routine, daemon=True) for _ in range(number_of_threads)
+        ]
+
+        for thread in self.threads:
+            thread.start()
+
+    def _writer_routine(self):
+        while True:
+            item = self.observation_queue.get()
+
+            if item is None:
+                return
+
+            observation, iteration = item
+
+            try:
+                save_observation(observation, iteration, self.observations_directory, self.compression_level)
+            except Exception as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing an observation failed") from self.error
+
+    def write(self, observation: np.ndarray, iteration: int):
+        self._raise_error()
+
+        # Copy, as the environment might reuse the memory of the observation for the next screenshot
+        observation = observation.copy()
+
+        start_time = time.perf_counter()
+        self.observation_queue.put((observation, iteration))
+        self.blocked_time += time.perf_counter() - start_time
+
+    def close(self):
+        for _ in self.threads:
+            self.observation_queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self._raise_error()
+
+
+class HDF5ObservationWriter:
+    """
+    Appends the observations of a data sequence to an observations container in sequence_directory (see
+    data/observation_container.py) instead of writing one PNG file per observation.
+
+    The observations are collected until a chunk of chunk_size observations is full, the chunk is then compressed
+    (gzip with compression_level) and appended by a background thread, as h5py cannot write from multiple threads.
+    Like PNGObservationWriter, at most max_pending_observations (rounded up to full chunks) are queued, write() blocks
+    otherwise (the time is accumulated in blocked_time), and close() writes the remaining observations. An error in the
+    writer thread, including one when creating the container, is raised again in the next write() or close().
+    """
+
+    def __init__(self, sequence_directory: str, compression_level: int = DEFAULT_CONTAINER_COMPRESSION_LEVEL,
+                 chunk_size: int = DEFAULT_CONTAINER_CHUNK_SIZE, max_pending_observations: int = 64):
+        assert 0 <= compression_level <= 9, "The gzip compression level must be between 0 and 9"
+        assert chunk_size > 0, "The chunk size must be greater than 0"
+
+        self.container_path = get_observations_container_path(sequence_directory)
+        self.compression_level = compression_level
+        self.chunk_size = chunk_size
+
+        self.chunk = []
+        self.next_iteration = 0
+
+        self.chunk_queue = queue.Queue(maxsize=max(1, math.ceil(max_pending_observations / chunk_size)))
+        self.error = None
+        self.blocked_time = 0.0
+
+        self.thread = threading.Thread(target=self._writer_routine, daemon=True)
+        self.thread.start()
+
+    def _writer_routine(self):
+        try:
+            f = h5py.File(self.container_path, "w")
+        except Exception as e:
+            self.error = e
+            f = None
+
+        dataset = None
+
+        while True:
+            chunk = self.chunk_queue.get()
+
+            if chunk is None:
+                break
+
+            # After an error the chunks are still taken from the queue, such that write() and close() do not block
+            if self.error is not None:
+                continue
+
+            try:
+                if dataset is None:
+                    dataset = f.create_dataset(
+                        OBSERVATIONS_CONTAINER_DATASET_NAME,
+                        shape=(0, *chunk.shape[1:]),
+                        maxshape=(None, *chunk.shape[1:]),
+                        dtype=np.uint8,
+                        chunks=(self.chunk_size, *chunk.shape[1:]),
+                        compression="gzip",
+                        compression_opts=self.compression_level
+                    )
+
+                number_of_observations = dataset.shape[0]
+                dataset.resize(number_of_observations + chunk.shape[0], axis=0)
+                dataset[number_of_observations:] = chunk
+            except Exception as e:
+                self.error = e
+
+        if f is not None:
+            try:
+                f.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing an observation failed") from self.error
+
+    def _put(self, item):
+        # Never block on a writer thread that is no longer running, as nobody would take the item from the queue
+        while True:
+            if not self.thread.is_alive():
+                self._raise_error()
+                raise RuntimeError("The observation writer thread terminated unexpectedly")
+
+            try:
+                self.chunk_queue.put(item, timeout=HDF5_WRITER_LIVENESS_CHECK_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _submit_chunk(self):
+        chunk = np.stack(self.chunk)
+        self.chunk = []
+
+        start_time = time.perf_counter()
+        self._put(chunk)
+        self.blocked_time += time.perf_counter() - start_time
+
+    def write(self, observation: np.ndarray, iteration: int):
+        self._raise_error()
+
+        assert iteration == self.next_iteration, "Observations must be written in the order of their iteration"
+        self.next_iteration += 1
+
+        # Copy, as the environment might reuse the memory of the observation for the next screenshot
+        self.chunk.append(observation.copy())
+
+        if len(self.chunk) == self.chunk_size:
+            self._submit_chunk()
+
+    def close(self):
+        if len(self.chunk) > 0 and self.error is None:
+            self._submit_chunk()
+
+        self._put(None)
+        self.thread.join()
+
+        self._raise_error()
+
+
+ObservationWriter = Union[PNGObservationWriter, HDF5ObservationWriter]
+
+
+def create_observation_writer(output_format: str, sequence_directory: str, png_compression_level: int,
+                              container_compression_level: int, number_of_threads: int,
+                              max_pending_observations: int) -> ObservationWriter:
+    """
+    Returns the writer for the observations of a data sequence: png writes the observations folder, hdf5 an
+    observations container.
+    """
+    if output_format == "png":
+        observations_directory = os.path.join(sequence_directory, "observations")
+        os.makedirs(observations_directory, exist_ok=True)
+
+        return PNGObservationWriter(
+            observations_directory,
+            compression_level=png_compression_level,
+            number_of_threads=number_of_threads,
+            max_pending_observations=max_pending_observations
+        )
+
+    if output_format == "hdf5":
+        return HDF5ObservationWriter(
+            sequence_directory,
+            compression_level=container_compression_level,
+            max_pending_observations=max_pending_observations
+        )
+
+    raise RuntimeError(f"Observation output format '{output_format}' unknown")
@@ -17,7 +17,9 @@ from data.data_generation import data_generation_options
               help="In this directory, subfolders are automatically created based on time to store the generated data")
 @data_generation_options
 def main(number_of_sequences: int, number_of_processes: int, root_dir: str,
-         stop_mode: str, amount: int, monkey_type: str, random_click_prob: float, log: bool, html_report: bool):
+         stop_mode: str, amount: int, monkey_type: str, random_click_prob: float, log: bool, html_report: bool,
+         png_compression_level: int, output_format: str, container_compression_level: int,
+         number_of_observation_writers: int, max_pending_observations: int):
 
     python_commands = ["python", "data/data_generation.py"]
 
@@ -34,6 +36,11 @@ def main(number_of_sequences: int, number_of_processes: int, root_dir: str,
         python_commands.append(f"--no-log")
     if not html_report:
         python_commands.append(f"--no-html-report")
+    python_commands.append(f"--png-compression-level={png_compression_level}")
+    python_commands.append(f"--output-format={output_format}")
+    python_commands.append(f"--container-compression-level={container_compression_level}")
+    python_commands.append(f"--observation-writers={number_of_observation_writers}")
+    python_commands.append(f"--max-pending-observations={max_pending_observations}")
 
     xvfb_command = ["xvfb-run", "-a", "-s", "-screen 0 448x448x24"]
 
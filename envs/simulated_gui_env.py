@@ -1,5 +1,5 @@
 import os
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 
 import cv2
 import gym
@@ -8,9 +8,12 @@ import numpy as np
 import torch
 
 from models import BaseVAE
+from models.rnn import build_fused_dream_step, convert_rnn_for_inference
+from utils.logging.phase_profiler import get_profiler
 from utils.setup_utils import load_yaml_config
 from utils.training_utils.training_utils import (
-    load_rnn_architecture, load_vae_architecture, get_rnn_action_transformation_function
+    load_rnn_architecture, load_vae_architecture, get_rnn_action_transformation_function,
+    get_rnn_action_transformation_parameters
 )
 
 
@@ -18,7 +21,20 @@ class SimulatedGUIEnv(gym.Env):
 
     def __init__(self, rnn_dir: str, vae_dir: str, initial_obs_path: str, max_coordinate_size_for_task: int,
                  temperature: float, device: torch.device, load_best_rnn: bool = True, load_best_vae: bool = True,
-                 render: bool = False):
+                 render: bool = False, rnn_state_dict: Optional[dict] = None, use_fused_step: bool = False,
+                 inference_precision: str = "float32"):
+        """
+        If rnn_state_dict is given, the M model uses these (for example shared) weights instead of loading them from
+        rnn_dir, see load_shared_state_dict()
+
+        With use_fused_step, a step is calculated by a compiled FusedDreamStep instead of calling the M model and its
+        predict function separately. The rewards have the same shape and dtype as without it, i.e. integer rewards for
+        M models with a BCE reward output.
+
+        inference_precision (float32, int8 or bfloat16) selects the precision of the M model, see
+        convert_rnn_for_inference(). The observations are always returned as float32 tensors, such that the controller
+        can use them directly. Reduced precisions cannot be combined with the fused step.
+        """
         self.rnn_dir = rnn_dir
         self.vae_dir = vae_dir
         self.max_coordinate_size_for_task = max_coordinate_size_for_task
@@ -35,9 +51,14 @@ class SimulatedGUIEnv(gym.Env):
             self.initial_log_var = torch.from_numpy(f["log_var"][:]).to(self.device)
 
         self.rnn, _ = load_rnn_architecture(self.rnn_dir, self.vae_dir, self.device, batch_size=1,
-                                            load_best=load_best_rnn, load_optimizer=False)
+                                            load_best=load_best_rnn, load_optimizer=False,
+                                            shared_state_dict=rnn_state_dict)
         self.rnn.eval()
 
+        assert inference_precision == "float32" or not use_fused_step, ("The fused step only supports float32 "
+                                                                        "inference")
+        self.rnn = convert_rnn_for_inference(self.rnn, inference_precision)
+
         self.latent_observation = None  # Populated when doing env.reset()
 
         self.actions_transformation_function = get_rnn_action_transformation_function(
@@ -46,6 +67,14 @@ class SimulatedGUIEnv(gym.Env):
             action_transformation_function_type=self.rnn.action_transformation_function_type
         )
 
+        self.fused_step = None
+        if use_fused_step:
+            reduce_factor, new_max_coordinate = get_rnn_action_transformation_parameters(
+                max_coordinate_size_for_task=self.max_coordinate_size_for_task,
+                reduce_action_coordinate_space_by=self.rnn.reduce_action_coordinate_space_by
+            )
+            self.fused_step = build_fused_dream_step(self.rnn, reduce_factor, new_max_coordinate)
+
         vae_config = load_yaml_config(os.path.join(self.vae_dir, "config.yaml"))
         self.disable_kld = vae_config["model_parameters"]["disable_kld"]
         self.apply_value_range_when_kld_disabled = vae_config["model_parameters"]["apply_value_range_when_kld_disabled"]
@@ -67,11 +96,39 @@ class SimulatedGUIEnv(gym.Env):
         if not isinstance(actions, torch.Tensor):
             actions = torch.tensor(actions, device=self.device)
 
+        if self.fused_step is not None:
+            return self._fused_step(actions)
+
         actions = self.actions_transformation_function(actions).view(1, 1, -1)
 
+        profiler = get_profiler()
+
         with torch.no_grad():
-            rnn_output = self.rnn(self.latent_observation, actions)
-            self.latent_observation, reward = self.rnn.predict(rnn_output, self.latent_observation, self.temperature)
+            with profiler.measure("rnn_forward"):
+                rnn_output = self.rnn(self.latent_observation, actions)
+
+            with profiler.measure("mdn_sampling"):
+                latent_observation, reward = self.rnn.predict(rnn_output, self.latent_observation, self.temperature)
+
+        # No-op, except for reduced precision inference
+        self.latent_observation = latent_observation.float()
+
+        if reward.dtype == torch.bfloat16:
+            # The rewards are summed up over the rollout, which would be too imprecise in bfloat16
+            reward = reward.float()
+
+        return self.latent_observation, reward.squeeze(), False, {}
+
+    def _fused_step(self, actions: torch.Tensor):
+        with torch.no_grad(), get_profiler().measure("fused_step"):
+            next_latents, reward, hidden_state, cell_state = self.fused_step(
+                self.latent_observation.view(1, -1), actions.view(1, -1), self.rnn.hidden[0][0], self.rnn.hidden[1][0],
+                self.temperature
+            )
+
+        # Keep the same shapes as the unfused step, such that both can be used interchangeably
+        self.rnn.hidden = (hidden_state.unsqueeze(0), cell_state.unsqueeze(0))
+        self.latent_observation = next_latents.view(1, 1, -1)
 
         return self.latent_observation, reward.squeeze(), False, {}
 
@@ -0,0 +1,205 @@
+import os
+from typing import Optional, Sequence, Tuple, Union
+
+import gym
+import h5py
+import numpy as np
+import torch
+
+from models import BaseVAE
+from models.rnn import build_fused_dream_step, convert_rnn_for_inference
+from utils.logging.phase_profiler import get_profiler
+from utils.setup_utils import load_yaml_config
+from utils.training_utils.training_utils import (
+    load_rnn_architecture, get_rnn_action_transformation_function, get_rnn_action_transformation_parameters
+)
+
+
+class VectorizedSimulatedGUIEnv(gym.vector.VectorEnv):
+
+    def __init__(self, number_of_envs: int, rnn_dir: str, vae_dir: str, initial_obs_path: str,
+                 max_coordinate_size_for_task: int, temperature: Union[float, Sequence[float]], device: torch.device,
+                 load_best_rnn: bool = True, rnn_state_dict: Optional[dict] = None, use_fused_step: bool = False,
+                 inference_precision: str = "float32"):
+        """
+        number_of_envs independent SimulatedGUIEnv's, which share one M model that runs with number_of_envs as its
+        batch size. A step of all environments is therefore one batched forward pass.
+
+        Follows the step/reset contract of gym.vector.VectorEnv, but observations and rewards stay torch tensors on
+        the device, as in SimulatedGUIEnv:
+        - Observations: (NUM_ENVS, L_SIZE)
+        - Actions: (NUM_ENVS, ACTION_SIZE) integers in [0, max_coordinate_size_for_task - 1]
+        - Rewards: (NUM_ENVS) float tensor
+
+        temperature is either one temperature for all environments or one per environment. The simulated environments
+        never terminate on their own, reset(mask) can be used to reset a subset of them.
+
+        With set_noise() the random numbers of the environments can be provided in advance, see NoiseBank.
+
+        inference_precision selects the precision of the M model, as in SimulatedGUIEnv.
+        """
+        self.rnn_dir = rnn_dir
+        self.vae_dir = vae_dir
+        self.max_coordinate_size_for_task = max_coordinate_size_for_task
+        self.device = device
+
+        with h5py.File(initial_obs_path, "r") as f:
+            self.initial_mu = torch.from_numpy(f["mu"][:]).to(self.device)
+            self.initial_log_var = torch.from_numpy(f["log_var"][:]).to(self.device)
+
+        self.rnn, _ = load_rnn_architecture(self.rnn_dir, self.vae_dir, self.device, batch_size=number_of_envs,
+                                            load_best=load_best_rnn, load_optimizer=False,
+                                            shared_state_dict=rnn_state_dict)
+        self.rnn.eval()
+
+        assert inference_precision == "float32" or not use_fused_step, ("The fused step only supports float32 "
+                                                                        "inference")
+        self.rnn = convert_rnn_for_inference(self.rnn, inference_precision)
+
+        vae_config = load_yaml_config(os.path.join(self.vae_dir, "config.yaml"))
+        self.disable_kld = vae_config["model_parameters"]["disable_kld"]
+        self.apply_value_range_when_kld_disabled = vae_config["model_parameters"]["apply_value_range_when_kld_disabled"]
+
+        self.actions_transformation_function = get_rnn_action_transformation_function(
+            max_coordinate_size_for_task=self.max_coordinate_size_for_task,
+            reduce_action_coordinate_space_by=self.rnn.reduce_action_coordinate_space_by,
+            action_transformation_function_type=self.rnn.action_transformation_function_type
+        )
+
+        self.fused_step = None
+        if use_fused_step:
+            reduce_factor, new_max_coordinate = get_rnn_action_transformation_parameters(
+                max_coordinate_size_for_task=self.max_coordinate_size_for_task,
+                reduce_action_coordinate_space_by=self.rnn.reduce_action_coordinate_space_by
+            )
+            self.fused_step = build_fused_dream_step(self.rnn, reduce_factor, new_max_coordinate)
+
+        observation_space = gym.spaces.Box(low=-np.inf, high=np.inf, shape=(self.rnn.latent_size,), dtype=np.float32)
+        action_space = gym.spaces.MultiDiscrete([self.max_coordinate_size_for_task, self.max_coordinate_size_for_task])
+        super().__init__(number_of_envs, observation_space, action_space)
+
+        self.temperature = None
+        self.set_temperature(temperature)
+
+        # (NUM_ENVS, 1, L_SIZE), which is the input format of the M model. Populated when doing env.reset()
+        self.latent_observations = None
+        self._actions = None
+
+        # Pre-generated noise, see set_noise(), and the current step of each environment in it
+        self.noise = None
+        self.noise_steps = torch.zeros(number_of_envs, dtype=torch.long, device=self.device)
+
+    @property
+    def hidden_state(self) -> torch.Tensor:
+        """
+        Hidden state of the last layer of the M model, shape (NUM_ENVS, H_SIZE), i.e. the input of the controllers
+        together with the observations. Always float32, also for reduced precision inference.
+        """
+        return self.rnn.hidden[0][-1].float()
+
+    def set_temperature(self, temperature: Union[float, Sequence[float], torch.Tensor]):
+        temperature = torch.as_tensor(temperature, dtype=torch.float32, device=self.device)
+
+        if temperature.dim() == 0:
+            temperature = temperature.expand(self.num_envs)
+
+        assert temperature.size() == (self.num_envs,), "Provide one temperature or one temperature per environment"
+
+        # Note that temperature is only used in MDN RNN's (in M models where only a LSTM is used this has no usage)
+        self.temperature = temperature.contiguous()
+
+    def set_noise(self, noise: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]):
+        """
+        Use the given noise instead of drawing new random numbers, for example from NoiseBank.get(). noise is a tuple of
+        the initial noise (NUM_ENVS, L_SIZE), used when resetting, and the uniform and standard normal noise
+        (NUM_STEPS, NUM_ENVS, L_SIZE), used when stepping. An environment starts at the first step of the noise when it
+        is reset, and starts from the beginning again after NUM_STEPS steps. With None, new random numbers are drawn
+        again.
+        """
+        self.noise = noise
+
+    def _get_step_noise(self) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        if self.noise is None:
+            return None
+
+        _, uniform_noise, normal_noise = self.noise
+        steps = torch.remainder(self.noise_steps, uniform_noise.size(0))
+        envs = torch.arange(self.num_envs, device=self.device)
+
+        return uniform_noise[steps, envs], normal_noise[steps, envs]
+
+    def reset(self, mask: Optional[Union[np.ndarray, torch.Tensor]] = None):
+        self.reset_async()
+        return self.reset_wait(mask=mask)
+
+    def reset_wait(self, mask: Optional[Union[np.ndarray, torch.Tensor]] = None, **kwargs):
+        """
+        Resets the environments for which mask (NUM_ENVS boolean array) is True, or all environments if no mask is
+        given. A new initial latent observation is sampled for each reset environment and its hidden state is set to
+        zero, the other environments are left unchanged.
+        """
+        with torch.no_grad():
+            latent_observations = BaseVAE.reparameterize(
+                self.initial_mu.expand(self.num_envs, -1), self.initial_log_var.expand(self.num_envs, -1),
+                self.disable_kld, self.apply_value_range_when_kld_disabled,
+                eps=self.noise[0] if self.noise is not None else None
+            ).unsqueeze(1)
+
+            if mask is None or self.latent_observations is None:
+                self.latent_observations = latent_observations
+                self.rnn.initialize_hidden()
+                self.noise_steps.zero_()
+            else:
+                mask = torch.as_tensor(mask, dtype=torch.bool, device=self.device).view(self.num_envs)
+                self.noise_steps[mask] = 0
+
+                self.latent_observations = torch.where(mask.view(-1, 1, 1), latent_observations,
+                                                       self.latent_observations)
+                # Hidden states have the shape (NUM_LAYERS, NUM_ENVS, H_SIZE)
+                self.rnn.hidden = tuple(
+                    torch.where(mask.view(1, -1, 1), torch.zeros_like(h), h) for h in self.rnn.hidden
+                )
+
+        return self.latent_observations.view(self.num_envs, -1)
+
+    def step_async(self, actions: Union[np.ndarray, torch.Tensor]):
+        self._actions = torch.as_tensor(actions, device=self.device).view(self.num_envs, -1)
+
+    def step_wait(self, **kwargs):
+        actions = self._actions
+        self._actions = None
+
+        noise = self._get_step_noise()
+        profiler = get_profiler()
+
+        with torch.no_grad():
+            if self.fused_step is not None:
+                with profiler.measure("fused_step"):
+                    next_latents, rewards, hidden_state, cell_state = self.fused_step(
+                        self.latent_observations.view(self.num_envs, -1), actions, self.rnn.hidden[0][0],
+                        self.rnn.hidden[1][0], self.temperature, *(noise if noise is not None else (None, None))
+                    )
+
+                # Keep the same shapes as the unfused step, such that both can be used interchangeably
+                self.rnn.hidden = (hidden_state.unsqueeze(0), cell_state.unsqueeze(0))
+                self.latent_observations = next_latents.unsqueeze(1)
+            else:
+                with profiler.measure("rnn_forward"):
+                    rnn_output = self.rnn(self.latent_observations,
+                                          self.actions_transformation_function(actions).view(self.num_envs, 1, -1))
+
+                with profiler.measure("mdn_sampling"):
+                    latent_observations, rewards = self.rnn.predict(
+                        rnn_output, self.latent_observations, self.temperature,
+                        noise=tuple(n.unsqueeze(1) for n in noise) if noise is not None else None
+                    )
+
+                # No-op, except for reduced precision inference
+                self.latent_observations = latent_observations.float()
+
+        self.noise_steps += 1
+
+        dones = np.zeros(self.num_envs, dtype=np.bool_)
+        infos = [{} for _ in range(self.num_envs)]
+
+        return self.latent_observations.view(self.num_envs, -1), rewards.view(self.num_envs).float(), dones, infos
@@ -0,0 +1,69 @@
+import os
+from multiprocessing.connection import Client
+
+import click
+
+from utils.logging.phase_profiler import get_profiler
+from utils.rollout.gui_env_rollout import GUIEnvRollout
+from utils.rollout.gui_env_worker_pool import GUI_ENV_WORKER_AUTHKEY_ENVIRONMENT_VARIABLE
+from utils.setup_utils import get_device
+
+
+@click.command()
+@click.option("--rnn-dir", type=str, required=True, help="Path to the MDN RNN of the evaluated controllers")
+@click.option("--vae-dir", type=str, required=True, help="Path to the VAE of the evaluated controllers")
+@click.option("-g", "--gpu", type=int, default=-1, help="GPU on which evaluation shall run, -1 means cpu")
+@click.option("--stop-mode", type=click.Choice(["time", "iterations"]), required=True,
+              help="Use elapsed time in seconds or the number of iterations to evaluate")
+@click.option("--amount", type=int, help="Amount on how long the evaluation shall run (seconds or number of "
+                                         "iterations, depending on the stop_mode")
+@click.option("--latent-cache-size", type=int, default=0,
+              help="Number of encoded observations that are cached, 0 disables the cache")
+@click.option("--pipelined/--no-pipelined", type=bool, default=False,
+              help="Update the hidden state of the M model while the environment executes the action")
+@click.option("--enable-profiling/--no-enable-profiling", type=bool, default=False,
+              help="Measure the latency of the phases of each step")
+@click.option("--port", type=int, required=True, help="Port of the GUIEnvWorkerPool on localhost")
+def main(rnn_dir: str, vae_dir: str, gpu: int, stop_mode: str, amount: int, latent_cache_size: int, pipelined: bool,
+         enable_profiling: bool, port: int):
+    """
+    Worker of a GUIEnvWorkerPool, started by the pool inside xvfb-run. Loads the models and the environment once,
+    then evaluates each received controller parameter vector and sends back the rewards, the metrics of the latent
+    cache and the latencies of the phases of the steps, until None is received.
+    """
+    authkey = bytes.fromhex(os.environ[GUI_ENV_WORKER_AUTHKEY_ENVIRONMENT_VARIABLE])
+    device = get_device(gpu)
+
+    # Allow only local evaluations, meaning models have to be on the same device when evaluating
+    rollout_helper = GUIEnvRollout(
+        rnn_dir=rnn_dir,
+        vae_dir=vae_dir,
+        device=device,
+        stop_mode=stop_mode,
+        amount=amount,
+        load_best_rnn=True,
+        load_best_vae=True,
+        latent_cache_size=latent_cache_size,
+        pipelined=pipelined
+    )
+
+    profiler = get_profiler()
+    profiler.enabled = enable_profiling
+
+    connection = Client(("127.0.0.1", port), authkey=authkey)
+
+    while True:
+        task = connection.recv()
+
+        if task is None:
+            break
+
+        task_id, params = task
+        reward_sum, all_rewards = rollout_helper.rollout(params, return_reward_list=True)
+        connection.send((task_id, reward_sum, all_rewards, rollout_helper.get_latent_cache_metrics(), profiler.pop()))
+
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
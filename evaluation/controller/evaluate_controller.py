@@ -1,67 +1,92 @@
 import logging
-import subprocess
-import tempfile
-import time
-from copy import deepcopy
+import os
+from typing import Optional
 
 import click
 import numpy as np
+import torch
 
-from utils.setup_utils import initialize_logger
+from utils.misc import flatten_parameters
+from utils.rollout.gui_env_worker_pool import GUIEnvWorkerPool
+from utils.setup_utils import initialize_logger, get_depending_model_path
+from utils.training_utils.training_utils import construct_controller, load_controller_parameters
 
 
 def evaluate_controller(controller_directory: str, gpu: int, stop_mode: str, amount: int, number_of_evaluations: int,
-                        save_evaluations_file: str = None):
-    python_commands = [
-        "python", "-m", "evaluation.controller._evaluation_run",
-        f"--dir={controller_directory}",
-        f"--gpu={gpu}"
-    ]
-
-    if stop_mode == "time":
-        python_commands.append("-t")
-    elif stop_mode == "iterations":
-        python_commands.append("-i")
-    else:
-        raise RuntimeError(f"Stop mode '{stop_mode}' unknown")
-
-    python_commands.append(f"--amount={amount}")
-
-    xvfb_command = ["xvfb-run", "-a", "-s", "-screen 0 448x448x24"]
-
-    temporary_files = [tempfile.NamedTemporaryFile(suffix=".npz") for _ in range(number_of_evaluations)]
-    processes = []
-
-    for i in range(number_of_evaluations):
-        current_python_command = deepcopy(python_commands)
-        current_python_command.append(f"--tmp-file={temporary_files[i].name}")
-
-        command = xvfb_command + current_python_command
-
-        # Sleep a bit before starting a new process, to avoid getting a duplicate server number
-        time.sleep(0.25)
-        p = subprocess.Popen(command)
-        processes.append(p)
+                        save_evaluations_file: str = None, worker_pool: Optional[GUIEnvWorkerPool] = None,
+                        latent_cache_size: int = 0, pipelined: bool = False, enable_profiling: bool = False):
+    """
+    Evaluates the controller in controller_directory number_of_evaluations times on the actual environment.
 
-        logging.info(f"Started process with command {command}")
+    If worker_pool is given, its already running workers are used, which must have been started with the M and V model
+    of the controller. Otherwise, a temporary pool with at most one worker per evaluation (bounded by the number of CPU
+    cores) is started and shut down after the evaluation. latent_cache_size, pipelined and enable_profiling configure
+    the workers of the temporary pool, see GUIEnvRollout.
 
-    for i, p in enumerate(processes):
-        p.wait()
-        logging.info(f"Finished process {i}")
+    With profiling, the latency of each phase of a step on the environment is logged, in milliseconds per step. With
+    pipelining, the M model forward pass runs during the environment step, and only the time waiting for it (rnn_wait)
+    adds to the step time.
+    """
+    # Allow only local evaluations, meaning models have to be on the same device when evaluating
+    # Therefore use directory paths directly
+    rnn_dir = get_depending_model_path(model_type="controller", model_dir=controller_directory)
+    vae_dir = get_depending_model_path(model_type="rnn", model_dir=rnn_dir)
+
+    controller = construct_controller(rnn_dir, vae_dir)
+    controller, _ = load_controller_parameters(controller, controller_directory, torch.device("cpu"))
+    controller_parameters = flatten_parameters(controller.parameters())
+
+    temporary_worker_pool = worker_pool is None
+
+    if temporary_worker_pool:
+        worker_pool = GUIEnvWorkerPool(
+            rnn_dir=rnn_dir,
+            vae_dir=vae_dir,
+            gpu=gpu,
+            stop_mode=stop_mode,
+            amount=amount,
+            number_of_workers=min(number_of_evaluations, os.cpu_count() or 1),
+            latent_cache_size=latent_cache_size,
+            pipelined=pipelined,
+            enable_profiling=enable_profiling
+        )
+        worker_pool.start()
+    else:
+        assert (os.path.abspath(worker_pool.rnn_dir) == os.path.abspath(rnn_dir)
+                and os.path.abspath(worker_pool.vae_dir) == os.path.abspath(vae_dir)), \
+            "The worker pool must use the same M and V model as the evaluated controller"
 
-    logging.info("Finished all processes, gathering evaluation")
+    try:
+        results = worker_pool.evaluate([controller_parameters for _ in range(number_of_evaluations)])
+        worker_metrics = worker_pool.get_metrics()
+    finally:
+        if temporary_worker_pool:
+            worker_pool.shutdown()
 
-    reward_sums = []
-    list_of_all_rewards = []
+    logging.info("Finished all evaluations")
 
-    for tmp_file in temporary_files:
-        data = np.load(tmp_file.name)
-        reward_sums.append(data["reward_sum"].item())
-        list_of_all_rewards.append(data["all_rewards"])
+    reward_sums = [reward_sum for reward_sum, _ in results]
+    list_of_all_rewards = [all_rewards for _, all_rewards in results]
 
     logging.info(f"Controller Evaluation")
     logging.info(f"Max {np.max(reward_sums):.6f} - Mean {np.mean(reward_sums):.6f} - Std {np.std(reward_sums):.6f} - "
                  f"Min {np.min(reward_sums):.6f}")
+
+    if "latent_cache_hits" in worker_metrics:
+        logging.info(f"Latent cache: Hits {worker_metrics['latent_cache_hits']} - "
+                     f"Hit rate {worker_metrics['latent_cache_hit_rate']:.2%} - "
+                     f"Encoder time {worker_metrics['encoder_time']:.3f} s - "
+                     f"Saved encoder time {worker_metrics['saved_encoder_time']:.3f} s")
+
+    number_of_steps = worker_metrics.get("profiling/real_env_steps", 0)
+    if number_of_steps > 0:
+        latencies = [
+            f"{k.split('/')[-1]} {v / number_of_steps * 1000:.3f} ms" for k, v in worker_metrics.items()
+            if k.startswith("profiling/") and k != "profiling/real_env_steps"
+        ]
+        logging.info(f"Latency per step ({'pipelined' if worker_pool.pipelined else 'serial'}, {number_of_steps:.0f} "
+                     f"steps): {' - '.join(latencies)}")
+
     logging.info("Finished")
 
     if save_evaluations_file is not None:
@@ -87,7 +112,14 @@ def evaluation_options(function):
 @click.command()
 @evaluation_options
 @click.option("-n", "--number-of-evaluations", type=int, default=1, help="Number of evaluations")
-def main(controller_directory: str, gpu: int, stop_mode: str, amount: int, number_of_evaluations: int):
+@click.option("--latent-cache-size", type=int, default=0,
+              help="Number of encoded observations that each worker caches, 0 disables the cache")
+@click.option("--pipelined/--no-pipelined", type=bool, default=False,
+              help="Update the hidden state of the M model while the environment executes the action")
+@click.option("--profile/--no-profile", "enable_profiling", type=bool, default=False,
+              help="Log the latency of the phases of a step")
+def main(controller_directory: str, gpu: int, stop_mode: str, amount: int, number_of_evaluations: int,
+         latent_cache_size: int, pipelined: bool, enable_profiling: bool):
     """
     Evaluate a trained controller on the actual environment for number_of_evaluations
 
@@ -106,7 +138,10 @@ def main(controller_directory: str, gpu: int, stop_mode: str, amount: int, numbe
         stop_mode=stop_mode,
         amount=amount,
         number_of_evaluations=number_of_evaluations,
-        save_evaluations_file=save_evaluations_file
+        save_evaluations_file=save_evaluations_file,
+        latent_cache_size=latent_cache_size,
+        pipelined=pipelined,
+        enable_profiling=enable_profiling
     )
 
 
@@ -0,0 +1,83 @@
+import itertools
+import logging
+import os
+import time
+from typing import Tuple
+
+import click
+import numpy as np
+import torch
+from PIL import Image
+
+from utils.setup_utils import initialize_logger, get_device
+from utils.training_utils import vae_transformation_functions, ObservationPreprocessor
+
+DATASETS = ["gui_env_image_dataset", "gui_env_image_dataset_500k_normalize"]
+OUTPUT_ACTIVATION_FUNCTIONS = ["sigmoid", "tanh"]
+
+
+@click.command()
+@click.option("-d", "--dir", "observations_dir", type=str, required=True,
+              help="Directory with observation images, for example the observations folder of a data sequence")
+@click.option("-s", "--img-sizes", type=int, default=[64, 448], multiple=True, help="Image sizes of the V model")
+@click.option("-n", "--number-of-images", type=int, default=200, help="Maximum number of compared images")
+@click.option("-g", "--gpu", type=int, default=-1, help="GPU on which the preprocessing runs, -1 means cpu")
+def main(observations_dir: str, img_sizes: Tuple[int], number_of_images: int, gpu: int):
+    """
+    Compares ObservationPreprocessor with vae_transformation_functions() on the images in the given directory, for
+    every combination of dataset, output activation function and image size. Logs the maximum absolute difference of
+    the outputs (in units of one intensity step, i.e. 1/255 before normalization) and the time per observation of
+    both, including the transfer to the device.
+    """
+    logger, _ = initialize_logger()
+    logger.setLevel(logging.INFO)
+
+    device = get_device(gpu)
+
+    image_files = sorted(os.listdir(observations_dir))[:number_of_images]
+    observations = [np.asarray(Image.open(os.path.join(observations_dir, f)).convert("RGB")) for f in image_files]
+
+    for dataset, output_activation_function, img_size in itertools.product(DATASETS, OUTPUT_ACTIVATION_FUNCTIONS,
+                                                                           img_sizes):
+        transformation_functions = vae_transformation_functions(img_size, dataset, output_activation_function)
+        preprocessor = ObservationPreprocessor(img_size, dataset, output_activation_function, device)
+
+        # Scale the differences back to intensity steps, the normalization of the dataset scales them by 1 / std
+        if dataset == "gui_env_image_dataset_500k_normalize":
+            step_scale = preprocessor.std.cpu() * 255
+        elif output_activation_function == "tanh":
+            step_scale = 255 / 2
+        else:
+            step_scale = 255
+
+        max_difference = 0.0
+        differing_pixels = 0
+        pil_time = 0.0
+        tensor_time = 0.0
+
+        for ob in observations:
+            start_time = time.perf_counter()
+            expected = transformation_functions(Image.fromarray(ob)).unsqueeze(0).to(device)
+            if device.type != "cpu":
+                torch.cuda.synchronize(device)
+            pil_time += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            achieved = preprocessor(ob)
+            if device.type != "cpu":
+                torch.cuda.synchronize(device)
+            tensor_time += time.perf_counter() - start_time
+
+            difference = ((achieved - expected).abs().cpu() * step_scale).round()
+            max_difference = max(max_difference, difference.max().item())
+            differing_pixels += (difference > 0).sum().item()
+
+        logging.info(f"{dataset} - {output_activation_function} - {img_size}: Max diff {max_difference:.0f} steps - "
+                     f"Differing values {differing_pixels / (len(observations) * 3 * img_size ** 2):.4%} - "
+                     f"PIL {pil_time / len(observations) * 1000:.3f} ms - "
+                     f"Tensor {tensor_time / len(observations) * 1000:.3f} ms - "
+                     f"Speedup {pil_time / tensor_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
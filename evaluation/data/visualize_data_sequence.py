@@ -3,7 +3,8 @@ import os
 import click
 import cv2
 import numpy as np
-from PIL import Image
+
+from data.observation_container import close_observation_containers, list_sequence_observations, load_observation
 
 
 def color_pixel(img, y, x):
@@ -21,29 +22,28 @@ def color_around(img, x, y):
 
 def create_video_from_sequence(sequence_dir: str):
     video_file_path = os.path.join(sequence_dir, "sequence_visualized.mp4")
-    images_dir = os.path.join(sequence_dir, "observations")
 
     data = np.load(os.path.join(sequence_dir, "data.npz"))
     actions = data["actions"]
     rewards = data["rewards"]
 
-    images_list = os.listdir(images_dir)
-    images_list.sort()
-    images_list = images_list[:-1]
+    # Works for the observations folder and the observations container, the last observation has no action
+    observations = list_sequence_observations(sequence_dir)[:-1]
 
-    assert len(images_list) > 0
-    assert len(images_list) == actions.shape[0] and len(images_list) == rewards.shape[0]
+    assert len(observations) > 0
+    assert len(observations) == actions.shape[0] and len(observations) == rewards.shape[0]
 
-    img = np.asarray(Image.open(os.path.join(images_dir, images_list[0])))
+    img = load_observation(observations[0])
 
     size = (img.shape[0], img.shape[1])
     fps = 25
 
     video_out = cv2.VideoWriter(video_file_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (size[0], size[1]), isColor=True)
 
-    for i, img_file_path in enumerate(images_list):
+    for i, observation_reference in enumerate(observations):
         x, y = actions[i]
-        img = np.asarray(Image.open(os.path.join(images_dir, img_file_path)))
+        # Copy, as the pixels around the action are colored
+        img = np.array(load_observation(observation_reference))
 
         color_around(img, x, y)
 
@@ -51,6 +51,7 @@ def create_video_from_sequence(sequence_dir: str):
             video_out.write(cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 
     video_out.release()
+    close_observation_containers()
 
 
 @click.command()
@@ -0,0 +1,124 @@
+import logging
+import time
+
+import click
+import torch
+
+from models.model_selection import rnn_models
+from models.rnn import build_fused_dream_step
+from utils.setup_utils import initialize_logger, get_device
+from utils.training_utils.training_utils import (
+    get_rnn_action_transformation_function, get_rnn_action_transformation_parameters
+)
+
+
+def get_benchmark_model_parameters(hidden_size: int, number_of_gaussians: int, use_gaussian_per_latent_dim: bool,
+                                   reward_output_activation_function: str) -> dict:
+    return {
+        "hidden_size": hidden_size,
+        "hidden_layers": 1,
+        "action_size": 2,
+        "number_of_gaussians": number_of_gaussians,
+        "use_gaussian_per_latent_dim": use_gaussian_per_latent_dim,
+        "loss_scale_option": None,
+        "reward_output_activation_function": reward_output_activation_function,
+        "reduce_action_coordinate_space_by": -1,
+        "action_transformation_function": "tanh"
+    }
+
+
+def benchmark_unfused_step(rnn, actions_transformation_function, latent_size: int, batch_size: int,
+                           temperature: torch.Tensor, number_of_steps: int, device: torch.device) -> float:
+    """
+    Steps the M model the same way as SimulatedGUIEnv.step() without the fused step does. Returns steps per second.
+    """
+    rnn.batch_size = batch_size
+    rnn.initialize_hidden()
+    latents = torch.randn((batch_size, 1, latent_size), device=device)
+    actions = torch.randint(0, 448, (batch_size, 2), device=device)
+
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        for _ in range(number_of_steps):
+            transformed_actions = actions_transformation_function(actions)
+            rnn_output = rnn(latents, transformed_actions.view(batch_size, 1, -1))
+            latents, rewards = rnn.predict(rnn_output, latents, temperature)
+
+    return number_of_steps / (time.perf_counter() - start_time)
+
+
+def benchmark_fused_step(fused_step, hidden_size: int, latent_size: int, batch_size: int, temperature: torch.Tensor,
+                         number_of_steps: int, device: torch.device) -> float:
+    hidden_state = torch.zeros((batch_size, hidden_size), device=device)
+    cell_state = torch.zeros((batch_size, hidden_size), device=device)
+    latents = torch.randn((batch_size, latent_size), device=device)
+    actions = torch.randint(0, 448, (batch_size, 2), device=device)
+
+    with torch.no_grad():
+        # Warm up, TorchScript optimizes the graph during the first calls
+        for _ in range(10):
+            fused_step(latents, actions, hidden_state, cell_state, temperature)
+
+        start_time = time.perf_counter()
+        for _ in range(number_of_steps):
+            latents, rewards, hidden_state, cell_state = fused_step(latents, actions, hidden_state, cell_state,
+                                                                    temperature)
+
+    return number_of_steps / (time.perf_counter() - start_time)
+
+
+@click.command()
+@click.option("-s", "--steps", "number_of_steps", type=int, default=5000, help="Number of steps per measurement")
+@click.option("-b", "--batch-size", type=int, default=1, help="Batch size of the simulated environment")
+@click.option("--latent-size", type=int, default=32, help="Latent size of the (simulated) V model")
+@click.option("--hidden-size", type=int, default=256, help="Hidden size of the M model")
+@click.option("--number-of-gaussians", type=int, default=5, help="Number of gaussians of the MDN RNNs")
+@click.option("-g", "--gpu", type=int, default=-1, help="Use CPU (-1) or the corresponding GPU")
+def main(number_of_steps: int, batch_size: int, latent_size: int, hidden_size: int, number_of_gaussians: int,
+         gpu: int):
+    """
+    Compare the steps per second of a step in the simulated environment with and without the fused step for every
+    M model in models/model_selection.py. The models are randomly initialized, as the speed does not depend on the
+    trained weights.
+    """
+    logger, _ = initialize_logger()
+    logger.setLevel(logging.INFO)
+
+    device = get_device(gpu)
+    temperature = torch.tensor(1.0, device=device)
+
+    reduce_factor, new_max_coordinate = get_rnn_action_transformation_parameters(
+        max_coordinate_size_for_task=448, reduce_action_coordinate_space_by=-1
+    )
+
+    for model_name, model_class in rnn_models.items():
+        for use_gaussian_per_latent_dim in [True, False]:
+            model_parameters = get_benchmark_model_parameters(hidden_size, number_of_gaussians,
+                                                              use_gaussian_per_latent_dim, "sigmoid")
+            rnn = model_class(model_parameters, latent_size, batch_size, device).to(device)
+            rnn.eval()
+
+            actions_transformation_function = get_rnn_action_transformation_function(
+                max_coordinate_size_for_task=448,
+                reduce_action_coordinate_space_by=rnn.reduce_action_coordinate_space_by,
+                action_transformation_function_type=rnn.action_transformation_function_type
+            )
+
+            unfused_steps_per_second = benchmark_unfused_step(rnn, actions_transformation_function, latent_size,
+                                                              batch_size, temperature, number_of_steps, device)
+
+            fused_step = build_fused_dream_step(rnn, reduce_factor, new_max_coordinate)
+            fused_steps_per_second = benchmark_fused_step(fused_step, hidden_size, latent_size, batch_size,
+                                                          temperature, number_of_steps, device)
+
+            logging.info(f"{model_name} (gaussian per latent dim: {use_gaussian_per_latent_dim}) - "
+                         f"Unfused {unfused_steps_per_second:.1f} steps/s - Fused {fused_steps_per_second:.1f} "
+                         f"steps/s - Speedup {fused_steps_per_second / unfused_steps_per_second:.2f}x")
+
+            # use_gaussian_per_latent_dim has no effect on the non MDN models
+            if not hasattr(rnn, "number_of_gaussians"):
+                break
+
+
+if __name__ == "__main__":
+    main()
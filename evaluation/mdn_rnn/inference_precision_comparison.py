@@ -0,0 +1,195 @@
+import logging
+import os
+import time
+from typing import Dict, List, Tuple
+
+import click
+import numpy as np
+import torch
+
+from data.dataset_implementations import get_main_rnn_data_loader
+from envs.vectorized_simulated_gui_env import VectorizedSimulatedGUIEnv
+from models import select_rnn_model
+from models.rnn import INFERENCE_PRECISIONS
+from utils.data_processing_utils import get_vae_preprocessed_data_path_name
+from utils.rollout.noise_bank import NoiseBank
+from utils.setup_utils import (
+    initialize_logger, get_depending_model_path, resolve_model_path, get_device, load_yaml_config
+)
+from utils.training_utils.training_utils import (
+    generate_initial_observation_latent_vector, get_rnn_action_transformation_function,
+    get_rnn_reward_transformation_function
+)
+
+
+def replay_sequences(dict_of_sequence_actions: Dict[int, List[torch.Tensor]], rnn_dir: str, vae_dir: str,
+                     initial_obs_path: str, device: torch.device, temperature: float, inference_precision: str,
+                     load_best_rnn: bool = True) -> Tuple[Dict[int, np.ndarray], float]:
+    """
+    Replays the action sequences in a VectorizedSimulatedGUIEnv with the given inference precision, all sequences of
+    the same length at once. The k-th sequence of each length uses the k-th seed of a NoiseBank, such that the MDN
+    sampling uses the same random numbers for every precision and the differences only stem from the precision.
+
+    Returns the summed rewards per sequence length and the number of environment steps per second.
+    """
+    sequence_rewards = {}
+    number_of_steps = 0
+    elapsed_time = 0.0
+
+    for sequence_length, list_of_sequence_actions in dict_of_sequence_actions.items():
+        env = VectorizedSimulatedGUIEnv(
+            number_of_envs=len(list_of_sequence_actions),
+            rnn_dir=rnn_dir,
+            vae_dir=vae_dir,
+            initial_obs_path=initial_obs_path,
+            max_coordinate_size_for_task=448,
+            temperature=temperature,
+            device=device,
+            load_best_rnn=load_best_rnn,
+            inference_precision=inference_precision
+        )
+
+        noise_bank = NoiseBank(sequence_length, env.rnn.latent_size, device,
+                               cache_size=len(list_of_sequence_actions))
+        env.set_noise(noise_bank.get(list(range(len(list_of_sequence_actions)))))
+
+        # (SEQ_LEN, NUM_ENVS, ACTION_SIZE)
+        actions = torch.stack(list_of_sequence_actions, dim=1).to(device)
+        total_rewards = torch.zeros(env.num_envs, device=device)
+
+        env.reset()
+
+        start_time = time.perf_counter()
+        for t in range(sequence_length):
+            _, rewards, _, _ = env.step(actions[t])
+            total_rewards += rewards
+        elapsed_time += time.perf_counter() - start_time
+
+        number_of_steps += sequence_length
+        sequence_rewards[sequence_length] = total_rewards.cpu().numpy()
+
+    return sequence_rewards, number_of_steps / elapsed_time
+
+
+def wasserstein_distance(a: np.ndarray, b: np.ndarray) -> float:
+    # For two empirical distributions with the same number of samples, the 1-Wasserstein distance is the mean absolute
+    # difference of the sorted samples
+    return float(np.mean(np.abs(np.sort(a) - np.sort(b))))
+
+
+@click.command()
+@click.option("-r", "--rnn-dir", type=str, required=True, help="Path to a trained MDN RNN directory")
+@click.option("-d", "--dataset", "dataset_name", type=str,
+              help="Dataset name, if not used then dataset of MDN RNN is used")
+@click.option("--dataset-path", type=str, help="Path of the dataset specified by '--dataset'")
+@click.option("-t", "--temperature", type=float, default=1.0, help="Temperature parameter of the MDN RNN")
+@click.option("-p", "--precisions", type=click.Choice(INFERENCE_PRECISIONS), default=["int8", "bfloat16"],
+              multiple=True, help="Precisions that are compared to float32")
+@click.option("--best-rnn/--no-best-rnn", "load_best_rnn", type=bool, default=True,
+              help="Load the best RNN or the last checkpoint")
+@click.option("--vae-copied/--no-vae-copied", type=bool, default=True, help="Was the VAE copied?")
+@click.option("--vae-location", type=str, default="local", help="Where was the vae trained (for example ai-machine)?")
+def main(rnn_dir: str, dataset_name: str, dataset_path: str, temperature: float, precisions: Tuple[str],
+         load_best_rnn: bool, vae_copied: bool, vae_location: str):
+    """
+    Fidelity check of the reduced precision inference of the M model (see convert_rnn_for_inference()). The validation
+    sequences of the dataset are replayed with float32 and with each given precision, on the CPU as this is where the
+    dream rollout workers run. Per sequence length, the summed rewards are compared to float32 (mean absolute
+    difference per sequence and the 1-Wasserstein distance between the reward distributions) and to the actual rewards
+    of the sequences. The speedup is reported as well.
+    """
+    logger, _ = initialize_logger()
+    logger.setLevel(logging.INFO)
+
+    vae_dir = get_depending_model_path("rnn", rnn_dir)
+    vae_dir = resolve_model_path(vae_dir, model_copied=vae_copied, location=vae_location)
+
+    # Dynamic int8 quantization is only supported on the CPU
+    device = get_device(-1)
+
+    rnn_config = load_yaml_config(os.path.join(rnn_dir, "config.yaml"))
+    model_type = select_rnn_model(rnn_config["model_parameters"]["name"])
+
+    if dataset_name is None:
+        logging.info("Using dataset_name and dataset_path from RNN config. Might not work when the server running "
+                     "this script is different from the one the RNN was trained on!")
+        dataset_name = rnn_config["experiment_parameters"]["dataset"]
+        dataset_path = rnn_config["experiment_parameters"]["data_path"]
+    else:
+        assert dataset_path is not None, "If --dataset is provided, --dataset-path has to be provided too"
+
+    reward_transformation_function = get_rnn_reward_transformation_function(
+        reward_output_mode=model_type.get_reward_output_mode(),
+        reward_output_activation_function=rnn_config["model_parameters"]["reward_output_activation_function"]
+    )
+
+    actions_transformation_function = get_rnn_action_transformation_function(
+        max_coordinate_size_for_task=448,
+        reduce_action_coordinate_space_by=rnn_config["model_parameters"]["reduce_action_coordinate_space_by"],
+        action_transformation_function_type=rnn_config["model_parameters"]["action_transformation_function"]
+    )
+
+    val_dataset, _ = get_main_rnn_data_loader(
+        dataset_name=dataset_name,
+        dataset_path=dataset_path,
+        split="val",
+        sequence_length=1,
+        batch_size=None,
+        actions_transformation_function=actions_transformation_function,
+        reward_transformation_function=reward_transformation_function,
+        vae_preprocessed_data_path=get_vae_preprocessed_data_path_name(vae_dir, dataset_name),
+        use_shifted_data=rnn_config["experiment_parameters"]["use_shifted_data"],
+        shuffle=False
+    )
+
+    validation_sequences = val_dataset.get_validation_sequences_for_m_model_comparison()
+    dict_of_sequence_actions = {
+        sequence_length: [seq.actions for seq in sequence_list]
+        for sequence_length, sequence_list in validation_sequences.items()
+    }
+
+    if model_type.get_reward_output_mode() == "bce":
+        # Compare also to 0 _or_ 1 rewards because the BCE models predicts only 0 or 1
+        actual_rewards = {
+            sequence_length: np.array([reward_transformation_function(seq.rewards).sum() for seq in sequence_list])
+            for sequence_length, sequence_list in validation_sequences.items()
+        }
+    else:
+        actual_rewards = {
+            sequence_length: np.array([seq.rewards.sum() for seq in sequence_list])
+            for sequence_length, sequence_list in validation_sequences.items()
+        }
+
+    initial_obs_path = generate_initial_observation_latent_vector(vae_dir, device, load_best=True)
+
+    with torch.no_grad():
+        reference_rewards, reference_steps_per_second = replay_sequences(
+            dict_of_sequence_actions, rnn_dir, vae_dir, initial_obs_path, device, temperature, "float32", load_best_rnn
+        )
+
+        for precision in precisions:
+            rewards, steps_per_second = replay_sequences(
+                dict_of_sequence_actions, rnn_dir, vae_dir, initial_obs_path, device, temperature, precision,
+                load_best_rnn
+            )
+
+            log_info_as_txt = ""
+            for sequence_length, reference in reference_rewards.items():
+                achieved = rewards[sequence_length]
+                log_info_as_txt += (f"seq_len {sequence_length} # {len(achieved)} "
+                                    f"- Actual Rew {np.mean(actual_rewards[sequence_length]):.6f} "
+                                    f"- float32 Mean {np.mean(reference):.6f} "
+                                    f"- Mean {np.mean(achieved):.6f} "
+                                    f"- Std {np.std(achieved):.6f} (float32 {np.std(reference):.6f}) "
+                                    f"- Diff to float32 {np.mean(np.abs(achieved - reference)):.6f} "
+                                    f"- Wasserstein {wasserstein_distance(achieved, reference):.6f} "
+                                    f"- Cmp Actual {np.mean(np.abs(achieved - actual_rewards[sequence_length])):.6f} "
+                                    f"(float32 {np.mean(np.abs(reference - actual_rewards[sequence_length])):.6f})  \n")
+
+            logging.info(f"\nPrecision: {precision} - {steps_per_second:.1f} steps/s - Speedup "
+                         f"{steps_per_second / reference_steps_per_second:.2f}x")
+            logging.info(f"\n{log_info_as_txt}")
+
+
+if __name__ == "__main__":
+    main()
@@ -23,8 +23,13 @@ from utils.training_utils.training_utils import (
 def compare_reward_of_m_model_to_sequence(
         dict_of_sequence_actions: Dict[int, List[List[Tuple[torch.Tensor, torch.Tensor]]]], rnn_dir: str,
         vae_dir: str, max_coordinate_size_for_task: int, device: torch.device, initial_obs_path: str,
-        temperature: float = 1.0, load_best_rnn: bool = True, render: bool = False
+        temperature: float = 1.0, load_best_rnn: bool = True, render: bool = False, use_fused_step: bool = False
 ) -> Dict[int, List[float]]:
+    """
+    With use_fused_step, each sequence is replayed with one call of BaseRNN.imagine(), i.e. in the compiled fused step,
+    instead of stepping the simulated environment from Python. Both give the same rewards up to floating point
+    differences, the fused step is faster but requires a single layer LSTM.
+    """
 
     env = SimulatedGUIEnv(
         rnn_dir=rnn_dir,
@@ -45,18 +50,28 @@ def compare_reward_of_m_model_to_sequence(
     for sequence_length, list_of_sequence_actions in dict_of_sequence_actions.items():
         for sequence_actions in list_of_sequence_actions:
             assert len(sequence_actions.size()) == 2 and sequence_actions.size(1) == 2
-            env.reset()
-
-            summed_reward = 0.0
+            initial_latent = env.reset()
+
+            if use_fused_step:
+                _, rewards = env.rnn.imagine(
+                    initial_latent.view(1, -1),
+                    sequence_actions.to(device).unsqueeze(1),
+                    temperature=env.temperature,
+                    max_coordinate_size_for_task=max_coordinate_size_for_task
+                )
+                summed_reward = rewards.sum().cpu().item()
+                progress_bar.update(len(sequence_actions))
+            else:
+                summed_reward = 0.0
 
-            for action in sequence_actions:
-                _, rew, _, _ = env.step((action[0], action[1]))
-                summed_reward += rew
-                progress_bar.update(1)
+                for action in sequence_actions:
+                    _, rew, _, _ = env.step((action[0], action[1]))
+                    summed_reward += rew
+                    progress_bar.update(1)
 
-            # rew coming from the SimulatedGUIEnv is always a torch.Tensor
-            # noinspection PyUnresolvedReferences
-            summed_reward = summed_reward.cpu().item()
+                # rew coming from the SimulatedGUIEnv is always a torch.Tensor
+                # noinspection PyUnresolvedReferences
+                summed_reward = summed_reward.cpu().item()
 
             try:
                 sequence_rewards[sequence_length]
@@ -71,7 +86,7 @@ def compare_reward_of_m_model_to_sequence(
 
 
 def start_reward_comparison(rnn_dir, vae_dir, val_dataset, reward_output_mode, reward_transformation_function, device,
-                            temperature: float = 1.0, load_best_rnn: bool = True):
+                            temperature: float = 1.0, load_best_rnn: bool = True, use_fused_step: bool = False):
     validation_sequences = val_dataset.get_validation_sequences_for_m_model_comparison()
 
     dict_of_sequence_actions = {}
@@ -98,7 +113,8 @@ def start_reward_comparison(rnn_dir, vae_dir, val_dataset, reward_output_mode, r
         initial_obs_path=initial_obs_path,
         load_best_rnn=load_best_rnn,
         render=False,
-        temperature=temperature
+        temperature=temperature,
+        use_fused_step=use_fused_step
     )
 
     comparison_loss_function = torch.nn.L1Loss()
@@ -140,8 +156,10 @@ def start_reward_comparison(rnn_dir, vae_dir, val_dataset, reward_output_mode, r
               help="Load the best RNN or the last checkpoint")
 @click.option("--vae-copied/--no-vae-copied", type=bool, default=True, help="Was the VAE copied?")
 @click.option("--vae-location", type=str, default="local", help="Where was the vae trained (for example ai-machine)?")
+@click.option("--fused-step/--no-fused-step", "use_fused_step", type=bool, default=False,
+              help="Replay the sequences with the compiled fused step of the M model")
 def main(rnn_dir: str, dataset_name: str, dataset_path: str, gpu: int, temperatures: Tuple[float], load_best_rnn: bool,
-         vae_copied: bool, vae_location: str):
+         vae_copied: bool, vae_location: str, use_fused_step: bool):
     """
     TODO
         - Save result in numpy file
@@ -203,7 +221,8 @@ def main(rnn_dir: str, dataset_name: str, dataset_path: str, gpu: int, temperatu
             reward_transformation_function=reward_transformation_function,
             device=device,
             temperature=temp,
-            load_best_rnn=load_best_rnn
+            load_best_rnn=load_best_rnn,
+            use_fused_step=use_fused_step
         )
 
         logging.info(f"\nTemperature: {temp}")
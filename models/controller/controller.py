@@ -1,3 +1,5 @@
+from typing import Tuple
+
 import torch
 import torch.nn as nn
 
@@ -16,14 +18,55 @@ class Controller(nn.Module):
         x = torch.tanh(x)
         return x
 
-    def predict(self, model_output):
+    @staticmethod
+    def predict(model_output):
         """
         Map [-1, 1] range of model_output (coming from tanh in forward()) to integers in [0, MAX_COORDINATE - 1.0] range
         as this is what the controller should predict to navigate in the SUT (GUIEnv)
+
+        model_output can either be the output of a single controller or of a population of controllers, i.e. of
+        population_forward(). The result has the shape (BATCH_SIZE, 1, ACTION_SIZE), with BATCH_SIZE = 1 for a single
+        controller.
         """
         x = model_output.add(1.0)
         # -1 because we start counting by 0 (pixel coordinates)
         x = x.mul(MAX_COORDINATE - 1)
         x = torch.div(x, 2.0)
-        x = x.round().int().view(1, 1, -1)
+        x = x.round().int().view(-1, 1, model_output.size(-1))
+        return x
+
+    @staticmethod
+    def unflatten_population(population_parameters: torch.Tensor, input_size: int,
+                             action_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Split a (N, NUM_PARAMETERS) matrix of flattened controller parameters (for example a slice of the CMA-ES
+        solutions) into stacked weights (N, ACTION_SIZE, INPUT_SIZE) and biases (N, ACTION_SIZE). This uses the same
+        ordering as flatten_parameters(controller.parameters()), i.e. first fc.weight, then fc.bias.
+        """
+        population_size = population_parameters.size(0)
+        weight_numel = action_size * input_size
+
+        weights = population_parameters[:, :weight_numel].reshape(population_size, action_size, input_size)
+        biases = population_parameters[:, weight_numel:weight_numel + action_size]
+
+        return weights, biases
+
+    @staticmethod
+    def population_forward(weights: torch.Tensor, biases: torch.Tensor, latent_observations: torch.Tensor,
+                           hidden_states: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass of N controllers at once, each one on its own latent observation and hidden state. Instead of N
+        small matrix-vector products this is one batched matrix multiplication.
+
+        Shapes:
+        weights: (N, ACTION_SIZE, L_SIZE + H_SIZE), biases: (N, ACTION_SIZE)
+        latent_observations: (N, 1, L_SIZE) or (N, L_SIZE), hidden_states: (N, H_SIZE)
+        Output: (N, ACTION_SIZE)
+        """
+        population_size = weights.size(0)
+        x = torch.cat(
+            [latent_observations.reshape(population_size, -1), hidden_states.reshape(population_size, -1)], dim=-1
+        )
+        x = torch.baddbmm(biases.unsqueeze(-1), weights, x.unsqueeze(-1)).squeeze(-1)
+        x = torch.tanh(x)
         return x
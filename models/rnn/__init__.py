@@ -1,3 +1,5 @@
 from models.rnn.base_rnn import BaseRNN, BaseMDNRNN, BaseSimpleRNN
 from models.rnn.mdn_rnn import StandardMDNRNN, MDNRNNWithBCE
 from models.rnn.lstm import LSTMWithBCE, LSTMWithMSE
+from models.rnn.fused_dream_step import FusedDreamStep, build_fused_dream_step
+from models.rnn.inference_precision import INFERENCE_PRECISIONS, convert_rnn_for_inference
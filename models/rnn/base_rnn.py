@@ -1,6 +1,6 @@
 import abc
 import math
-from typing import Tuple
+from typing import Callable, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -47,17 +47,23 @@ class BaseRNN(abc.ABC, nn.Module):
 
         self.batch_size = batch_size
         self.device = device
+        # Only differs from float32 for reduced precision inference, see convert_rnn_for_inference()
+        self.hidden_dtype = torch.float32
 
         self.rnn = None
         self.fc = None
         self.hidden = None
         self.initialize_hidden()
 
+        # Compiled FusedDreamStep objects used by imagine(), per max_coordinate_size_for_task. This is a plain dict,
+        # therefore they are not registered as submodules and do not end up in the state dict
+        self._fused_dream_steps = {}
+
     def initialize_hidden(self):
         hidden_state = torch.zeros((self.number_of_hidden_layers, self.batch_size, self.hidden_size),
-                                   device=self.device, requires_grad=True)
+                                   dtype=self.hidden_dtype, device=self.device, requires_grad=True)
         cell_state = torch.zeros((self.number_of_hidden_layers, self.batch_size, self.hidden_size),
-                                 device=self.device, requires_grad=True)
+                                 dtype=self.hidden_dtype, device=self.device, requires_grad=True)
 
         self.hidden = (hidden_state, cell_state)
 
@@ -66,11 +72,100 @@ class BaseRNN(abc.ABC, nn.Module):
     def rnn_forward(
             self, latents: torch.Tensor,
             actions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        x = torch.cat([latents, actions], dim=-1)
+        x = torch.cat([latents, actions], dim=-1).to(self.hidden_dtype)
         outputs, self.hidden = self.rnn(x, self.hidden)
 
         return outputs, self.hidden
 
+    def imagine(self, initial_latents: torch.Tensor,
+                actions_or_controller: Union[torch.Tensor, nn.Module, Tuple[torch.Tensor, torch.Tensor], Callable],
+                number_of_steps: Optional[int] = None,
+                hidden: Optional[Tuple[torch.Tensor, torch.Tensor]] = None, temperature: float = 1.0,
+                max_coordinate_size_for_task: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Run the M model for multiple steps without calling it from Python at every step, i.e. "imagine" a trajectory.
+
+        initial_latents: (BATCH_SIZE, L_SIZE)
+        actions_or_controller: Either
+            - the actions as a (SEQ_LEN, BATCH_SIZE, ACTION_SIZE) tensor, in [0, max_coordinate_size_for_task - 1]
+            - a Controller, which is used for all batch entries
+            - a tuple (weights, biases) of stacked controllers, one per batch entry, see
+              Controller.unflatten_population()
+            - any other callable that maps (latents, hidden_states) of shapes (BATCH_SIZE, L_SIZE) and
+              (BATCH_SIZE, H_SIZE) to actions (BATCH_SIZE, ACTION_SIZE). It is called from Python at every step
+        number_of_steps: Only required if a controller is given
+        hidden: Initial (hidden_state, cell_state), each (1, BATCH_SIZE, H_SIZE). Zeros if not given
+        temperature: Float or (BATCH_SIZE) tensor, only used for MDN RNNs
+        max_coordinate_size_for_task: Size of the action coordinate space, the full GUI environment (MAX_COORDINATE) if
+            not given
+
+        Except for the Python callable, the steps run in one TorchScript compiled loop. self.hidden is set to the final
+        hidden state. Returns the latent trajectory (SEQ_LEN, BATCH_SIZE, L_SIZE) and the rewards (SEQ_LEN, BATCH_SIZE).
+        """
+        fused_dream_step = self._get_fused_dream_step(max_coordinate_size_for_task)
+
+        batch_size = initial_latents.size(0)
+        if hidden is None:
+            hidden_state = torch.zeros((batch_size, self.hidden_size), device=initial_latents.device)
+            cell_state = torch.zeros((batch_size, self.hidden_size), device=initial_latents.device)
+        else:
+            hidden_state, cell_state = hidden[0][-1], hidden[1][-1]
+
+        temperature = torch.as_tensor(temperature, dtype=initial_latents.dtype, device=initial_latents.device)
+
+        with torch.no_grad():
+            if isinstance(actions_or_controller, torch.Tensor):
+                latents, rewards, hidden_state, cell_state = fused_dream_step.rollout_actions(
+                    initial_latents, actions_or_controller, hidden_state, cell_state, temperature
+                )
+            else:
+                assert number_of_steps is not None, "When using a controller, the number of steps must be given"
+
+                if isinstance(actions_or_controller, nn.Module) and hasattr(actions_or_controller, "fc"):
+                    controller_weights = actions_or_controller.fc.weight.unsqueeze(0).expand(batch_size, -1, -1)
+                    controller_biases = actions_or_controller.fc.bias.unsqueeze(0).expand(batch_size, -1)
+                    actions_or_controller = (controller_weights, controller_biases)
+
+                if isinstance(actions_or_controller, tuple):
+                    latents, rewards, hidden_state, cell_state = fused_dream_step.rollout_controller(
+                        initial_latents, actions_or_controller[0], actions_or_controller[1], number_of_steps,
+                        hidden_state, cell_state, temperature
+                    )
+                else:
+                    latents, rewards = [], []
+                    current_latents = initial_latents
+
+                    for _ in range(number_of_steps):
+                        actions = actions_or_controller(current_latents, hidden_state)
+                        current_latents, current_rewards, hidden_state, cell_state = fused_dream_step(
+                            current_latents, actions, hidden_state, cell_state, temperature
+                        )
+                        latents.append(current_latents)
+                        rewards.append(current_rewards.view(-1).to(current_latents.dtype))
+
+                    latents, rewards = torch.stack(latents), torch.stack(rewards)
+
+        self.hidden = (hidden_state.unsqueeze(0), cell_state.unsqueeze(0))
+
+        return latents, rewards
+
+    def _get_fused_dream_step(self, max_coordinate_size_for_task: Optional[int]):
+        if max_coordinate_size_for_task not in self._fused_dream_steps:
+            # Imported here, as the fused_dream_step module and the training utils themselves depend on this module
+            from models.rnn.fused_dream_step import build_fused_dream_step
+            from utils.constants import MAX_COORDINATE
+            from utils.training_utils.training_utils import get_rnn_action_transformation_parameters
+
+            reduce_factor, new_max_coordinate = get_rnn_action_transformation_parameters(
+                max_coordinate_size_for_task if max_coordinate_size_for_task is not None else MAX_COORDINATE,
+                self.reduce_action_coordinate_space_by
+            )
+            self._fused_dream_steps[max_coordinate_size_for_task] = build_fused_dream_step(
+                self, reduce_factor, new_max_coordinate
+            )
+
+        return self._fused_dream_steps[max_coordinate_size_for_task]
+
     def combine_latent_and_reward_loss(self, latent_loss, reward_loss):
         if self.loss_scale_option is None:
             loss = latent_loss + reward_loss
@@ -88,7 +183,12 @@ class BaseRNN(abc.ABC, nn.Module):
         return loss
 
     @abc.abstractmethod
-    def predict(self, model_output, latents, temperature) -> Tuple[torch.Tensor, torch.Tensor]:
+    def predict(self, model_output, latents, temperature,
+                noise: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        noise optionally provides the random numbers for sampling the next latent vectors (only used by MDN RNNs), see
+        BaseMDNRNN._predict_gaussian_mixture()
+        """
         pass
 
     @abc.abstractmethod
@@ -113,89 +213,98 @@ class BaseMDNRNN(BaseRNN):
         self.number_of_gaussians = model_parameters["number_of_gaussians"]
         self.use_gaussian_per_latent_dim: bool = model_parameters["use_gaussian_per_latent_dim"]
 
-    def _predict_gaussian_mixture(self, model_output, temperature):
+    def _predict_gaussian_mixture(self, model_output, temperature,
+                                  noise: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
         # Temperature parameter is used at two points and only during sampling (not during training):
         # log_pi is divided with the temperature and sigma is multiplied with the square root of the temperature.
         # This is done in the reference implementation of the world model approach, specifically here:
         # https://github.com/hardmaru/WorldModelsExperiments/blob/master/doomrnn/doomrnn.py#L625 and on line 639
 
         # Shapes:
-        # latents: (1, 1, L_SIZE)
-        # mus, sigmas: (1, 1, N_GAUSS, L_SIZE)
-        # log_pi: (1, 1, N_GAUSS, 1) or (1, 1, N_GAUSS, L_SIZE) depending on
+        # mus, sigmas: (BATCH_SIZE, SEQ_LEN, N_GAUSS, L_SIZE)
+        # log_pi: (BATCH_SIZE, SEQ_LEN, N_GAUSS, 1) or (BATCH_SIZE, SEQ_LEN, N_GAUSS, L_SIZE) depending on
         #         self.use_gaussian_per_latent_dim
+        # temperature: Scalar (float or 0-dim tensor) or (BATCH_SIZE) tensor, i.e. one temperature per batch entry
+        # noise: Optional tuple of uniform noise in [0, 1) and standard normal noise, both
+        #        (BATCH_SIZE, SEQ_LEN, L_SIZE), which is then used instead of drawing new random numbers (for example
+        #        from a noise bank)
+        # Output: (BATCH_SIZE, SEQ_LEN, L_SIZE)
         mus = model_output[0]
         sigmas = model_output[1]
         log_pi = model_output[2]
 
-        number_of_gaussians = mus.size(2)
-        latent_size = mus.size(3)
+        batch_size, sequence_length, number_of_gaussians, latent_size = mus.size()
 
-        # Remove (1, 1) dimensions and transpose to get (L_SIZE, N_GAUSS) dimensions
-        mus = mus.view(number_of_gaussians, latent_size).t()
-        sigmas = sigmas.view(number_of_gaussians, latent_size).t()
+        temperature = torch.as_tensor(temperature, dtype=mus.dtype, device=mus.device)
+        if temperature.dim() > 0:
+            # Per batch entry temperature, reshape such that it broadcasts over (BATCH_SIZE, SEQ_LEN, ..., ...)
+            temperature = temperature.view(batch_size, 1, 1, 1)
 
-        if self.use_gaussian_per_latent_dim:
-            log_pi = log_pi.view(number_of_gaussians, latent_size).t()
-        else:
-            log_pi = log_pi.view(number_of_gaussians, 1).t()
+        # Transpose to get (BATCH_SIZE, SEQ_LEN, L_SIZE, N_GAUSS) dimensions, log_pi then has either L_SIZE or 1 in
+        # the third dimension
+        mus = mus.transpose(2, 3)
+        sigmas = sigmas.transpose(2, 3)
+        log_pi = log_pi.transpose(2, 3)
 
         # Exp-Normalization trick to calculate the softmax, useful to ensure numerical stability
         log_pi_temperature_adjusted = (log_pi / temperature)
-        log_pi_temperature_adjusted -= log_pi_temperature_adjusted.max()
+        log_pi_temperature_adjusted -= log_pi_temperature_adjusted.max(dim=-1, keepdim=True)[0]
         log_pi_temperature_adjusted = log_pi_temperature_adjusted.exp()
-        pi_temperature_adjusted = log_pi_temperature_adjusted / log_pi_temperature_adjusted.sum(dim=1, keepdim=True)
+        pi_temperature_adjusted = log_pi_temperature_adjusted / log_pi_temperature_adjusted.sum(dim=-1, keepdim=True)
 
         # Randomly select a gaussian distribution either per dimension of the latent vector
         # (self.use_gaussian_per_latent_dim == True) or one gaussian distribution in general if
         # (self.use_gaussian_per_latent_dim == False)
 
-        cumulated_sum = pi_temperature_adjusted.cumsum(dim=1)
+        cumulated_sum = pi_temperature_adjusted.cumsum(dim=-1)
         # Last entry is already 1.0 as the pis sum up to 1.0 because of the calculation above, but sometimes there
         # are slight rounding errors leading to results like 1.000001 or worse 0.9999994 etc. This leads to errors
         # in the drawing of the categorical distribution below, because if the random number is then 0.9999995
         # it would lead to a list of all False's which leads count_nonzero to count 0, which leads to getting an
         # index of num_gaussians - 0 = num_gaussians and this would be out of bounds!
-        cumulated_sum[:, -1] = 1.0
-
-        if self.use_gaussian_per_latent_dim:
-            pi_count = torch.count_nonzero(
-                cumulated_sum
-                >= torch.rand((latent_size, 1), device=self.device),
-                dim=1
-            )
+        cumulated_sum[..., -1] = 1.0
+
+        # Take the cumulated sum of the pi's and then use a random number of the uniform distribution to do create
+        # a categorical distribution. The first pi in the cumulated sum that is larger than the random number is
+        # the sample drawn. To get the first number simply count all non zeros (i.e. larger pi's) and then subtract
+        # from the size of pi at the last dim (i.e. number_of_gaussians). Hopefully this is faster than using
+        # torch.distributions.Categorical
+        # One random number is drawn per batch entry and time step, and if self.use_gaussian_per_latent_dim also per
+        # latent dimension
+        if noise is None:
+            uniform_noise = torch.rand((batch_size, sequence_length, cumulated_sum.size(2), 1), device=mus.device)
         else:
-            # Take the cumulated sum of the pi's and then use a random number of the uniform distribution to do create
-            # a categorical distribution. The first pi in the cumulated sum that is larger than the random number is
-            # the sample drawn. To get the first number simply count all non zeros (i.e. larger pi's) and then subtract
-            # from the size of pi at dim 1 (i.e. number_of_gaussians). Hopefully this is faster than using
-            # torch.distributions.Categorical
-            pi_count = torch.count_nonzero(cumulated_sum >= torch.rand(1, device=self.device))
+            uniform_noise = noise[0][..., :cumulated_sum.size(2)].unsqueeze(-1)
+
+        pi_count = torch.count_nonzero(cumulated_sum >= uniform_noise, dim=-1)
 
         drawn_mixtures = number_of_gaussians - pi_count
 
-        # Shape after this for selected_mus and selected_sigmas: (1, 1, L_SIZE)
-        if self.use_gaussian_per_latent_dim:
-            selected_mus = torch.gather(mus, dim=1, index=drawn_mixtures.unsqueeze(-1)).view(1, 1, latent_size)
-            selected_sigmas = torch.gather(sigmas, dim=1, index=drawn_mixtures.unsqueeze(-1)).view(1, 1, latent_size)
-        else:
-            selected_mus = mus[:, drawn_mixtures].view(1, 1, latent_size)
-            selected_sigmas = sigmas[:, drawn_mixtures].view(1, 1, latent_size)
+        # If only one gaussian is drawn for all latent dimensions, expand the drawn index to all of them
+        drawn_mixtures = drawn_mixtures.unsqueeze(-1).expand(batch_size, sequence_length, latent_size, 1)
+
+        # Shape after this for selected_mus and selected_sigmas: (BATCH_SIZE, SEQ_LEN, L_SIZE)
+        selected_mus = torch.gather(mus, dim=-1, index=drawn_mixtures).squeeze(-1)
+        selected_sigmas = torch.gather(sigmas, dim=-1, index=drawn_mixtures).squeeze(-1)
 
         # Now use the randomly selected gaussian(s) to sample the next latent vector, i.e. the prediction
-        random_vector = torch.randn(size=(1, 1, latent_size), device=self.device)
-        latent_prediction = selected_mus + random_vector * selected_sigmas * torch.sqrt(temperature)
+        if noise is None:
+            random_vector = torch.randn(size=(batch_size, sequence_length, latent_size), device=mus.device)
+        else:
+            random_vector = noise[1]
+        latent_prediction = selected_mus + random_vector * selected_sigmas * torch.sqrt(temperature.squeeze(-1))
 
         return latent_prediction
 
-    def predict(self, model_output, latents, temperature):
-        latent_prediction = self._predict_gaussian_mixture(model_output, temperature)
+    def predict(self, model_output, latents, temperature, noise=None):
+        latent_prediction = self._predict_gaussian_mixture(model_output, temperature, noise)
         rewards = model_output[3]
 
         # latent_prediction: (BATCH_SIZE, SEQ_LEN, L_SIZE)
         return latent_prediction, self.denormalize_reward(rewards)
 
     def _forward_gaussian_mixture(self, gmm_outputs, sequence_length):
+        batch_size = gmm_outputs.size(0)
         stride = self.number_of_gaussians * self.latent_size
 
         if self.use_gaussian_per_latent_dim:
@@ -211,15 +320,15 @@ class BaseMDNRNN(BaseRNN):
                 dim=-1
             )
 
-        mus = mus.view(self.batch_size, sequence_length, self.number_of_gaussians, self.latent_size)
+        mus = mus.view(batch_size, sequence_length, self.number_of_gaussians, self.latent_size)
 
-        sigmas = sigmas.view(self.batch_size, sequence_length, self.number_of_gaussians, self.latent_size)
+        sigmas = sigmas.view(batch_size, sequence_length, self.number_of_gaussians, self.latent_size)
         sigmas = torch.exp(sigmas)
 
         if self.use_gaussian_per_latent_dim:
-            pi = pi.view(self.batch_size, sequence_length, self.number_of_gaussians, self.latent_size)
+            pi = pi.view(batch_size, sequence_length, self.number_of_gaussians, self.latent_size)
         else:
-            pi = pi.view(self.batch_size, sequence_length, self.number_of_gaussians, 1)
+            pi = pi.view(batch_size, sequence_length, self.number_of_gaussians, 1)
 
         # The pi's shall sum to one, therefore take the softmax over dimension 2 (number_of_gaussians)
         # Use log_softmax for numerical stability as we also compute NLLLoss directly in log-space
@@ -283,7 +392,7 @@ class BaseSimpleRNN(BaseRNN):
     def __init__(self, model_parameters: dict, latent_size: int, batch_size: int, device: torch.device):
         super().__init__(model_parameters, latent_size, batch_size, device)
 
-    def predict(self, model_output, latents=None, temperature=None):
+    def predict(self, model_output, latents=None, temperature=None, noise=None):
         # This function mostly exists for mixture density network as the actual calculation of the next latent state
         # is not required for training, just the calculation of the predicted probability distribution.
         # But since we want to use the same interface, just return the prediction here
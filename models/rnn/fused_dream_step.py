@@ -0,0 +1,238 @@
+import logging
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+from torch.jit.frontend import FrontendError
+
+from models.rnn.base_rnn import BaseRNN, BaseMDNRNN
+from utils.constants import MAX_COORDINATE
+
+# How the raw reward output of the M model is transformed into the reward of the simulated environment
+REWARD_MODE_SIGMOID = 0  # MSE models with sigmoid output activation
+REWARD_MODE_TANH = 1  # MSE models with tanh output activation, the reward is mapped back to [0, 1]
+REWARD_MODE_BCE = 2  # BCE models, the sigmoid of the logits is rounded to either 0 or 1
+
+
+class FusedDreamStep(nn.Module):
+    """
+    One step of the simulated environment in a single call: Transformation of the actions into the input format of the
+    M model, the LSTM recurrence, the output layer, and (for MDN RNNs) the sampling of the next latent vector.
+
+    The LSTM is computed as a cell, i.e. without the overhead of calling nn.LSTM on a sequence of length 1. Instead of
+    copying, the weights of the given M model are used directly. This module is meant to be compiled with TorchScript,
+    see build_fused_dream_step(), such that the interpreter overhead of the many small operations is removed, which
+    dominates at small batch sizes.
+
+    The results are the same as calling the actions transformation function, rnn() and rnn.predict() one after another,
+    including the shape (BATCH_SIZE, 1, 1) and the dtype of the rewards (int for BCE models, float otherwise). The
+    trajectories of rollout_actions() and rollout_controller() store the rewards as float tensors.
+
+    Shapes:
+    latents: (BATCH_SIZE, L_SIZE), actions: (BATCH_SIZE, ACTION_SIZE) in [0, max_coordinate_size_for_task - 1]
+    hidden_state, cell_state: (BATCH_SIZE, H_SIZE)
+    temperature: 0-dim tensor or (BATCH_SIZE) tensor, only used for MDN RNNs
+    uniform_noise, normal_noise: Optional (BATCH_SIZE, L_SIZE) tensors, used instead of drawing new random numbers when
+    sampling from the MDN (for example from a noise bank)
+    """
+
+    def __init__(self, rnn: BaseRNN, reduce_factor: float, new_max_coordinate: float):
+        super().__init__()
+
+        assert isinstance(rnn.rnn, nn.LSTM) and rnn.rnn.num_layers == 1 and rnn.rnn.bias, ("The fused step only "
+                                                                                           "supports single layer "
+                                                                                           "LSTMs with bias")
+
+        self.latent_size: int = rnn.latent_size
+        self.is_mdn: bool = isinstance(rnn, BaseMDNRNN)
+
+        if self.is_mdn:
+            self.number_of_gaussians: int = rnn.number_of_gaussians
+            self.use_gaussian_per_latent_dim: bool = rnn.use_gaussian_per_latent_dim
+        else:
+            self.number_of_gaussians: int = 1
+            self.use_gaussian_per_latent_dim: bool = False
+
+        # reduce_factor <= 0 means that the action coordinate space is not reduced
+        self.reduce_factor: float = float(reduce_factor)
+        self.new_max_coordinate: float = float(new_max_coordinate)
+        self.use_tanh_actions: bool = rnn.action_transformation_function_type == "tanh"
+
+        if rnn.get_reward_output_mode() == "bce":
+            self.reward_mode: int = REWARD_MODE_BCE
+        elif rnn.reward_output_activation_function_type == "sigmoid":
+            self.reward_mode: int = REWARD_MODE_SIGMOID
+        else:
+            self.reward_mode: int = REWARD_MODE_TANH
+
+        # References to the weights of the M model, not copies
+        self.weight_ih = rnn.rnn.weight_ih_l0
+        self.weight_hh = rnn.rnn.weight_hh_l0
+        self.bias_ih = rnn.rnn.bias_ih_l0
+        self.bias_hh = rnn.rnn.bias_hh_l0
+        self.fc_weight = rnn.fc.weight
+        self.fc_bias = rnn.fc.bias
+
+    def forward(self, latents: torch.Tensor, actions: torch.Tensor, hidden_state: torch.Tensor,
+                cell_state: torch.Tensor, temperature: torch.Tensor, uniform_noise: Optional[torch.Tensor] = None,
+                normal_noise: Optional[torch.Tensor] = None
+                ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        batch_size = latents.size(0)
+
+        # Same as get_rnn_action_transformation_function()
+        actions = actions.to(latents.dtype)
+        if self.reduce_factor > 0:
+            actions = torch.floor(actions / self.reduce_factor)
+        if self.use_tanh_actions:
+            actions = ((2.0 * actions) / self.new_max_coordinate) - 1.0
+
+        x = torch.cat([latents, actions], dim=-1)
+
+        # LSTM cell, the gates are ordered (input, forget, cell, output) in the weights of nn.LSTM
+        gates = torch.addmm(self.bias_ih, x, self.weight_ih.t()) + torch.addmm(self.bias_hh, hidden_state,
+                                                                               self.weight_hh.t())
+        input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=1)
+
+        cell_state = torch.sigmoid(forget_gate) * cell_state + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+        hidden_state = torch.sigmoid(output_gate) * torch.tanh(cell_state)
+
+        outputs = torch.addmm(self.fc_bias, hidden_state, self.fc_weight.t())
+
+        if self.is_mdn:
+            next_latents = self._sample_gaussian_mixture(outputs, batch_size, temperature, uniform_noise, normal_noise)
+        else:
+            next_latents = outputs[:, :self.latent_size]
+
+        rewards = outputs[:, -1]
+
+        if self.reward_mode == REWARD_MODE_SIGMOID:
+            rewards = torch.sigmoid(rewards)
+        elif self.reward_mode == REWARD_MODE_TANH:
+            rewards = (torch.tanh(rewards) + 1.0) / 2.0
+        else:
+            rewards = torch.round(torch.sigmoid(rewards)).int()
+
+        return next_latents, rewards.view(batch_size, 1, 1), hidden_state, cell_state
+
+    @torch.jit.export
+    def rollout_actions(self, latents: torch.Tensor, actions: torch.Tensor, hidden_state: torch.Tensor,
+                        cell_state: torch.Tensor, temperature: torch.Tensor
+                        ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Open-loop rollout of a given action sequence, actions has the shape (SEQ_LEN, BATCH_SIZE, ACTION_SIZE).
+
+        Returns the latent trajectory (SEQ_LEN, BATCH_SIZE, L_SIZE), the rewards (SEQ_LEN, BATCH_SIZE) and the final
+        hidden and cell state.
+        """
+        number_of_steps = actions.size(0)
+        latent_trajectory = torch.empty((number_of_steps, latents.size(0), latents.size(1)), dtype=latents.dtype,
+                                        device=latents.device)
+        reward_trajectory = torch.empty((number_of_steps, latents.size(0)), dtype=latents.dtype,
+                                        device=latents.device)
+
+        for t in range(number_of_steps):
+            latents, rewards, hidden_state, cell_state = self.forward(latents, actions[t], hidden_state, cell_state,
+                                                                      temperature)
+            latent_trajectory[t] = latents
+            reward_trajectory[t] = rewards.view(-1).to(reward_trajectory.dtype)
+
+        return latent_trajectory, reward_trajectory, hidden_state, cell_state
+
+    @torch.jit.export
+    def rollout_controller(self, latents: torch.Tensor, controller_weights: torch.Tensor,
+                           controller_biases: torch.Tensor, number_of_steps: int, hidden_state: torch.Tensor,
+                           cell_state: torch.Tensor, temperature: torch.Tensor
+                           ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Closed-loop rollout, where the actions are calculated by one (linear) controller per batch entry, see
+        Controller.population_forward() and Controller.predict() for the computation and the shapes of the weights.
+
+        Returns the same as rollout_actions().
+        """
+        latent_trajectory = torch.empty((number_of_steps, latents.size(0), latents.size(1)), dtype=latents.dtype,
+                                        device=latents.device)
+        reward_trajectory = torch.empty((number_of_steps, latents.size(0)), dtype=latents.dtype,
+                                        device=latents.device)
+
+        for t in range(number_of_steps):
+            controller_input = torch.cat([latents, hidden_state], dim=-1).unsqueeze(-1)
+            controller_output = torch.tanh(
+                torch.baddbmm(controller_biases.unsqueeze(-1), controller_weights, controller_input).squeeze(-1)
+            )
+            actions = torch.round((controller_output + 1.0) * (MAX_COORDINATE - 1) / 2.0)
+
+            latents, rewards, hidden_state, cell_state = self.forward(latents, actions, hidden_state, cell_state,
+                                                                      temperature)
+            latent_trajectory[t] = latents
+            reward_trajectory[t] = rewards.view(-1).to(reward_trajectory.dtype)
+
+        return latent_trajectory, reward_trajectory, hidden_state, cell_state
+
+    def _sample_gaussian_mixture(self, outputs: torch.Tensor, batch_size: int, temperature: torch.Tensor,
+                                 uniform_noise: Optional[torch.Tensor],
+                                 normal_noise: Optional[torch.Tensor]) -> torch.Tensor:
+        # Same computation as BaseMDNRNN._forward_gaussian_mixture() followed by
+        # BaseMDNRNN._predict_gaussian_mixture(), without the sequence dimension
+        number_of_gaussians = self.number_of_gaussians
+        latent_size = self.latent_size
+        stride = number_of_gaussians * latent_size
+
+        # (BATCH_SIZE, L_SIZE, N_GAUSS)
+        mus = outputs[:, :stride].reshape(batch_size, number_of_gaussians, latent_size).transpose(1, 2)
+        sigmas = torch.exp(outputs[:, stride:2 * stride]).reshape(
+            batch_size, number_of_gaussians, latent_size
+        ).transpose(1, 2)
+
+        # (BATCH_SIZE, L_SIZE, N_GAUSS) or (BATCH_SIZE, 1, N_GAUSS)
+        if self.use_gaussian_per_latent_dim:
+            pi = outputs[:, 2 * stride:3 * stride].reshape(batch_size, number_of_gaussians, latent_size)
+        else:
+            pi = outputs[:, 2 * stride:2 * stride + number_of_gaussians].reshape(batch_size, number_of_gaussians, 1)
+
+        log_pi = torch.log_softmax(pi, dim=1).transpose(1, 2)
+
+        if temperature.dim() > 0:
+            temperature = temperature.view(batch_size, 1, 1)
+
+        log_pi_temperature_adjusted = log_pi / temperature
+        log_pi_temperature_adjusted = log_pi_temperature_adjusted - log_pi_temperature_adjusted.max(dim=-1,
+                                                                                                   keepdim=True)[0]
+        pi_temperature_adjusted = log_pi_temperature_adjusted.exp()
+        pi_temperature_adjusted = pi_temperature_adjusted / pi_temperature_adjusted.sum(dim=-1, keepdim=True)
+
+        cumulated_sum = pi_temperature_adjusted.cumsum(dim=-1)
+        cumulated_sum[:, :, -1] = 1.0
+
+        # New variables instead of reassigning the Optional arguments, as TorchScript would keep them Optional
+        if uniform_noise is None:
+            random_numbers = torch.rand((batch_size, cumulated_sum.size(1), 1), device=outputs.device)
+        else:
+            random_numbers = uniform_noise[:, :cumulated_sum.size(1)].unsqueeze(-1)
+
+        pi_count = (cumulated_sum >= random_numbers).sum(dim=-1)
+        drawn_mixtures = (number_of_gaussians - pi_count).unsqueeze(-1).expand(batch_size, latent_size, 1)
+
+        selected_mus = torch.gather(mus, dim=-1, index=drawn_mixtures).squeeze(-1)
+        selected_sigmas = torch.gather(sigmas, dim=-1, index=drawn_mixtures).squeeze(-1)
+
+        if normal_noise is None:
+            random_vector = torch.randn((batch_size, latent_size), device=outputs.device)
+        else:
+            random_vector = normal_noise
+
+        return selected_mus + random_vector * selected_sigmas * torch.sqrt(temperature).view(-1, 1)
+
+
+def build_fused_dream_step(rnn: BaseRNN, reduce_factor: float, new_max_coordinate: float) -> nn.Module:
+    """
+    Build a FusedDreamStep for the given M model and compile it with TorchScript. If the module cannot be compiled
+    (for example because the installed TorchScript version does not support a construct), the uncompiled module is
+    returned, which is still faster than the separate steps. Other errors are raised.
+    """
+    fused_dream_step = FusedDreamStep(rnn, reduce_factor, new_max_coordinate).eval()
+
+    try:
+        return torch.jit.script(fused_dream_step)
+    except (FrontendError, torch.jit.Error) as e:
+        logging.warning(f"Could not compile the fused dream step with TorchScript, using it uncompiled: {e}")
+        return fused_dream_step
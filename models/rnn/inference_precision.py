@@ -0,0 +1,33 @@
+import torch
+import torch.nn as nn
+
+from models.rnn.base_rnn import BaseRNN
+
+INFERENCE_PRECISIONS = ["float32", "int8", "bfloat16"]
+
+
+def convert_rnn_for_inference(rnn: BaseRNN, inference_precision: str) -> BaseRNN:
+    """
+    Returns the M model with reduced precision for inference:
+    - float32: The model itself, unchanged
+    - int8: A copy, in which the LSTM and the linear output layer are dynamically quantized, i.e. the weights are stored
+      as int8 and the activations are quantized on the fly. Only supported on the CPU
+    - bfloat16: The model itself, converted to bfloat16. The hidden state is then also kept in bfloat16, inputs are
+      converted in BaseRNN.rnn_forward(). The outputs of the model are bfloat16 tensors
+
+    The converted model has its own weights, shared weights (see load_shared_state_dict()) are therefore copied. Only
+    use the returned model for inference.
+    """
+    assert inference_precision in INFERENCE_PRECISIONS, f"Inference precision '{inference_precision}' unknown"
+
+    if inference_precision == "int8":
+        assert rnn.device.type == "cpu", "Dynamic int8 quantization is only supported on the CPU"
+
+        return torch.ao.quantization.quantize_dynamic(rnn, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+    if inference_precision == "bfloat16":
+        rnn = rnn.to(torch.bfloat16)
+        rnn.hidden_dtype = torch.bfloat16
+        rnn.initialize_hidden()
+
+    return rnn
@@ -32,8 +32,8 @@ class MDNRNNWithBCE(StandardMDNRNN):
         # that.
         self.denormalize_reward = lambda x: torch.round(x).int()
 
-    def predict(self, model_output, latents, temperature):
-        latent_prediction = self._predict_gaussian_mixture(model_output, temperature)
+    def predict(self, model_output, latents, temperature, noise=None):
+        latent_prediction = self._predict_gaussian_mixture(model_output, temperature, noise)
         predicted_reward_in_logits = model_output[3]
 
         # latent_prediction: (BATCH_SIZE, SEQ_LEN, L_SIZE)
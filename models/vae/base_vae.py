@@ -1,5 +1,5 @@
 import abc
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import torch
@@ -75,17 +75,22 @@ class BaseVAE(abc.ABC, nn.Module):
         pass
 
     @staticmethod
-    def reparameterization_trick(mu: torch.Tensor, log_var: torch.Tensor) -> torch.Tensor:
+    def reparameterization_trick(mu: torch.Tensor, log_var: torch.Tensor,
+                                 eps: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        eps can be used to provide the standard normal noise instead of drawing it, for example from a noise bank
+        """
         sigma = torch.exp(0.5 * log_var)
-        eps = torch.randn_like(sigma)
+        if eps is None:
+            eps = torch.randn_like(sigma)
         z = eps.mul(sigma).add_(mu)
 
         return z
 
     @staticmethod
     def reparameterize(mu: torch.Tensor, log_var: torch.Tensor, disable_kld: bool,
-                       apply_value_range_when_kld_disabled: bool):
-        z = BaseVAE.reparameterization_trick(mu, log_var)
+                       apply_value_range_when_kld_disabled: bool, eps: Optional[torch.Tensor] = None):
+        z = BaseVAE.reparameterization_trick(mu, log_var, eps)
 
         if disable_kld and apply_value_range_when_kld_disabled:
             z = torch.tanh(z)
@@ -0,0 +1,49 @@
+import logging
+
+import click
+import torch
+
+from utils.rollout.distributed import DEFAULT_MODEL_CACHE_DIR, distributed_worker_routine, get_authkey
+from utils.setup_utils import initialize_logger, get_device
+
+
+@click.command()
+@click.option("--host", type=str, required=True, help="Host of the Controller training (the coordinator)")
+@click.option("--port", type=int, default=6000, help="Port on which the coordinator listens")
+@click.option("-n", "--number-of-workers", type=int, default=1, help="Number of workers started on this machine")
+@click.option("-g", "--gpu", type=int, default=-1, help="Use CPU (-1) or the corresponding GPU")
+@click.option("--cache-dir", type=str, default=DEFAULT_MODEL_CACHE_DIR,
+              help="Directory in which the M models received from the coordinator are cached")
+def main(host: str, port: int, number_of_workers: int, gpu: int, cache_dir: str):
+    """
+    Start rollout workers for a Controller training that uses trainer_parameters.distributed. The workers connect to
+    the coordinator, receive the M model, and evaluate dream rollouts until the training is finished. Set the same
+    ROLLOUT_WORKER_AUTHKEY environment variable as for the training.
+    """
+    logger, _ = initialize_logger()
+    logger.setLevel(logging.INFO)
+
+    device = get_device(gpu)
+    authkey = get_authkey()
+
+    if number_of_workers == 1:
+        distributed_worker_routine(host, port, authkey, device, cache_dir)
+        return
+
+    ctx = torch.multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=distributed_worker_routine, args=(host, port, authkey, device, cache_dir))
+        for _ in range(number_of_workers)
+    ]
+
+    for p in processes:
+        p.start()
+
+    for p in processes:
+        p.join()
+
+    logging.info("Coordinator finished, stopped all rollout workers")
+
+
+if __name__ == "__main__":
+    main()
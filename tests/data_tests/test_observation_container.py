@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+
+from data import observation_container
+from data.observation_container import (
+    close_observation_containers, get_observations_container_path, list_sequence_observations, load_observation,
+    load_observation_image
+)
+from data.observation_writer import HDF5ObservationWriter, PNGObservationWriter
+
+NUMBER_OF_OBSERVATIONS = 10
+
+
+def create_observation(iteration: int) -> np.ndarray:
+    rng = np.random.default_rng(iteration)
+    return rng.integers(0, 256, (16, 24, 3), dtype=np.uint8)
+
+
+def write_container(sequence_dir: str, number_of_observations: int = NUMBER_OF_OBSERVATIONS):
+    os.makedirs(sequence_dir, exist_ok=True)
+
+    # The last chunk is only partially filled
+    writer = HDF5ObservationWriter(sequence_dir, chunk_size=4)
+    for i in range(number_of_observations):
+        writer.write(create_observation(i), i)
+    writer.close()
+
+
+def test_hdf5_writer_and_container_round_trip(tmp_path):
+    sequence_dir = str(tmp_path)
+    write_container(sequence_dir)
+
+    observations = list_sequence_observations(sequence_dir)
+
+    try:
+        assert observations == [(get_observations_container_path(sequence_dir), i)
+                                for i in range(NUMBER_OF_OBSERVATIONS)]
+
+        for i, observation_reference in enumerate(observations):
+            assert np.array_equal(load_observation(observation_reference), create_observation(i))
+
+        image = load_observation_image(observations[3])
+        assert image.size == (24, 16)
+        assert np.array_equal(np.asarray(image), create_observation(3))
+    finally:
+        close_observation_containers()
+
+
+def test_png_folder_and_container_load_the_same_observations(tmp_path):
+    png_sequence_dir = os.path.join(tmp_path, "png")
+    os.makedirs(os.path.join(png_sequence_dir, "observations"))
+
+    writer = PNGObservationWriter(os.path.join(png_sequence_dir, "observations"))
+    for i in range(NUMBER_OF_OBSERVATIONS):
+        writer.write(create_observation(i), i)
+    writer.close()
+
+    container_sequence_dir = os.path.join(tmp_path, "container")
+    write_container(container_sequence_dir)
+
+    png_observations = list_sequence_observations(png_sequence_dir)
+    container_observations = list_sequence_observations(container_sequence_dir)
+    assert len(png_observations) == len(container_observations) == NUMBER_OF_OBSERVATIONS
+
+    try:
+        for png_reference, container_reference in zip(png_observations, container_observations):
+            assert np.array_equal(load_observation(png_reference), load_observation(container_reference))
+    finally:
+        close_observation_containers()
+
+
+def test_least_recently_used_container_is_closed(tmp_path, monkeypatch):
+    monkeypatch.setattr(observation_container, "MAX_OPEN_CONTAINERS", 2)
+
+    sequence_dirs = [os.path.join(tmp_path, str(i)) for i in range(3)]
+    for sequence_dir in sequence_dirs:
+        write_container(sequence_dir, number_of_observations=1)
+
+    def open_container_paths():
+        return [path for _, path in observation_container._open_containers]
+
+    container_paths = [get_observations_container_path(sequence_dir) for sequence_dir in sequence_dirs]
+
+    try:
+        load_observation((container_paths[0], 0))
+        load_observation((container_paths[1], 0))
+        # Using the first container makes the second one the least recently used
+        load_observation((container_paths[0], 0))
+        load_observation((container_paths[2], 0))
+
+        assert open_container_paths() == [container_paths[0], container_paths[2]]
+
+        # A closed container is opened again when it is used
+        assert np.array_equal(load_observation((container_paths[1], 0)), create_observation(0))
+        assert open_container_paths() == [container_paths[2], container_paths[1]]
+    finally:
+        close_observation_containers()
@@ -0,0 +1,93 @@
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from data.observation_writer import HDF5ObservationWriter, PNGObservationWriter, get_observation_file_name
+
+NUMBER_OF_OBSERVATIONS = 20
+
+
+def create_observation(iteration: int) -> np.ndarray:
+    return np.full((16, 16, 3), iteration, dtype=np.uint8)
+
+
+def test_close_writes_all_queued_observations(tmp_path):
+    writer = PNGObservationWriter(str(tmp_path), number_of_threads=2, max_pending_observations=4)
+
+    observation = create_observation(0)
+    for i in range(NUMBER_OF_OBSERVATIONS):
+        # The writer copies the observation, therefore reusing the array must not change already written observations
+        observation[:] = i
+        writer.write(observation, i)
+
+    writer.close()
+
+    assert sorted(os.listdir(tmp_path)) == [get_observation_file_name(i) for i in range(NUMBER_OF_OBSERVATIONS)]
+
+    for i in range(NUMBER_OF_OBSERVATIONS):
+        written_observation = np.asarray(Image.open(os.path.join(tmp_path, get_observation_file_name(i))))
+        assert np.array_equal(written_observation, create_observation(i))
+
+
+def test_error_of_writer_thread_is_raised_in_close(tmp_path):
+    writer = PNGObservationWriter(os.path.join(tmp_path, "missing_directory"))
+    writer.write(create_observation(0), 0)
+
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+
+def test_error_of_writer_thread_is_raised_in_next_write(tmp_path):
+    writer = PNGObservationWriter(os.path.join(tmp_path, "missing_directory"), number_of_threads=1)
+    writer.write(create_observation(0), 0)
+
+    deadline = time.time() + 10
+    while writer.error is None and time.time() < deadline:
+        time.sleep(0.01)
+
+    with pytest.raises(RuntimeError) as exception_info:
+        writer.write(create_observation(1), 1)
+
+    assert isinstance(exception_info.value.__cause__, OSError)
+
+    # The threads still shut down, the error is raised again
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+
+def test_hdf5_writer_raises_if_the_container_cannot_be_created(tmp_path):
+    writer = HDF5ObservationWriter(os.path.join(tmp_path, "missing_directory"), chunk_size=2)
+
+    deadline = time.time() + 10
+    while writer.error is None and time.time() < deadline:
+        time.sleep(0.01)
+
+    with pytest.raises(RuntimeError) as exception_info:
+        writer.write(create_observation(0), 0)
+
+    assert isinstance(exception_info.value.__cause__, OSError)
+
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+
+def test_hdf5_writer_does_not_block_after_an_error(tmp_path):
+    # The queue only holds one chunk, without draining it after the error the writes and close() would block forever
+    writer = HDF5ObservationWriter(os.path.join(tmp_path, "missing_directory"), chunk_size=2,
+                                   max_pending_observations=2)
+
+    # Writes until the error of the writer thread is raised
+    with pytest.raises(RuntimeError):
+        iteration = 0
+        while True:
+            writer.write(create_observation(iteration % 256), iteration)
+            iteration += 1
+
+    # Also raises if it was already called or the thread already terminated
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+    assert not writer.thread.is_alive()
@@ -0,0 +1,64 @@
+import pytest
+import torch
+
+from models.rnn import MDNRNNWithBCE, StandardMDNRNN, build_fused_dream_step
+from utils.constants import MAX_COORDINATE
+from utils.training_utils.training_utils import (
+    get_rnn_action_transformation_function, get_rnn_action_transformation_parameters
+)
+
+BATCH_SIZE = 4
+LATENT_SIZE = 8
+HIDDEN_SIZE = 16
+
+
+def create_rnn(rnn_class) -> StandardMDNRNN:
+    model_parameters = {
+        "hidden_size": HIDDEN_SIZE,
+        "hidden_layers": 1,
+        "action_size": 2,
+        "number_of_gaussians": 5,
+        "use_gaussian_per_latent_dim": True,
+        "loss_scale_option": None,
+        "reward_output_activation_function": "sigmoid",
+        "reduce_action_coordinate_space_by": -1,
+        "action_transformation_function": "tanh"
+    }
+
+    torch.manual_seed(0)
+    return rnn_class(model_parameters, LATENT_SIZE, BATCH_SIZE, torch.device("cpu")).eval()
+
+
+@pytest.mark.parametrize("rnn_class", [StandardMDNRNN, MDNRNNWithBCE])
+def test_fused_step_matches_unfused_step(rnn_class):
+    rnn = create_rnn(rnn_class)
+
+    reduce_factor, new_max_coordinate = get_rnn_action_transformation_parameters(
+        MAX_COORDINATE, rnn.reduce_action_coordinate_space_by
+    )
+    fused_step = build_fused_dream_step(rnn, reduce_factor, new_max_coordinate)
+    actions_transformation_function = get_rnn_action_transformation_function(
+        MAX_COORDINATE, rnn.reduce_action_coordinate_space_by, rnn.action_transformation_function_type
+    )
+
+    latents = torch.randn((BATCH_SIZE, LATENT_SIZE))
+    actions = torch.randint(0, MAX_COORDINATE, (BATCH_SIZE, 2))
+    temperature = torch.tensor(1.0)
+    noise = (torch.rand((BATCH_SIZE, LATENT_SIZE)), torch.randn((BATCH_SIZE, LATENT_SIZE)))
+
+    with torch.no_grad():
+        rnn.initialize_hidden()
+        rnn_output = rnn(latents.unsqueeze(1), actions_transformation_function(actions).view(BATCH_SIZE, 1, -1))
+        unfused_latents, unfused_rewards = rnn.predict(rnn_output, latents.unsqueeze(1), temperature,
+                                                       noise=tuple(n.unsqueeze(1) for n in noise))
+
+        hidden_state = torch.zeros((BATCH_SIZE, HIDDEN_SIZE))
+        cell_state = torch.zeros((BATCH_SIZE, HIDDEN_SIZE))
+        fused_latents, fused_rewards, _, _ = fused_step(latents, actions, hidden_state, cell_state, temperature,
+                                                        *noise)
+
+    assert torch.allclose(fused_latents, unfused_latents.squeeze(1), atol=1e-5)
+
+    assert fused_rewards.size() == unfused_rewards.size() == (BATCH_SIZE, 1, 1)
+    assert fused_rewards.dtype == unfused_rewards.dtype
+    assert torch.allclose(fused_rewards.float(), unfused_rewards.float(), atol=1e-5)
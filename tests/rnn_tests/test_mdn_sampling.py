@@ -0,0 +1,88 @@
+import pytest
+import torch
+
+from models.rnn.mdn_rnn import StandardMDNRNN
+
+BATCH_SIZE = 4
+SEQUENCE_LENGTH = 3
+LATENT_SIZE = 8
+NUMBER_OF_GAUSSIANS = 5
+
+
+def create_rnn(use_gaussian_per_latent_dim: bool) -> StandardMDNRNN:
+    model_parameters = {
+        "hidden_size": 16,
+        "hidden_layers": 1,
+        "action_size": 2,
+        "number_of_gaussians": NUMBER_OF_GAUSSIANS,
+        "use_gaussian_per_latent_dim": use_gaussian_per_latent_dim,
+        "loss_scale_option": None,
+        "reward_output_activation_function": "sigmoid",
+        "reduce_action_coordinate_space_by": -1,
+        "action_transformation_function": "tanh"
+    }
+
+    return StandardMDNRNN(model_parameters, LATENT_SIZE, BATCH_SIZE, torch.device("cpu"))
+
+
+def create_model_output(rnn: StandardMDNRNN):
+    torch.manual_seed(0)
+    latents = torch.randn((BATCH_SIZE, SEQUENCE_LENGTH, LATENT_SIZE))
+    actions = torch.rand((BATCH_SIZE, SEQUENCE_LENGTH, 2))
+
+    with torch.no_grad():
+        return rnn(latents, actions)
+
+
+def create_noise():
+    return (torch.rand((BATCH_SIZE, SEQUENCE_LENGTH, LATENT_SIZE)),
+            torch.randn((BATCH_SIZE, SEQUENCE_LENGTH, LATENT_SIZE)))
+
+
+@pytest.mark.parametrize("use_gaussian_per_latent_dim", [True, False])
+def test_batched_sampling_shapes(use_gaussian_per_latent_dim):
+    rnn = create_rnn(use_gaussian_per_latent_dim)
+    model_output = create_model_output(rnn)
+
+    latents, rewards = rnn.predict(model_output, None, 1.0)
+
+    assert latents.size() == (BATCH_SIZE, SEQUENCE_LENGTH, LATENT_SIZE)
+    assert rewards.size() == (BATCH_SIZE, SEQUENCE_LENGTH, 1)
+
+
+@pytest.mark.parametrize("use_gaussian_per_latent_dim", [True, False])
+def test_batched_sampling_matches_per_row_sampling(use_gaussian_per_latent_dim):
+    rnn = create_rnn(use_gaussian_per_latent_dim)
+    model_output = create_model_output(rnn)
+    noise = create_noise()
+
+    batched_latents, _ = rnn.predict(model_output, None, 1.0, noise)
+
+    for i in range(BATCH_SIZE):
+        row_latents, _ = rnn.predict(tuple(x[i:i + 1] for x in model_output), None, 1.0,
+                                     tuple(x[i:i + 1] for x in noise))
+        assert torch.allclose(batched_latents[i:i + 1], row_latents)
+
+
+def test_per_row_temperature_matches_scalar_temperature():
+    rnn = create_rnn(use_gaussian_per_latent_dim=True)
+    model_output = create_model_output(rnn)
+    noise = create_noise()
+
+    temperatures = torch.tensor([0.5, 1.0, 1.5, 2.0])
+    batched_latents, _ = rnn.predict(model_output, None, temperatures, noise)
+
+    for i, temperature in enumerate(temperatures.tolist()):
+        scalar_latents, _ = rnn.predict(model_output, None, temperature, noise)
+        assert torch.allclose(batched_latents[i], scalar_latents[i])
+
+
+def test_sampling_with_noise_is_deterministic():
+    rnn = create_rnn(use_gaussian_per_latent_dim=False)
+    model_output = create_model_output(rnn)
+    noise = create_noise()
+
+    first_latents, _ = rnn.predict(model_output, None, 1.0, noise)
+    second_latents, _ = rnn.predict(model_output, None, 1.0, noise)
+
+    assert torch.equal(first_latents, second_latents)
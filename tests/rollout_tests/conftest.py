@@ -0,0 +1,60 @@
+import os
+
+import h5py
+import pytest
+import torch
+import yaml
+
+from models import select_rnn_model
+
+LATENT_SIZE = 4
+
+RNN_MODEL_PARAMETERS = {
+    "name": "mdn_mse",
+    "hidden_size": 8,
+    "hidden_layers": 1,
+    "action_size": 2,
+    "number_of_gaussians": 2,
+    "use_gaussian_per_latent_dim": True,
+    "loss_scale_option": None,
+    "reward_output_activation_function": "sigmoid",
+    "reduce_action_coordinate_space_by": -1,
+    "action_transformation_function": "tanh"
+}
+
+
+@pytest.fixture
+def rollout_arguments(tmp_path) -> dict:
+    """ Rollout arguments of a tiny, randomly initialized V and M model, such that rollouts run in a few milliseconds.
+    """
+    rnn_dir = os.path.join(tmp_path, "rnn")
+    vae_dir = os.path.join(tmp_path, "vae")
+    os.makedirs(rnn_dir)
+    os.makedirs(vae_dir)
+
+    with open(os.path.join(rnn_dir, "config.yaml"), "w") as f:
+        yaml.safe_dump({"model_parameters": RNN_MODEL_PARAMETERS, "experiment_parameters": {"batch_size": 1}}, f)
+
+    vae_model_parameters = {"latent_size": LATENT_SIZE, "disable_kld": False,
+                            "apply_value_range_when_kld_disabled": False}
+    with open(os.path.join(vae_dir, "config.yaml"), "w") as f:
+        yaml.safe_dump({"model_parameters": vae_model_parameters}, f)
+
+    initial_obs_path = os.path.join(vae_dir, "initial_obs_latent.hdf5")
+    with h5py.File(initial_obs_path, "w") as f:
+        f.create_dataset("mu", data=torch.zeros((1, LATENT_SIZE)).numpy())
+        f.create_dataset("log_var", data=torch.zeros((1, LATENT_SIZE)).numpy())
+
+    rnn = select_rnn_model(RNN_MODEL_PARAMETERS["name"])(RNN_MODEL_PARAMETERS, LATENT_SIZE, 1, torch.device("cpu"))
+
+    return {
+        "rnn_dir": rnn_dir,
+        "vae_dir": vae_dir,
+        "initial_obs_path": initial_obs_path,
+        "temperature": 1.0,
+        "time_limit": 20,
+        "device": torch.device("cpu"),
+        "stop_when_total_reward_exceeded": False,
+        "rollout_batch_size": 1,
+        "rnn_state_dict": rnn.state_dict()
+    }
@@ -0,0 +1,39 @@
+import os
+
+from utils.misc import flatten_parameters
+from utils.rollout.distributed import DistributedRolloutWorkerPool
+from utils.training_utils.training_utils import construct_controller
+
+NUMBER_OF_TASKS = 8
+
+
+def test_chunks_of_killed_worker_are_redispatched(tmp_path, rollout_arguments):
+    params = flatten_parameters(
+        construct_controller(rollout_arguments["rnn_dir"], rollout_arguments["vae_dir"]).parameters()
+    )
+
+    pool = DistributedRolloutWorkerPool(
+        number_of_local_workers=2,
+        rollout_arguments=rollout_arguments,
+        host="127.0.0.1",
+        port=0,
+        authkey=os.urandom(32),
+        tasks_per_chunk=1,
+        max_chunks_in_flight=2,
+        cache_dir=os.path.join(tmp_path, "model_cache")
+    )
+    pool.start()
+
+    try:
+        while len(pool.connections) < 2:
+            pool._receive_message()
+
+        # Both workers have chunks in flight, the chunks of the killed worker must be evaluated by the other one
+        pool.submit([(i, params) for i in range(NUMBER_OF_TASKS)])
+        pool.processes[0].kill()
+
+        results = [pool.get_result() for _ in range(NUMBER_OF_TASKS)]
+    finally:
+        pool.shutdown()
+
+    assert sorted(s_id for s_id, _ in results) == list(range(NUMBER_OF_TASKS))
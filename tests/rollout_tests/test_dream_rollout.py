@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+import torch
+
+from envs.vectorized_simulated_gui_env import VectorizedSimulatedGUIEnv
+from utils.misc import flatten_parameters
+from utils.rollout.dream_rollout import PopulationDreamRollout
+from utils.rollout.noise_bank import NoiseBank
+from utils.training_utils.training_utils import construct_controller
+
+POPULATION_SIZE = 4
+NOISE_SEEDS = [11, 12, 13, 14]
+MAX_COORDINATE_SIZE = 448
+
+
+def create_population_rollout(rollout_arguments: dict, number_of_envs: int) -> PopulationDreamRollout:
+    return PopulationDreamRollout(
+        number_of_envs=number_of_envs,
+        rnn_dir=rollout_arguments["rnn_dir"],
+        vae_dir=rollout_arguments["vae_dir"],
+        initial_obs_path=rollout_arguments["initial_obs_path"],
+        max_coordinate_size_for_task=MAX_COORDINATE_SIZE,
+        temperature=rollout_arguments["temperature"],
+        device=rollout_arguments["device"],
+        time_limit=rollout_arguments["time_limit"],
+        rnn_state_dict=rollout_arguments["rnn_state_dict"],
+        use_noise_bank=True
+    )
+
+
+def create_population_parameters(rollout_arguments: dict) -> np.ndarray:
+    number_of_parameters = len(flatten_parameters(
+        construct_controller(rollout_arguments["rnn_dir"], rollout_arguments["vae_dir"]).parameters()
+    ))
+
+    return np.random.default_rng(0).normal(size=(POPULATION_SIZE, number_of_parameters))
+
+
+def create_vectorized_env(rollout_arguments: dict, number_of_envs: int, temperature=1.0) -> VectorizedSimulatedGUIEnv:
+    return VectorizedSimulatedGUIEnv(
+        number_of_envs=number_of_envs,
+        rnn_dir=rollout_arguments["rnn_dir"],
+        vae_dir=rollout_arguments["vae_dir"],
+        initial_obs_path=rollout_arguments["initial_obs_path"],
+        max_coordinate_size_for_task=MAX_COORDINATE_SIZE,
+        temperature=temperature,
+        device=rollout_arguments["device"],
+        rnn_state_dict=rollout_arguments["rnn_state_dict"]
+    )
+
+
+def create_actions(number_of_envs: int, step: int) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(step)
+    return torch.randint(0, MAX_COORDINATE_SIZE, (number_of_envs, 2), generator=generator)
+
+
+@pytest.mark.parametrize("temperatures", [None, [0.5, 1.0, 1.5, 2.0]])
+def test_population_rollout_matches_separate_rollouts(rollout_arguments, temperatures):
+    population_parameters = create_population_parameters(rollout_arguments)
+
+    population_rollout = create_population_rollout(rollout_arguments, POPULATION_SIZE)
+    single_rollout = create_population_rollout(rollout_arguments, 1)
+
+    with torch.no_grad():
+        population_results = population_rollout.rollout(population_parameters, NOISE_SEEDS, temperatures)
+        separate_results = [
+            single_rollout.rollout(
+                population_parameters[i:i + 1], NOISE_SEEDS[i:i + 1],
+                temperatures[i:i + 1] if temperatures is not None else None
+            )[0]
+            for i in range(POPULATION_SIZE)
+        ]
+
+    assert population_results.tolist() == pytest.approx(separate_results, abs=1e-5)
+
+
+def test_per_controller_temperatures_change_the_rollouts(rollout_arguments):
+    population_parameters = create_population_parameters(rollout_arguments)
+    population_rollout = create_population_rollout(rollout_arguments, POPULATION_SIZE)
+
+    # The same controller and noise, only the temperature differs
+    same_parameters = np.repeat(population_parameters[:1], POPULATION_SIZE, axis=0)
+
+    with torch.no_grad():
+        results = population_rollout.rollout(same_parameters, [NOISE_SEEDS[0]] * POPULATION_SIZE,
+                                             [0.1, 0.1, 5.0, 5.0])
+
+    assert results[0] == pytest.approx(results[1], abs=1e-6)
+    assert results[2] == pytest.approx(results[3], abs=1e-6)
+    assert results[0] != pytest.approx(results[2], abs=1e-6)
+
+
+def test_partial_chunk_matches_full_batch(rollout_arguments):
+    population_parameters = create_population_parameters(rollout_arguments)
+    population_rollout = create_population_rollout(rollout_arguments, POPULATION_SIZE)
+
+    with torch.no_grad():
+        full_results = population_rollout.rollout(population_parameters, NOISE_SEEDS)
+        # Fewer controllers than environments, as for the last chunk of a generation
+        partial_results = population_rollout.rollout(population_parameters[:2], NOISE_SEEDS[:2])
+
+    assert list(population_rollout.partial_simulated_gui_envs.keys()) == [2]
+    assert population_rollout.partial_simulated_gui_envs[2].num_envs == 2
+    assert partial_results.tolist() == pytest.approx(full_results[:2].tolist(), abs=1e-5)
+
+
+def test_reset_with_mask_only_resets_the_masked_envs(rollout_arguments):
+    env = create_vectorized_env(rollout_arguments, number_of_envs=3)
+    env.set_noise(NoiseBank(rollout_arguments["time_limit"], env.rnn.latent_size, env.device).get(NOISE_SEEDS[:3]))
+
+    initial_observations = env.reset().clone()
+    first_step_observations, first_step_rewards, _, _ = env.step(create_actions(3, step=0))
+
+    for step in range(1, 3):
+        observations, _, _, _ = env.step(create_actions(3, step))
+    hidden_state = env.hidden_state.clone()
+
+    mask = np.array([True, False, True])
+    reset_observations = env.reset(mask)
+
+    assert torch.equal(reset_observations[mask], initial_observations[mask])
+    assert torch.equal(reset_observations[1], observations[1])
+    assert torch.equal(env.hidden_state[mask], torch.zeros_like(hidden_state[mask]))
+    assert torch.equal(env.hidden_state[1], hidden_state[1])
+    assert env.noise_steps.tolist() == [0, 3, 0]
+
+    # The reset environments start again at the first step of their noise, the same actions give the same step
+    observations, rewards, _, _ = env.step(create_actions(3, step=0))
+
+    assert torch.allclose(observations[mask], first_step_observations[mask], atol=1e-6)
+    assert torch.allclose(rewards[mask], first_step_rewards[mask], atol=1e-6)
+
+
+def test_temperature_is_set_per_env(rollout_arguments):
+    env = create_vectorized_env(rollout_arguments, number_of_envs=3, temperature=[0.5, 1.0, 2.0])
+    assert env.temperature.tolist() == [0.5, 1.0, 2.0]
+
+    env.set_temperature(1.5)
+    assert env.temperature.tolist() == [1.5, 1.5, 1.5]
+
+    with pytest.raises(AssertionError):
+        env.set_temperature([1.0, 2.0])
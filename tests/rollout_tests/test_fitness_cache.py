@@ -0,0 +1,61 @@
+import numpy as np
+
+from utils.rollout.fitness_cache import FitnessCache
+
+
+def test_key_depends_on_exact_parameters_and_noise_seed():
+    params = np.arange(4, dtype=np.float64)
+
+    key = FitnessCache.get_key(params, 1.0, 100, 7)
+
+    assert key == FitnessCache.get_key(params.copy(), 1.0, 100, 7)
+    assert key == FitnessCache.get_key(params.astype(np.float32), 1.0, 100, 7)
+    assert key != FitnessCache.get_key(params + 1e-12, 1.0, 100, 7)
+    assert key != FitnessCache.get_key(params, 1.0, 100, 8)
+    assert key != FitnessCache.get_key(params, 0.5, 100, 7)
+    assert key != FitnessCache.get_key(params, 1.0, 200, 7)
+
+
+def test_rollouts_without_noise_seed_are_not_cached():
+    cache = FitnessCache(max_size=2)
+
+    key = FitnessCache.get_key(np.zeros(3), 1.0, 100, None)
+    cache.put(key, 1.0)
+
+    assert key is None
+    assert cache.get(key) is None
+    assert len(cache.cache) == 0
+
+
+def test_least_recently_used_result_is_evicted():
+    cache = FitnessCache(max_size=2)
+    keys = [FitnessCache.get_key(np.full(3, i, dtype=np.float64), 1.0, 100, 0) for i in range(3)]
+
+    cache.put(keys[0], 0.0)
+    cache.put(keys[1], 1.0)
+    # Using the first result makes the second one the least recently used
+    assert cache.get(keys[0]) == 0.0
+    cache.put(keys[2], 2.0)
+
+    assert cache.get(keys[0]) == 0.0
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == 2.0
+
+    metrics = cache.get_metrics()
+    assert metrics["fitness_cache_hits"] == 3
+    assert metrics["fitness_cache_hit_rate"] == 0.75
+
+
+def test_state_round_trip_keeps_most_recently_used_results():
+    cache = FitnessCache(max_size=3)
+    keys = [FitnessCache.get_key(np.full(3, i, dtype=np.float64), 1.0, 100, 0) for i in range(3)]
+
+    for i, key in enumerate(keys):
+        cache.put(key, float(i))
+
+    restored_cache = FitnessCache(max_size=2)
+    restored_cache.set_state(cache.get_state())
+
+    assert restored_cache.get(keys[0]) is None
+    assert restored_cache.get(keys[1]) == 1.0
+    assert restored_cache.get(keys[2]) == 2.0
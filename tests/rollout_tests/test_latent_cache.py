@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+
+from utils.rollout.latent_cache import ObservationLatentCache
+
+
+def create_observation(value: int) -> np.ndarray:
+    return np.full((8, 8, 3), value, dtype=np.uint8)
+
+
+def test_identical_observations_hit_the_cache():
+    cache = ObservationLatentCache(max_size=2)
+    mu, log_var = torch.zeros(4), torch.ones(4)
+
+    key = ObservationLatentCache.get_key(create_observation(0))
+    assert cache.get(key) is None
+    cache.put(key, mu, log_var, encoder_time=2.0)
+
+    # A new array with the same content, as the environment returns a new screenshot every step
+    cached_mu, cached_log_var = cache.get(ObservationLatentCache.get_key(create_observation(0)))
+    assert cached_mu is mu and cached_log_var is log_var
+
+    assert cache.get(ObservationLatentCache.get_key(create_observation(1))) is None
+
+    metrics = cache.get_metrics()
+    assert metrics["latent_cache_hits"] == 1
+    assert metrics["latent_cache_misses"] == 2
+    assert metrics["encoder_time"] == 2.0
+    assert metrics["saved_encoder_time"] == 1.0
+
+    assert cache.get_metrics()["latent_cache_hits"] == 0
+
+
+def test_observations_with_same_bytes_but_different_shape_do_not_collide():
+    observation = create_observation(0)
+
+    assert (ObservationLatentCache.get_key(observation)
+            != ObservationLatentCache.get_key(observation.reshape((4, 16, 3))))
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ObservationLatentCache(max_size=2)
+    keys = [ObservationLatentCache.get_key(create_observation(i)) for i in range(3)]
+
+    for key in keys[:2]:
+        cache.put(key, torch.zeros(4), torch.zeros(4), encoder_time=0.0)
+
+    # Using the first entry makes the second one the least recently used
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[2], torch.zeros(4), torch.zeros(4), encoder_time=0.0)
+
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
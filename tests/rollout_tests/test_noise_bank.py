@@ -0,0 +1,73 @@
+import torch
+
+from utils.rollout.noise_bank import NoiseBank, get_evaluation_noise_seed, get_noise_seed
+
+TIME_LIMIT = 20
+LATENT_SIZE = 8
+
+
+def test_noise_seeds_are_deterministic():
+    assert get_noise_seed(1010, 3, 2) == get_noise_seed(1010, 3, 2)
+    assert get_evaluation_noise_seed(1010, 2) == get_evaluation_noise_seed(1010, 2)
+
+    assert get_noise_seed(1010, 3, 2) != get_noise_seed(1010, 4, 2)
+    assert get_noise_seed(1010, 3, 2) != get_noise_seed(1010, 3, 1)
+    assert get_noise_seed(1010, 3, 2) != get_noise_seed(1011, 3, 2)
+
+
+def test_evaluation_noise_seeds_differ_from_generation_noise_seeds():
+    generation_seeds = {get_noise_seed(1010, generation, k) for generation in range(10) for k in range(10)}
+    evaluation_seeds = {get_evaluation_noise_seed(1010, k) for k in range(10)}
+
+    assert not generation_seeds & evaluation_seeds
+
+
+def test_noise_bank_shapes():
+    noise_bank = NoiseBank(TIME_LIMIT, LATENT_SIZE, torch.device("cpu"))
+
+    initial_noise, uniform_noise, normal_noise = noise_bank.get([1, 2, 3])
+
+    assert initial_noise.size() == (3, LATENT_SIZE)
+    assert uniform_noise.size() == (TIME_LIMIT, 3, LATENT_SIZE)
+    assert normal_noise.size() == (TIME_LIMIT, 3, LATENT_SIZE)
+    assert ((uniform_noise >= 0) & (uniform_noise < 1)).all()
+
+
+def test_same_seed_gives_same_noise():
+    first_noise = NoiseBank(TIME_LIMIT, LATENT_SIZE, torch.device("cpu")).get([7, 8])
+    second_noise = NoiseBank(TIME_LIMIT, LATENT_SIZE, torch.device("cpu")).get([7, 8])
+
+    for first, second in zip(first_noise, second_noise):
+        assert torch.equal(first, second)
+
+
+def test_noise_of_a_seed_is_independent_of_the_batch():
+    noise_bank = NoiseBank(TIME_LIMIT, LATENT_SIZE, torch.device("cpu"))
+
+    single_noise = noise_bank.get([7])
+    batch_noise = noise_bank.get([5, 7, 9])
+
+    assert torch.equal(single_noise[0][0], batch_noise[0][1])
+    assert torch.equal(single_noise[1][:, 0], batch_noise[1][:, 1])
+    assert torch.equal(single_noise[2][:, 0], batch_noise[2][:, 1])
+
+
+def test_different_seeds_give_different_noise():
+    initial_noise, uniform_noise, normal_noise = NoiseBank(TIME_LIMIT, LATENT_SIZE, torch.device("cpu")).get([7, 8])
+
+    assert not torch.equal(initial_noise[0], initial_noise[1])
+    assert not torch.equal(uniform_noise[:, 0], uniform_noise[:, 1])
+    assert not torch.equal(normal_noise[:, 0], normal_noise[:, 1])
+
+
+def test_evicted_seeds_give_the_same_noise_again():
+    noise_bank = NoiseBank(TIME_LIMIT, LATENT_SIZE, torch.device("cpu"), cache_size=2)
+
+    first_noise = noise_bank.get([1])
+    noise_bank.get([2, 3, 4])
+    assert 1 not in noise_bank.cache
+
+    second_noise = noise_bank.get([1])
+
+    for first, second in zip(first_noise, second_noise):
+        assert torch.equal(first, second)
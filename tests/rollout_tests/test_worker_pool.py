@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.misc import flatten_parameters
+from utils.rollout.dream_rollout import create_dream_rollout
+from utils.rollout.worker_pool import RolloutWorkerPool, evaluate_chunk
+from utils.training_utils.training_utils import construct_controller
+
+NUMBER_OF_TASKS = 8
+TASKS_PER_CHUNK = 2
+# Less rows than distinct parameter vectors per submit, the parameters of the remaining tasks are pickled
+SHARED_MEMORY_ROWS = 6
+
+
+def create_pool(tasks_per_chunk: int) -> RolloutWorkerPool:
+    # Without workers nothing is started, the chunks are only formed when they are evaluated
+    return RolloutWorkerPool(number_of_workers=0, rollout_arguments={"rollout_batch_size": 1, "temperature": 1.0},
+                             tasks_per_chunk=tasks_per_chunk)
+
+
+def test_chunks_do_not_mix_tasks_with_and_without_noise_seed():
+    pool = create_pool(tasks_per_chunk=4)
+    params = np.zeros(3)
+
+    pool.submit([(0, params, 11), (1, params, 12), (2, params), (3, params), (4, params, 13)])
+
+    chunks = []
+    while pool.pending_tasks:
+        _, tasks = pool._next_chunk()
+        chunks.append([task[0] for task in tasks])
+
+    assert chunks == [[0, 1], [2, 3], [4]]
+
+
+
+def test_spawned_workers_match_local_rollouts_and_release_shared_memory(rollout_arguments):
+    # With noise seeds the rollouts are deterministic, and with the same batches the workers compute the same results
+    rollout_arguments = dict(rollout_arguments, use_noise_bank=True, rollout_batch_size=TASKS_PER_CHUNK)
+
+    number_of_parameters = len(flatten_parameters(
+        construct_controller(rollout_arguments["rnn_dir"], rollout_arguments["vae_dir"]).parameters()
+    ))
+    rng = np.random.default_rng(0)
+    params = [rng.normal(size=number_of_parameters) for _ in range(NUMBER_OF_TASKS)]
+    noise_seeds = list(range(100, 100 + NUMBER_OF_TASKS))
+
+    with torch.no_grad():
+        expected_results = evaluate_chunk(create_dream_rollout(**rollout_arguments), np.stack(params),
+                                          TASKS_PER_CHUNK, noise_seeds)
+
+    pool = RolloutWorkerPool(number_of_workers=2, rollout_arguments=rollout_arguments, tasks_per_chunk=TASKS_PER_CHUNK,
+                             max_chunks_in_flight=1, shared_memory_rows=SHARED_MEMORY_ROWS,
+                             number_of_parameters=number_of_parameters)
+    pool.start()
+    processes = list(pool.processes)
+
+    try:
+        # The rows are released after each submit, therefore the second one uses the shared memory the same way
+        for _ in range(2):
+            pool.submit([(i, params[i], noise_seeds[i]) for i in range(NUMBER_OF_TASKS)])
+
+            # Each worker got one chunk, the remaining chunks wait until a worker returns its chunk
+            assert [len(chunks) for chunks in pool.chunks_in_flight.values()] == [1, 1]
+            assert len(pool.pending_tasks) == NUMBER_OF_TASKS - 2 * TASKS_PER_CHUNK
+
+            results = {}
+            for _ in range(NUMBER_OF_TASKS):
+                s_id, result = pool.get_result()
+                results[s_id] = result
+
+                assert all(len(chunks) <= 1 for chunks in pool.chunks_in_flight.values())
+
+            assert [results[i] for i in range(NUMBER_OF_TASKS)] == pytest.approx(expected_results, abs=1e-6)
+
+            assert sorted(pool.free_rows) == list(range(SHARED_MEMORY_ROWS))
+            assert pool.row_references == [0] * SHARED_MEMORY_ROWS
+            assert sorted(pool.free_result_slots) == [0, 1]
+            assert pool.get_metrics()["pickled_tasks"] == NUMBER_OF_TASKS - SHARED_MEMORY_ROWS
+    finally:
+        pool.shutdown()
+
+    # The workers terminate on their own, they are not killed
+    assert all(not p.is_alive() and p.exitcode == 0 for p in processes)
+    assert pool.processes == [] and pool.task_queues == []
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from utils.training_utils.training_utils import (
+    ObservationPreprocessor, get_dataset_mean_std, vae_transformation_functions
+)
+
+IMG_SIZE = 64
+
+# (dataset, output activation function) combinations of vae_transformation_functions()
+TRANSFORMATIONS = [
+    ("gui_env_image_dataset_500k", "sigmoid"),
+    ("gui_env_image_dataset_500k", "tanh"),
+    ("gui_env_image_dataset_500k_normalize", "sigmoid")
+]
+
+
+def create_observation(height: int, width: int, structured: bool) -> np.ndarray:
+    rng = np.random.default_rng(0)
+
+    if not structured:
+        return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    # Mostly white with hard edged, flat colored widgets, similar to the screenshots of the GUI
+    observation = np.full((height, width, 3), 255, dtype=np.uint8)
+    for _ in range(20):
+        y, x = rng.integers(0, height - 10), rng.integers(0, width - 10)
+        h, w = rng.integers(5, height // 4), rng.integers(5, width // 4)
+        observation[y:y + h, x:x + w] = rng.integers(0, 256, 3, dtype=np.uint8)
+
+    return observation
+
+
+def get_tolerance(dataset: str, output_activation_function: str) -> float:
+    # One intensity step of the resized image, scaled like the output
+    step = 1 / 255
+
+    mean, std = get_dataset_mean_std(dataset)
+    if mean is not None:
+        return step / min(std) + 1e-5
+
+    if output_activation_function == "tanh":
+        return 2 * step + 1e-5
+
+    return step + 1e-5
+
+
+@pytest.mark.parametrize("dataset, output_activation_function", TRANSFORMATIONS)
+@pytest.mark.parametrize("height, width", [(448, 448), (300, 200)])
+@pytest.mark.parametrize("structured", [True, False])
+def test_preprocessor_matches_pil_pipeline(dataset, output_activation_function, height, width, structured):
+    observation = create_observation(height, width, structured)
+
+    transformation_functions = vae_transformation_functions(IMG_SIZE, dataset, output_activation_function)
+    preprocessor = ObservationPreprocessor(IMG_SIZE, dataset, output_activation_function, torch.device("cpu"))
+
+    expected = transformation_functions(Image.fromarray(observation)).unsqueeze(0)
+    actual = preprocessor(observation)
+
+    assert actual.size() == expected.size() == (1, 3, IMG_SIZE, IMG_SIZE)
+    assert (actual - expected).abs().max().item() <= get_tolerance(dataset, output_activation_function)
+
+
+@pytest.mark.parametrize("dataset, output_activation_function", TRANSFORMATIONS)
+def test_preprocessor_without_resize_is_identical(dataset, output_activation_function):
+    observation = create_observation(IMG_SIZE, IMG_SIZE, structured=False)
+
+    transformation_functions = vae_transformation_functions(IMG_SIZE, dataset, output_activation_function)
+    preprocessor = ObservationPreprocessor(IMG_SIZE, dataset, output_activation_function, torch.device("cpu"))
+
+    expected = transformation_functions(Image.fromarray(observation)).unsqueeze(0)
+
+    assert torch.allclose(preprocessor(observation), expected, atol=1e-6)
@@ -1,14 +1,12 @@
 import logging
 import os
-import sys
-from os import mkdir, unlink, listdir, getpid
-from time import sleep
+import time
+from os import mkdir, unlink, listdir
 
 # noinspection PyUnresolvedReferences
 import comet_ml  # Needs to be imported __before__ torch
 import click
 import torch
-import cma
 from tqdm import tqdm
 import numpy as np
 
@@ -17,155 +15,388 @@ from evaluation.controller.evaluate_controller import evaluate_controller
 from utils.logging.improved_summary_writer import ImprovedSummaryWriter
 from utils.misc import load_parameters
 from utils.misc import flatten_parameters
-from utils.rollout.dream_rollout import DreamRollout
+from utils.rollout.distributed import DistributedRolloutWorkerPool, get_authkey
+from utils.rollout.gui_env_worker_pool import GUIEnvWorkerPool
+from utils.rollout.noise_bank import get_noise_seed, get_evaluation_noise_seed
+from utils.rollout.worker_pool import RolloutWorkerPool
 from utils.setup_utils import (
     load_yaml_config, initialize_logger, pretty_json, save_yaml_config, set_seeds, get_device, get_depending_model_path
 )
 from utils.training_utils.training_utils import (
-    load_controller_parameters, construct_controller, generate_initial_observation_latent_vector
+    load_controller_parameters, construct_controller, generate_initial_observation_latent_vector,
+    load_shared_state_dict, create_cma_evolution_strategy, save_es_checkpoint, load_es_checkpoint
 )
 
+# Number of times the final controller is evaluated on the actual environment
+NUMBER_OF_FINAL_EVALUATIONS = 5
+
 
 ################################################################################
-#                           Thread routines                                    #
+#                           Evaluation                                         #
 ################################################################################
-def debug_worker_routine(p_queue, r_queue,
-                         rnn_dir, vae_dir, initial_obs_path, temperature, time_limit, device,
-                         stop_when_total_reward_exceeded):
+def submit_evaluation(worker_pool, pending_evaluations, generation, solutions, results, rollouts, noise_seeds=None,
+                      temperature=None):
+    """ Submit the evaluation of the current best controller.
+
+    The rollouts are submitted with low priority, i.e. they run in the background alongside the next generation,
+    using the workers that have no normal tasks left. Use collect_evaluations() to get the evaluation once it is
+    finished, which is usually after the next generation.
+
+    :args worker_pool: RolloutWorkerPool used to evaluate the rollouts
+    :args pending_evaluations: dict of the not yet finished evaluations, the new evaluation is added to it
+    :args generation: generation of the solutions
+    :args solutions: CMA set of solutions
+    :args results: corresponding results
+    :args rollouts: number of rollouts
+    :args noise_seeds: optional noise seed per rollout, see create_tasks()
+    :args temperature: optional temperature of the rollouts, see create_tasks()
     """
-    Same routine as worker_routine, but used for debugging
+    index_min = np.argmin(results)
+    submit_best_guess_evaluation(worker_pool, pending_evaluations, generation, solutions[index_min], rollouts,
+                                 noise_seeds, temperature)
 
-    Debugging is difficult with subprocesses running, therefore this function can be used without subprocesses.
+
+def submit_best_guess_evaluation(worker_pool, pending_evaluations, generation, best_guess, rollouts, noise_seeds=None,
+                                 temperature=None):
+    """ Submit the evaluation of best_guess, the best controller of the generation, see submit_evaluation().
+
+    Also used to submit the evaluations again that were pending when a checkpoint was saved.
     """
-    with torch.no_grad():
-        r_gen = DreamRollout(
-            rnn_dir=rnn_dir,
-            vae_dir=vae_dir,
-            initial_obs_path=initial_obs_path,
-            max_coordinate_size_for_task=448,
-            temperature=temperature,
-            device=device,
-            time_limit=time_limit,
-            load_best_rnn=True,
-            load_best_vae=True,
-            stop_when_total_reward_exceeded=stop_when_total_reward_exceeded,
-            render=False
-        )
+    pending_evaluations[generation] = (best_guess, [])
+    worker_pool.submit(create_tasks((generation, 0), best_guess, range(rollouts), noise_seeds, temperature),
+                       low_priority=True)
 
-        empty_counter = 0
-        while True:
-            if p_queue.empty():
-                sleep(.1)
-                empty_counter += 1
 
-                if empty_counter > 20:
-                    break
-            else:
-                s_id, params = p_queue.get()
-                r_queue.put((s_id, r_gen.rollout(params)))
-                empty_counter = 0
+def collect_evaluations(worker_pool, pending_evaluations, rollouts, block=False):
+    """ Collect the evaluations that finished in the background.
+
+    Evaluation is minus the cumulated reward averaged over rollout runs.
+
+    :args worker_pool: RolloutWorkerPool used to evaluate the rollouts
+    :args pending_evaluations: dict of the not yet finished evaluations, finished ones are removed from it
+    :args rollouts: number of rollouts per evaluation
+    :args block: wait until all pending evaluations are finished
+
+    :returns: list of (generation, best guess, minus averaged cumulated reward, std) ordered by generation
+    """
+    for (generation, _), r in worker_pool.get_low_priority_results(block=block):
+        pending_evaluations[generation][1].append(r)
+
+    finished_evaluations = []
+    for generation in sorted(pending_evaluations.keys()):
+        best_guess, restimates = pending_evaluations[generation]
+
+        if len(restimates) == rollouts:
+            finished_evaluations.append((generation, best_guess, np.mean(restimates), np.std(restimates)))
+            del pending_evaluations[generation]
+
+    return finished_evaluations
+
+
+def save_evaluation(summary_writer, controller, best_model_filename, save_model_checkpoints, current_best, generation,
+                    best_params, best, std_best):
+    """ Log a finished evaluation and save the controller as the new best.pt if it is better than the current best.
+
+    :returns: the (possibly updated) current best
+    """
+    logging.info(f"Evaluation of generation {generation}: {-best}")
 
+    if summary_writer is None:
+        return current_best
 
-def worker_routine(p_queue, r_queue, e_queue,
-                   tmp_dir, rnn_dir, vae_dir, initial_obs_path, temperature, time_limit, device,
-                   stop_when_total_reward_exceeded):
-    """ Thread routine.
+    summary_writer.add_scalar("best", -best, global_step=generation)
+    summary_writer.add_scalar("best_std", std_best, global_step=generation)
 
-    Threads interact with p_queue, the parameters queue, r_queue, the result
-    queue and e_queue the end queue. They pull parameters from p_queue, execute
-    the corresponding rollout, then place the result in r_queue.
+    if save_model_checkpoints:
+        if not os.path.exists(best_model_filename) or current_best is None or best < current_best:
+            current_best = best
+            logging.info(f"Saving new best with value {-current_best}+-{std_best}...")
+            load_parameters(best_params, controller)
 
-    Each parameter has its own unique id. Parameters are pulled as tuples
-    (s_id, params) and results are pushed as (s_id, result).  The same
-    parameter can appear multiple times in p_queue, displaying the same id
-    each time.
+            torch.save(
+                {"generation": generation,
+                 "reward": -current_best,
+                 "state_dict": controller.state_dict()},
+                best_model_filename)
 
-    As soon as e_queue is non empty, the thread terminate.
+    return current_best
 
-    When multiple gpus are involved, the assigned gpu is determined by the
-    process index p_index (gpu = p_index % n_gpus).
 
-    :args p_queue: queue containing couples (s_id, parameters) to evaluate
-    :args r_queue: where to place results (s_id, results)
-    :args e_queue: as soon as not empty, terminate
-    :args p_index: the process index
+def create_tasks(s_id, solution, sample_indices, noise_seeds=None, temperature=None):
+    """ Create the worker pool tasks to evaluate a solution for the given sample indices.
+
+    :args noise_seeds: optional noise seed per sample index, the k-th sample of every solution then uses noise_seeds[k]
+    :args temperature: optional temperature of the rollouts, otherwise the temperature of the worker pool is used
+
+    :returns: list of tasks
     """
-    if tmp_dir is not None:
-        # redirect streams
-        sys.stdout = open(os.path.join(tmp_dir, str(getpid()) + '.out'), 'a')
-        sys.stderr = open(os.path.join(tmp_dir, str(getpid()) + '.err'), 'a')
-
-    with torch.no_grad():
-        r_gen = DreamRollout(
-            rnn_dir=rnn_dir,
-            vae_dir=vae_dir,
-            initial_obs_path=initial_obs_path,
-            max_coordinate_size_for_task=448,
-            temperature=temperature,
-            device=device,
-            time_limit=time_limit,
-            load_best_rnn=True,
-            load_best_vae=True,
-            stop_when_total_reward_exceeded=stop_when_total_reward_exceeded,
-            render=False
-        )
+    if temperature is not None:
+        return [(s_id, solution, noise_seeds[k] if noise_seeds is not None else None, temperature)
+                for k in sample_indices]
 
-        while e_queue.empty():
-            if p_queue.empty():
-                sleep(.1)
-            else:
-                s_id, params = p_queue.get()
-                r_queue.put((s_id, r_gen.rollout(params)))
+    if noise_seeds is None:
+        return [(s_id, solution) for _ in sample_indices]
 
+    return [(s_id, solution, noise_seeds[k]) for k in sample_indices]
 
-################################################################################
-#                           Evaluation                                         #
-################################################################################
-def evaluate(p_queue, r_queue, rnn_dir, vae_dir, initial_obs_path, temperature, time_limit,
-             solutions, results, rollouts, device, stop_when_total_reward_exceeded, debug=False):
-    """ Give current controller evaluation.
 
-    Evaluation is minus the cumulated reward averaged over rollout runs.
+def evaluate_population(worker_pool, solutions, number_of_samples, progress_bar=None, noise_seeds=None):
+    """ Evaluate each solution with number_of_samples rollouts.
 
+    :args worker_pool: RolloutWorkerPool used to evaluate the rollouts
     :args solutions: CMA set of solutions
-    :args results: corresponding results
-    :args rollouts: number of rollouts
+    :args number_of_samples: number of rollouts per solution
+    :args progress_bar: optional tqdm progress bar, updated per finished rollout
+    :args noise_seeds: optional noise seed per sample index, see create_tasks()
 
-    :returns: minus averaged cumulated reward
+    :returns: averaged results per solution, number of used rollouts
     """
-    index_min = np.argmin(results)
-    best_guess = solutions[index_min]
-    restimates = []
+    r_list = [0] * len(solutions)  # Result list
+
+    # Push parameters to the workers
+    worker_pool.submit([
+        task for s_id, s in enumerate(solutions)
+        for task in create_tasks(s_id, s, range(number_of_samples), noise_seeds)
+    ])
+
+    # Take results from the workers, get_result() blocks until the next result is available
+    for _ in range(len(solutions) * number_of_samples):
+        r_s_id, r = worker_pool.get_result()
+        r_list[r_s_id] += r / number_of_samples
+
+        if progress_bar is not None:
+            progress_bar.update(1)
+
+    return r_list, len(solutions) * number_of_samples
+
+
+def evaluate_population_successive_halving(worker_pool, solutions, number_of_samples, initial_samples, keep_fraction,
+                                           budget_fraction, progress_bar=None, noise_seeds=None):
+    """ Evaluate the solutions with successive halving instead of a fixed number of rollouts per solution.
+
+    The solutions are evaluated in rounds. After each round only the best keep_fraction of the remaining solutions are
+    kept, until one solution is left. The total budget of budget_fraction * len(solutions) * number_of_samples
+    rollouts is split evenly across the rounds, and the budget of a round evenly across the solutions that are still
+    kept, such that the rollouts that clearly worse solutions do not get go to the better ones. In the first round each
+    solution gets at least initial_samples rollouts. No solution gets more than number_of_samples rollouts, budget that
+    cannot be used in a round moves to the later rounds, and what is left in the end is not used.
+
+    The result of a solution is the average over the rollouts it got. As averages over fewer rollouts are noisier, a
+    solution that was dropped in an earlier round could have a better average than a solution that was kept longer.
+    To not rank it above that solution, the result of a dropped solution is raised to the worst result of the solutions
+    that were kept in its round, if it is better than that.
+
+    :args worker_pool: RolloutWorkerPool used to evaluate the rollouts
+    :args solutions: CMA set of solutions
+    :args number_of_samples: maximum number of rollouts per solution
+    :args initial_samples: minimum number of rollouts per solution in the first round
+    :args keep_fraction: fraction of solutions that are kept after each round
+    :args budget_fraction: total number of rollouts, as a fraction of the rollouts of evaluate_population()
+    :args progress_bar: optional tqdm progress bar, updated per finished rollout
+    :args noise_seeds: optional noise seed per sample index, see create_tasks()
+
+    :returns: results per solution, number of used rollouts
+    """
+    population_size = len(solutions)
+    result_sums = np.zeros(population_size)
+    sample_counts = np.zeros(population_size, dtype=int)
+
+    # Number of solutions per round
+    round_sizes = [population_size]
+    while round_sizes[-1] > 1:
+        round_sizes.append(max(1, min(round_sizes[-1] - 1, int(np.ceil(round_sizes[-1] * keep_fraction)))))
+
+    remaining_budget = int(budget_fraction * population_size * number_of_samples)
+
+    candidates = np.arange(population_size)
+    # Per round the candidates that were dropped after it, ordered from the first to the last round
+    dropped_candidates = []
+
+    for round_index, round_size in enumerate(round_sizes):
+        round_budget = remaining_budget // (len(round_sizes) - round_index)
+        samples_per_candidate = round_budget // round_size
+
+        if round_index == 0:
+            samples_per_candidate = max(samples_per_candidate, initial_samples)
+
+        tasks = [
+            task for s_id in candidates
+            for task in create_tasks(
+                s_id, solutions[s_id],
+                range(sample_counts[s_id], min(sample_counts[s_id] + samples_per_candidate, number_of_samples)),
+                noise_seeds
+            )
+        ]
+        worker_pool.submit(tasks)
+        remaining_budget -= len(tasks)
+
+        for _ in range(len(tasks)):
+            r_s_id, r = worker_pool.get_result()
+            result_sums[r_s_id] += r
+            sample_counts[r_s_id] += 1
+
+            if progress_bar is not None:
+                progress_bar.update(1)
+
+        if round_index == len(round_sizes) - 1:
+            break
+
+        # Results are minus the reward, therefore the best candidates have the lowest averages
+        averages = result_sums[candidates] / sample_counts[candidates]
+        order = np.argsort(averages, kind="stable")
+        dropped_candidates.append(candidates[order[round_sizes[round_index + 1]:]])
+        candidates = candidates[order[:round_sizes[round_index + 1]]]
+
+    results = result_sums / sample_counts
+
+    # Going backwards from the last round, the worst result of the kept candidates is the bound for the dropped ones
+    kept_candidates = candidates
+    for candidates_of_round in reversed(dropped_candidates):
+        results[candidates_of_round] = np.maximum(results[candidates_of_round], results[kept_candidates].max())
+        kept_candidates = np.concatenate([kept_candidates, candidates_of_round])
+
+    return results.tolist(), int(sample_counts.sum())
+
+
+class SteadyStateEvaluation:
+    """ Steady-state (asynchronous) evaluation of the CMA-ES candidates.
+
+    Instead of evaluating a whole population before the next one is sampled, a fixed number of candidates is kept in
+    flight. As soon as a candidate has all its rollouts, it is replaced by a new candidate sampled from the current
+    distribution, such that the workers never wait for the slowest rollout of a generation. A generation consists of
+    the first population_size candidates that finish. Some of them were sampled before the last es.tell(), i.e. from a
+    slightly outdated distribution, which is the price for keeping the workers busy.
+
+    If base_noise_seed is given, the rollouts use noise seeds of the CMA-ES iteration in which the candidate was
+    sampled, see get_noise_seed().
+
+    get_state() returns the candidates in flight together with their partial results, such that a checkpoint can be
+    saved without waiting for them. Given to the constructor as candidates_state, the rollouts that were missing are
+    submitted again.
+    """
+
+    def __init__(self, es, worker_pool, population_size, number_of_samples, candidates_in_flight,
+                 base_noise_seed=None, candidates_state=None):
+        self.es = es
+        self.worker_pool = worker_pool
+        self.population_size = population_size
+        self.number_of_samples = number_of_samples
+        self.candidates_in_flight = candidates_in_flight
+        self.base_noise_seed = base_noise_seed
+
+        # candidate id -> [solution, averaged result so far, number of finished rollouts, noise seeds (or None),
+        # sample indices of the rollouts that are not finished]. The tasks of a rollout have (candidate id, sample
+        # index) as s_id, such that the missing rollouts are known when a checkpoint is saved
+        self.candidates = {}
+        self.next_candidate_id = 0
 
-    for s_id in range(rollouts):
-        p_queue.put((s_id, best_guess))
+        if candidates_state is not None:
+            for solution, result, finished_rollouts, noise_seeds, missing_samples in candidates_state:
+                self._submit_candidate(solution, result, finished_rollouts, noise_seeds, missing_samples)
 
-    if debug:
-        debug_worker_routine(p_queue, r_queue, rnn_dir, vae_dir, initial_obs_path, temperature, time_limit, device,
-                             stop_when_total_reward_exceeded)
+    def _submit_candidate(self, solution, result, finished_rollouts, noise_seeds, sample_indices):
+        candidate_id = self.next_candidate_id
+        self.next_candidate_id += 1
 
-    logging.info("Evaluating...")
-    for _ in tqdm(range(rollouts)):
-        while r_queue.empty():
-            sleep(.1)
-        restimates.append(r_queue.get()[1])
+        self.candidates[candidate_id] = [solution, result, finished_rollouts, noise_seeds, set(sample_indices)]
+        self.worker_pool.submit([
+            task for k in sample_indices for task in create_tasks((candidate_id, k), solution, [k], noise_seeds)
+        ])
 
-    return best_guess, np.mean(restimates), np.std(restimates)
+    def _add_candidate(self):
+        solution = self.es.ask(1)[0]
+
+        noise_seeds = None
+        if self.base_noise_seed is not None:
+            noise_seeds = [
+                get_noise_seed(self.base_noise_seed, self.es.countiter, k) for k in range(self.number_of_samples)
+            ]
+
+        self._submit_candidate(solution, 0, 0, noise_seeds, range(self.number_of_samples))
+
+    def _receive_result(self, progress_bar=None):
+        """ Wait for the next rollout result.
+
+        :returns: (solution, averaged result) if the candidate of the rollout is finished with it, otherwise None
+        """
+        (candidate_id, k), r = self.worker_pool.get_result()
+        candidate = self.candidates[candidate_id]
+        candidate[1] += r / self.number_of_samples
+        candidate[2] += 1
+        candidate[4].discard(k)
+
+        if progress_bar is not None:
+            progress_bar.update(1)
+
+        if candidate[2] < self.number_of_samples:
+            return None
+
+        del self.candidates[candidate_id]
+        return candidate[0], candidate[1]
+
+    def next_population(self, progress_bar=None):
+        """ Wait until population_size candidates are finished.
+
+        :args progress_bar: optional tqdm progress bar, updated per finished rollout
+
+        :returns: the finished solutions, their averaged results and the time spent in es.ask()
+        """
+        solutions = []
+        r_list = []
+
+        ask_start = time.perf_counter()
+        while len(self.candidates) < self.candidates_in_flight:
+            self._add_candidate()
+        ask_time = time.perf_counter() - ask_start
+
+        while len(solutions) < self.population_size:
+            finished_candidate = self._receive_result(progress_bar)
+
+            if finished_candidate is not None:
+                solutions.append(finished_candidate[0])
+                r_list.append(finished_candidate[1])
+
+                # Immediately replace the finished candidate, such that the workers do not run out of tasks
+                ask_start = time.perf_counter()
+                self._add_candidate()
+                ask_time += time.perf_counter() - ask_start
+
+        return solutions, r_list, ask_time
+
+    def get_state(self):
+        """ State of the candidates in flight, to save them in a checkpoint without waiting for their rollouts.
+
+        :returns: list of (solution, averaged result so far, number of finished rollouts, noise seeds, sample indices
+            of the missing rollouts)
+        """
+        return [
+            (solution, result, finished_rollouts, noise_seeds, sorted(missing_samples))
+            for solution, result, finished_rollouts, noise_seeds, missing_samples in self.candidates.values()
+        ]
 
 
 @click.command()
-@click.option("-c", "--config", "config_path", type=str, required=True,
+@click.option("-c", "--config", "config_path", type=str,
               help="Path to a YAML configuration containing training options")
 @click.option("-l", "--load", "load_path", type=str,
               help=("Path to a previous training, from which training shall continue (will create a new experiment "
                     "directory)"))
+@click.option("-r", "--resume", "resume_path", type=str,
+              help=("Path to an interrupted training, which is resumed exactly from its last CMA-ES checkpoint using "
+                    "its configuration (continues logging into that directory)"))
 @click.option("--disable-comet/--no-disable-comet", type=bool, default=False,
               help="Disable logging to Comet (automatically disabled when API key is not provided in home folder)")
-def main(config_path: str, load_path: str, disable_comet: bool):
+def main(config_path: str, load_path: str, resume_path: str, disable_comet: bool):
     logger, _ = initialize_logger()
     logger.setLevel(logging.INFO)
 
-    config = load_yaml_config(config_path)
+    if resume_path is not None:
+        assert config_path is None and load_path is None, ("When resuming a training, do not provide a config or load "
+                                                           "path")
+        config = load_yaml_config(os.path.join(resume_path, "config.yaml"))
+    else:
+        assert config_path is not None, "Provide a config, or resume a training"
+        config = load_yaml_config(config_path)
 
     population_size = config["experiment_parameters"]["population_size"]
     sigma = config["experiment_parameters"]["sigma"]
@@ -175,10 +406,27 @@ def main(config_path: str, load_path: str, disable_comet: bool):
     stop_when_total_reward_exceeded = config["experiment_parameters"]["stop_when_total_reward_exceeded"]
     time_limit = config["experiment_parameters"]["time_limit"]
     max_generations = config["experiment_parameters"]["max_generations"]
+    # full, diagonal (sep-CMA), vd or vkd (low rank), see create_cma_evolution_strategy()
+    cma_mode = config["experiment_parameters"]["cma_mode"]
+    # fixed (number_of_samples rollouts per candidate) or successive_halving, see
+    # evaluate_population_successive_halving()
+    evaluation_mode = config["experiment_parameters"]["evaluation_mode"]
+    # synchronous (one generation after another) or asynchronous, see SteadyStateEvaluation
+    es_mode = config["experiment_parameters"]["es_mode"]
+    # Common random numbers: The k-th rollout of each candidate in a generation uses the same pre-generated noise
+    use_noise_bank = config["experiment_parameters"]["use_noise_bank"]
+    # Evaluate the best candidates of all generations on the same noise of the noise bank, requires use_noise_bank
+    fixed_evaluation_noise = config["experiment_parameters"]["fixed_evaluation_noise"]
+    racing_initial_samples = config["experiment_parameters"]["racing_initial_samples"]
+    racing_keep_fraction = config["experiment_parameters"]["racing_keep_fraction"]
+    # Rollouts that successive halving may use, as a fraction of population_size * number_of_samples
+    racing_budget_fraction = config["experiment_parameters"]["racing_budget_fraction"]
 
     evaluate_final_on_actual_environment = config["evaluation_parameters"]["evaluate_final_on_actual_environment"]
     evaluation_stop_mode = config["evaluation_parameters"]["evaluation_stop_mode"]
     evaluation_amount = config["evaluation_parameters"]["evaluation_amount"]
+    latent_cache_size = config["evaluation_parameters"]["latent_cache_size"]
+    pipelined_rollouts = config["evaluation_parameters"]["pipelined_rollouts"]
 
     rnn_dir = config["rnn_parameters"]["rnn_dir"]
 
@@ -189,14 +437,52 @@ def main(config_path: str, load_path: str, disable_comet: bool):
 
     number_of_workers = config["trainer_parameters"]["num_workers"]
     gpu_id = config["trainer_parameters"]["gpu"]
+    # Number of rollouts that a worker evaluates at once, 1 evaluates each rollout on its own
+    rollout_batch_size = config["trainer_parameters"]["rollout_batch_size"]
+    # Number of tasks sent to a worker at once and how many of these chunks a worker may have assigned at the same time
+    tasks_per_chunk = config["trainer_parameters"]["tasks_per_chunk"]
+    max_chunks_in_flight = config["trainer_parameters"]["max_chunks_in_flight"]
+    # Calculate a step of the simulated environment with a single compiled function, see FusedDreamStep
+    use_fused_dream_step = config["trainer_parameters"]["use_fused_dream_step"]
+    # Precision of the M model in the workers: float32, int8 (dynamically quantized, CPU only) or bfloat16
+    inference_precision = config["trainer_parameters"]["inference_precision"]
+    # Number of rollout results that are cached, to not evaluate the same candidate with the same noise seed again.
+    # Only rollouts with a noise seed are cached, i.e. this requires use_noise_bank. 0 disables the cache
+    fitness_cache_size = config["trainer_parameters"]["fitness_cache_size"]
+    # Send the candidates to the workers through shared memory instead of pickling them for every task
+    use_shared_memory_dispatch = config["trainer_parameters"]["use_shared_memory_dispatch"]
+    # Let workers on other machines connect over TCP, see rollout_worker.py. num_workers local workers are started too
+    distributed = config["trainer_parameters"]["distributed"]
+    distributed_host = config["trainer_parameters"]["distributed_host"]
+    distributed_port = config["trainer_parameters"]["distributed_port"]
+    # Seconds after which a distributed worker without heartbeats is considered lost. Workers only send heartbeats while
+    # they finish rollouts, therefore this must be larger than the time of the slowest rollout batch
+    distributed_heartbeat_timeout = config["trainer_parameters"]["distributed_heartbeat_timeout"]
 
     debug = config["logging_parameters"]["debug"]
     save_dir = config["logging_parameters"]["save_dir"]
     scalar_log_frequency = config["logging_parameters"]["scalar_log_frequency"]
     save_model_checkpoints = config["logging_parameters"]["save_model_checkpoints"]
     display_progress_bars = config["logging_parameters"]["display_progress_bars"]
+    # Save the complete CMA-ES state every es_checkpoint_frequency generations to be able to resume, 0 disables it
+    es_checkpoint_frequency = config["logging_parameters"]["es_checkpoint_frequency"]
+    # Measure where the time of the rollouts goes (logged as profiling/...), disable for production runs
+    enable_profiling = config["logging_parameters"]["enable_profiling"]
 
     assert max_generations > 0, f"Maximum number of generations must be greater than 0"
+    assert rollout_batch_size > 0, f"Rollout batch size must be greater than 0"
+    assert tasks_per_chunk >= rollout_batch_size, f"Tasks per chunk must be at least the rollout batch size"
+    assert evaluation_mode in ["fixed", "successive_halving"], f"Evaluation mode '{evaluation_mode}' unknown"
+    assert es_mode in ["synchronous", "asynchronous"], f"ES mode '{es_mode}' unknown"
+    assert es_mode == "synchronous" or evaluation_mode == "fixed", ("The asynchronous ES mode requires evaluation "
+                                                                   "mode fixed")
+    assert racing_initial_samples > 0, f"Number of initial racing samples must be greater than 0"
+    assert 0 < racing_keep_fraction < 1, f"Racing keep fraction must be in (0, 1)"
+    assert 0 < racing_budget_fraction <= 1, f"Racing budget fraction must be in (0, 1]"
+    assert use_noise_bank or not fixed_evaluation_noise, f"Fixed evaluation noise requires use_noise_bank"
+
+    if fitness_cache_size > 0 and not use_noise_bank:
+        logging.warning("The fitness cache only caches rollouts with a noise seed, enable use_noise_bank to use it")
 
     manual_seed = config["experiment_parameters"]["manual_seed"]
     set_seeds(manual_seed)
@@ -204,18 +490,20 @@ def main(config_path: str, load_path: str, disable_comet: bool):
     device = get_device(gpu_id)
 
     if not debug:
-        assert number_of_workers > 0, f"Number of workers must be greater than 0"
+        assert number_of_workers > 0 or distributed, f"Number of workers must be greater than 0"
 
         summary_writer = ImprovedSummaryWriter(
             log_dir=save_dir,
+            resume_log_dir=resume_path,
             comet_config={
                 "project_name": "world-models/controller",
                 "disabled": disable_comet
             }
         )
 
-        # Log hyperparameters to the tensorboard
-        summary_writer.add_text("Hyperparameters", pretty_json(config), global_step=0)
+        # Log hyperparameters to the tensorboard, when resuming they were already logged
+        if resume_path is None:
+            summary_writer.add_text("Hyperparameters", pretty_json(config), global_step=0)
 
         # Unfortunately tensorboardX does not expose this functionality and name cannot be set in constructor
         if not disable_comet:
@@ -235,11 +523,13 @@ def main(config_path: str, load_path: str, disable_comet: bool):
             for fname in listdir(tmp_dir):
                 unlink(os.path.join(tmp_dir, fname))
 
-        logging.info(f"Started Controller training version_{summary_writer.version_number} for {max_generations} "
-                     "generations")
+        if resume_path is None:
+            logging.info(f"Started Controller training version_{summary_writer.version_number} for "
+                         f"{max_generations} generations")
     else:
         summary_writer = None
         log_dir = None
+        best_model_filename = None
         tmp_dir = None
 
     # Set up initial observation
@@ -247,28 +537,64 @@ def main(config_path: str, load_path: str, disable_comet: bool):
     initial_obs_path = generate_initial_observation_latent_vector(vae_dir, device, load_best=True)
 
     ################################################################################
-    #                Define queues and start workers                               #
+    #                           Start workers                                      #
     ################################################################################
-    # To share CUDA tensors between subprocesses we have to use "spawn" as the starting method for the subprocesses
-    # Compare also with https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
-    # Also use the get_context method, as globally defining the start method messes with comet_ml and the stdout
-    # log is no longer shown for some reason
-    ctx = torch.multiprocessing.get_context("spawn")
-    p_queue = ctx.Queue()
-    r_queue = ctx.Queue()
-    e_queue = ctx.Queue()
-
-    if not debug:
-        processes = []
-        for p_index in range(number_of_workers):
-            p = ctx.Process(
-                target=worker_routine,
-                args=(p_queue, r_queue, e_queue, tmp_dir, rnn_dir, vae_dir, initial_obs_path, temperature, time_limit,
-                      device, stop_when_total_reward_exceeded)
-            )
-
-            processes.append(p)
-            p.start()
+    # Load the M model only once, into shared memory. The workers then use these weights instead of loading the
+    # checkpoint themselves, which makes starting them faster and avoids a copy of the weights per worker
+    rnn_state_dict = load_shared_state_dict(rnn_dir, device, load_best=True)
+
+    number_of_parameters = len(flatten_parameters(construct_controller(rnn_dir, vae_dir).parameters()))
+
+    rollout_arguments = {
+        "rnn_dir": rnn_dir,
+        "vae_dir": vae_dir,
+        "initial_obs_path": initial_obs_path,
+        "temperature": temperature,
+        "time_limit": time_limit,
+        "device": device,
+        "stop_when_total_reward_exceeded": stop_when_total_reward_exceeded,
+        "rollout_batch_size": rollout_batch_size,
+        "rnn_state_dict": rnn_state_dict,
+        "use_fused_step": use_fused_dream_step,
+        "use_noise_bank": use_noise_bank,
+        "inference_precision": inference_precision
+    }
+
+    if distributed and not debug:
+        if use_shared_memory_dispatch:
+            logging.warning("use_shared_memory_dispatch is ignored for distributed training, the parameters are always "
+                            "sent with the chunks")
+
+        worker_pool = DistributedRolloutWorkerPool(
+            number_of_local_workers=number_of_workers,
+            rollout_arguments=rollout_arguments,
+            host=distributed_host,
+            port=distributed_port,
+            authkey=get_authkey(),
+            tmp_dir=tmp_dir,
+            tasks_per_chunk=tasks_per_chunk,
+            max_chunks_in_flight=max_chunks_in_flight,
+            enable_profiling=enable_profiling,
+            fitness_cache_size=fitness_cache_size,
+            heartbeat_timeout=distributed_heartbeat_timeout
+        )
+    else:
+        # In debug mode no subprocesses are started, the rollouts are then evaluated in this process
+        worker_pool = RolloutWorkerPool(
+            number_of_workers=0 if debug else number_of_workers,
+            rollout_arguments=rollout_arguments,
+            tmp_dir=tmp_dir,
+            tasks_per_chunk=tasks_per_chunk,
+            max_chunks_in_flight=max_chunks_in_flight,
+            # Room for the candidates of two generations (or the candidates in flight of the asynchronous mode) and
+            # the evaluations running in the background. If this is not enough the remaining tasks are pickled as
+            # before
+            shared_memory_rows=2 * population_size + 2 if use_shared_memory_dispatch else 0,
+            number_of_parameters=number_of_parameters,
+            enable_profiling=enable_profiling,
+            fitness_cache_size=fitness_cache_size
+        )
+    worker_pool.start()
 
     ################################################################################
     #                           Launch CMA                                         #
@@ -289,14 +615,94 @@ def main(config_path: str, load_path: str, disable_comet: bool):
 
         logging.info(f"Loading previous training from {load_path}. Starting training with newly given configuration")
 
-    parameters = controller.parameters()
-    es = cma.CMAEvolutionStrategy(
-        flatten_parameters(parameters),
-        sigma,
-        {"popsize": population_size, "seed": manual_seed}
-    )
+    if resume_path is not None:
+        # Also restores the random number generators, therefore this has to happen after everything else is set up
+        es, generation, current_best, additional_es_state = load_es_checkpoint(resume_path)
+        logging.info(f"Resuming Controller training from {resume_path} at generation {generation}")
+
+        if worker_pool.fitness_cache is not None and "fitness_cache" in additional_es_state:
+            worker_pool.fitness_cache.set_state(additional_es_state["fitness_cache"])
+    else:
+        parameters = controller.parameters()
+        es = create_cma_evolution_strategy(
+            flatten_parameters(parameters),
+            sigma,
+            population_size=population_size,
+            seed=manual_seed,
+            cma_mode=cma_mode
+        )
+
+        generation = 0
+        additional_es_state = {}
+
+    # Evaluations of the best controllers run in the background, see submit_evaluation()
+    pending_evaluations = {}
+
+    def save_finished_evaluations(block=False):
+        """ Log and save the evaluations that finished, see collect_evaluations().
+
+        :returns: True if one of them achieved the target return
+        """
+        nonlocal current_best
+        target_return_achieved = False
 
-    generation = 0
+        for evaluated_generation, best_params, best, std_best in collect_evaluations(
+                worker_pool, pending_evaluations, number_of_evaluations, block=block):
+            current_best = save_evaluation(summary_writer, controller, best_model_filename, save_model_checkpoints,
+                                           current_best, evaluated_generation, best_params, best, std_best)
+
+            if target_return is not None and -best > target_return:
+                logging.info(f"Terminating controller training with achieved value {-best}")
+                target_return_achieved = True
+
+        return target_return_achieved
+
+    # Evaluating the best candidates of all generations on the same noise makes their rewards comparable, and lets the
+    # fitness cache skip repeated evaluations of the same candidate. Otherwise, each evaluation draws new noise
+    evaluation_noise_seeds = None
+    if fixed_evaluation_noise:
+        evaluation_noise_seeds = [get_evaluation_noise_seed(manual_seed, k) for k in range(number_of_evaluations)]
+
+    # Evaluations that were still running when the checkpoint was saved are started again
+    for evaluated_generation, best_guess in additional_es_state.get("pending_evaluations", {}).items():
+        submit_best_guess_evaluation(worker_pool, pending_evaluations, evaluated_generation, best_guess,
+                                     rollouts=number_of_evaluations, noise_seeds=evaluation_noise_seeds)
+
+    if es_mode == "asynchronous":
+        # Keep just enough candidates in flight to fill all workers, more would only use more outdated candidates and
+        # delay the background evaluations, which only run when no other tasks are pending. For distributed training
+        # the remote workers are not known in advance, therefore num_workers is used as the estimate
+        worker_capacity = max(number_of_workers, 1) * max_chunks_in_flight * tasks_per_chunk if not debug else 1
+        steady_state_evaluation = SteadyStateEvaluation(
+            es, worker_pool, population_size, number_of_samples,
+            candidates_in_flight=max(1, int(np.ceil(worker_capacity / number_of_samples))),
+            base_noise_seed=manual_seed if use_noise_bank else None,
+            candidates_state=additional_es_state.get("candidates_in_flight")
+        )
+
+    def save_checkpoint():
+        """ Save the CMA-ES checkpoint without waiting for the rollouts in flight. Instead, the pending evaluations and
+        the candidates in flight of the asynchronous mode are saved, and submitted again when resuming.
+        """
+        additional_state = {
+            # The partial results of the evaluations are not saved, an evaluation is started again as a whole
+            "pending_evaluations": {
+                evaluated_generation: best_guess
+                for evaluated_generation, (best_guess, _) in pending_evaluations.items()
+            }
+        }
+
+        if es_mode == "asynchronous":
+            additional_state["candidates_in_flight"] = steady_state_evaluation.get_state()
+
+        if worker_pool.fitness_cache is not None:
+            additional_state["fitness_cache"] = worker_pool.fitness_cache.get_state()
+
+        save_es_checkpoint(log_dir, es, generation, current_best, additional_state)
+
+    # Used to calculate the generations per hour
+    generations_since_last_log = 0
+    last_log_time = time.perf_counter()
 
     while not es.stop() and generation < max_generations:
 
@@ -304,106 +710,134 @@ def main(config_path: str, load_path: str, disable_comet: bool):
             logging.info("Training already better than target return, stopping.")
             break
 
-        r_list = [0] * population_size  # Result list
-        solutions = es.ask()
-
-        # Push parameters to queue
-        for s_id, s in enumerate(solutions):
-            for _ in range(number_of_samples):
-                p_queue.put((s_id, s))
-
-        if debug:
-            debug_worker_routine(p_queue, r_queue, rnn_dir, vae_dir, initial_obs_path, temperature, time_limit, device,
-                                 stop_when_total_reward_exceeded)
-
         if display_progress_bars:
+            # With successive halving fewer rollouts are used, the total is then the upper bound
             progress_bar = tqdm(total=population_size * number_of_samples, desc=f"Generation {generation} - Rewards")
+        else:
+            progress_bar = None
 
-        # Take results from result queue
-        for _ in range(population_size * number_of_samples):
-            while r_queue.empty():
-                sleep(.1)
-            r_s_id, r = r_queue.get()
-            r_list[r_s_id] += r / number_of_samples
+        evaluation_start = time.perf_counter()
 
-            if display_progress_bars:
-                progress_bar.update(1)
+        if es_mode == "asynchronous":
+            # noinspection PyUnboundLocalVariable
+            solutions, r_list, ask_time = steady_state_evaluation.next_population(progress_bar)
+            used_rollouts = population_size * number_of_samples
+        else:
+            ask_start = time.perf_counter()
+            solutions = es.ask()
+            ask_time = time.perf_counter() - ask_start
+
+            noise_seeds = None
+            if use_noise_bank:
+                noise_seeds = [get_noise_seed(manual_seed, generation, k) for k in range(number_of_samples)]
+
+            if evaluation_mode == "successive_halving":
+                r_list, used_rollouts = evaluate_population_successive_halving(
+                    worker_pool, solutions, number_of_samples, racing_initial_samples, racing_keep_fraction,
+                    racing_budget_fraction, progress_bar, noise_seeds
+                )
+            else:
+                r_list, used_rollouts = evaluate_population(worker_pool, solutions, number_of_samples, progress_bar,
+                                                            noise_seeds)
 
         if display_progress_bars:
             progress_bar.close()
 
+        evaluation_time = time.perf_counter() - evaluation_start
+
+        tell_start = time.perf_counter()
         es.tell(solutions, r_list)
+        tell_time = time.perf_counter() - tell_start
+
         es.disp()
+        generations_since_last_log += 1
 
         # evaluation and saving
         if generation % scalar_log_frequency == 0 or generation == max_generations - 1:
-            best_params, best, std_best = evaluate(p_queue, r_queue, rnn_dir, vae_dir, initial_obs_path, temperature,
-                                                   time_limit, solutions, r_list, rollouts=number_of_evaluations,
-                                                   device=device,
-                                                   stop_when_total_reward_exceeded=stop_when_total_reward_exceeded,
-                                                   debug=debug)
-            logging.info(f"Current evaluation: {-best}")
+            submit_evaluation(worker_pool, pending_evaluations, generation, solutions, r_list,
+                              rollouts=number_of_evaluations, noise_seeds=evaluation_noise_seeds)
 
             if not debug:
+                # queue_wait_time is the time the workers were idle
+                for metric_name, metric_value in worker_pool.get_metrics(generations_since_last_log).items():
+                    summary_writer.add_scalar(metric_name, metric_value, global_step=generation)
+
+                summary_writer.add_scalar(
+                    "generations_per_hour",
+                    3600 * generations_since_last_log / (time.perf_counter() - last_log_time),
+                    global_step=generation
+                )
+
+                # Time the optimizer itself needs per generation, grows with the number of parameters for cma_mode full
+                summary_writer.add_scalar("es_ask_time", ask_time, global_step=generation)
+                summary_writer.add_scalar("es_tell_time", tell_time, global_step=generation)
+
+                if enable_profiling:
+                    # Wall clock time of asking for and evaluating the population, includes es_ask_time
+                    summary_writer.add_scalar("profiling/population_evaluation", evaluation_time,
+                                              global_step=generation)
+
+                summary_writer.add_scalar("used_rollouts", used_rollouts, global_step=generation)
+                summary_writer.add_scalar("saved_rollouts", population_size * number_of_samples - used_rollouts,
+                                          global_step=generation)
+
                 # Rewards are multiplied with (-1), therefore taking the max and then multiplying with (-1) gives the
                 # correct minimum reward for example
                 summary_writer.add_scalar("min", -np.max(r_list), global_step=generation)
                 summary_writer.add_scalar("max", -np.min(r_list), global_step=generation)
                 summary_writer.add_scalar("mean", -np.mean(r_list), global_step=generation)
-                summary_writer.add_scalar("best", -best, global_step=generation)
-                summary_writer.add_scalar("best_std", std_best, global_step=generation)
-
-                if save_model_checkpoints:
-                    # noinspection PyUnboundLocalVariable
-                    if not os.path.exists(best_model_filename) or current_best is None or best < current_best:
-                        current_best = best
-                        logging.info(f"Saving new best with value {-current_best}+-{std_best}...")
-                        load_parameters(best_params, controller)
-
-                        # noinspection PyUnboundLocalVariable
-                        torch.save(
-                            {"generation": generation,
-                             "reward": -current_best,
-                             "state_dict": controller.state_dict()},
-                            best_model_filename)
 
-            if target_return is not None and -best > target_return:
-                logging.info(f"Terminating controller training with achieved value {-best}")
-                break
+            generations_since_last_log = 0
+            last_log_time = time.perf_counter()
+
+        # Evaluations of previous generations that finished in the meantime. As the evaluation of a generation runs
+        # alongside the next one, the training stops one generation after the one that achieved the target return
+        target_return_achieved = save_finished_evaluations()
 
         generation += 1
 
-    es.result_pretty()
-    e_queue.put("EOP")
+        if not debug and es_checkpoint_frequency > 0 and generation % es_checkpoint_frequency == 0:
+            save_checkpoint()
 
-    if not debug:
-        # Queue cleanup
-        while not p_queue.empty():
-            p_queue.get()
+        if target_return_achieved:
+            break
 
-        while not r_queue.empty():
-            r_queue.get()
+    # Wait for the evaluations that are still running
+    save_finished_evaluations(block=True)
 
-        p_queue.close()
-        r_queue.close()
-        p_queue.join_thread()
-        r_queue.join_thread()
+    if not debug and es_checkpoint_frequency > 0:
+        save_checkpoint()
 
-        # noinspection PyUnboundLocalVariable
-        for p in processes:
-            # Give 1 second of time to gracefully shutdown, otherwise just kill the process as it is no longer in use
-            # anyway
-            p.join(timeout=1)
-            p.kill()
+    es.result_pretty()
+    worker_pool.shutdown()
 
+    if not debug:
         if evaluate_final_on_actual_environment:
-            evaluated_rewards = evaluate_controller(
-                controller_directory=log_dir,
+            # The environment workers are started once and evaluate all final rollouts, at most num_workers at a time
+            gui_env_worker_pool = GUIEnvWorkerPool(
+                rnn_dir=rnn_dir,
+                vae_dir=vae_dir,
                 gpu=gpu_id,
                 stop_mode=evaluation_stop_mode,
                 amount=evaluation_amount,
-                number_of_evaluations=5
+                number_of_workers=min(max(number_of_workers, 1), NUMBER_OF_FINAL_EVALUATIONS),
+                latent_cache_size=latent_cache_size,
+                pipelined=pipelined_rollouts,
+                enable_profiling=enable_profiling
             )
+            gui_env_worker_pool.start()
+
+            try:
+                evaluated_rewards = evaluate_controller(
+                    controller_directory=log_dir,
+                    gpu=gpu_id,
+                    stop_mode=evaluation_stop_mode,
+                    amount=evaluation_amount,
+                    number_of_evaluations=NUMBER_OF_FINAL_EVALUATIONS,
+                    worker_pool=gui_env_worker_pool
+                )
+            finally:
+                gui_env_worker_pool.shutdown()
 
             summary_writer.add_scalar("eval_min", np.min(evaluated_rewards), global_step=0)
             summary_writer.add_scalar("eval_max", np.max(evaluated_rewards), global_step=0)
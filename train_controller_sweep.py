@@ -0,0 +1,419 @@
+import itertools
+import logging
+import os
+import time
+from copy import deepcopy
+from os import mkdir, unlink, listdir
+
+# noinspection PyUnresolvedReferences
+import comet_ml  # Needs to be imported __before__ torch
+import click
+import numpy as np
+from tqdm import tqdm
+
+from evaluation.controller.evaluate_controller import evaluate_controller
+from train_controller import (
+    create_tasks, submit_evaluation, collect_evaluations, save_evaluation, NUMBER_OF_FINAL_EVALUATIONS
+)
+from utils.logging.improved_summary_writer import ImprovedSummaryWriter
+from utils.misc import flatten_parameters
+from utils.rollout.gui_env_worker_pool import GUIEnvWorkerPool
+from utils.rollout.noise_bank import get_noise_seed, get_evaluation_noise_seed
+from utils.rollout.worker_pool import RolloutWorkerPool
+from utils.setup_utils import (
+    load_yaml_config, initialize_logger, pretty_json, save_yaml_config, set_seeds, get_device, get_depending_model_path
+)
+from utils.training_utils.training_utils import (
+    construct_controller, generate_initial_observation_latent_vector, load_shared_state_dict,
+    create_cma_evolution_strategy
+)
+
+# Parameters that can be swept and the section of the controller config they belong to. All other parameters are shared
+# by the instances of a sweep, as they share the worker pool
+SWEEP_PARAMETERS = {
+    "manual_seed": "experiment_parameters",
+    "sigma": "experiment_parameters",
+    "temperature": "rnn_parameters"
+}
+
+
+class SweepInstance:
+    """
+    One CMA-ES training of a sweep, with its own configuration, log directory and best controller.
+    """
+
+    def __init__(self, index, config, summary_writer, controller, cma_mode):
+        self.index = index
+        self.config = config
+        self.summary_writer = summary_writer
+
+        self.manual_seed = config["experiment_parameters"]["manual_seed"]
+        self.temperature = config["rnn_parameters"]["temperature"]
+
+        self.log_dir = summary_writer.get_logdir() if summary_writer is not None else None
+        self.best_model_filename = os.path.join(self.log_dir, "best.pt") if summary_writer is not None else None
+
+        self.es = create_cma_evolution_strategy(
+            flatten_parameters(controller.parameters()),
+            config["experiment_parameters"]["sigma"],
+            population_size=config["experiment_parameters"]["population_size"],
+            seed=self.manual_seed,
+            cma_mode=cma_mode
+        )
+
+        self.current_best = None
+        self.finished = False
+
+    def get_noise_seeds(self, generation, number_of_samples, use_noise_bank):
+        if not use_noise_bank:
+            return None
+
+        return [get_noise_seed(self.manual_seed, generation, k) for k in range(number_of_samples)]
+
+    def get_evaluation_noise_seeds(self, number_of_evaluations, fixed_evaluation_noise):
+        if not fixed_evaluation_noise:
+            return None
+
+        return [get_evaluation_noise_seed(self.manual_seed, k) for k in range(number_of_evaluations)]
+
+
+def create_sweep_configs(config):
+    """ Create one config per combination of the values in config["sweep_parameters"].
+
+    :returns: list of configs, without the sweep_parameters
+    """
+    config = deepcopy(config)
+    sweep_parameters = config.pop("sweep_parameters")
+
+    for parameter in sweep_parameters.keys():
+        assert parameter in SWEEP_PARAMETERS, (f"Parameter '{parameter}' cannot be swept, only "
+                                               f"{list(SWEEP_PARAMETERS.keys())} are supported")
+
+    sweep_configs = []
+    for values in itertools.product(*sweep_parameters.values()):
+        sweep_config = deepcopy(config)
+
+        for parameter, value in zip(sweep_parameters.keys(), values):
+            sweep_config[SWEEP_PARAMETERS[parameter]][parameter] = value
+
+        sweep_configs.append(sweep_config)
+
+    return sweep_configs
+
+
+def evaluate_instances(worker_pool, instances, population_solutions, number_of_samples, generation, use_noise_bank,
+                       progress_bar=None):
+    """ Evaluate the populations of all instances with number_of_samples rollouts per solution.
+
+    The tasks of the instances are interleaved, such that the workers evaluate all instances at the same rate instead
+    of one instance after another.
+
+    :returns: averaged results per solution for each instance
+    """
+    instance_tasks = [
+        [
+            task for s_id, s in enumerate(solutions) for task in create_tasks(
+                (instance.index, s_id), s, range(number_of_samples),
+                instance.get_noise_seeds(generation, number_of_samples, use_noise_bank), instance.temperature
+            )
+        ]
+        for instance, solutions in zip(instances, population_solutions)
+    ]
+
+    # Round-robin over the instances
+    worker_pool.submit([
+        task for tasks in itertools.zip_longest(*instance_tasks) for task in tasks if task is not None
+    ])
+
+    r_lists = {instance.index: [0] * len(solutions) for instance, solutions in zip(instances, population_solutions)}
+
+    for _ in range(sum(len(tasks) for tasks in instance_tasks)):
+        (instance_index, r_s_id), r = worker_pool.get_result()
+        r_lists[instance_index][r_s_id] += r / number_of_samples
+
+        if progress_bar is not None:
+            progress_bar.update(1)
+
+    return [r_lists[instance.index] for instance in instances]
+
+
+@click.command()
+@click.option("-c", "--config", "config_path", type=str, required=True,
+              help="Path to a YAML configuration containing training options and sweep_parameters")
+@click.option("--disable-comet/--no-disable-comet", type=bool, default=False,
+              help="Disable logging to Comet (automatically disabled when API key is not provided in home folder)")
+def main(config_path: str, disable_comet: bool):
+    """
+    Train multiple controllers at once, which share one pool of dream rollout workers and therefore also one loaded
+    M model.
+
+    The config is a controller config with an additional sweep_parameters section, which lists the values of the swept
+    parameters (manual_seed, sigma and temperature). One CMA-ES instance is trained for each combination, each with its
+    own log directory. All instances advance one generation at a time, and their rollouts are interleaved, such that
+    every instance gets the same share of the workers. Instances that are finished leave the workers to the others.
+    """
+    logger, _ = initialize_logger()
+    logger.setLevel(logging.INFO)
+
+    base_config = load_yaml_config(config_path)
+    sweep_configs = create_sweep_configs(base_config)
+
+    # Parameters that are shared by all instances are taken from the first config
+    config = sweep_configs[0]
+
+    population_size = config["experiment_parameters"]["population_size"]
+    number_of_samples = config["experiment_parameters"]["number_of_samples"]
+    number_of_evaluations = config["experiment_parameters"]["number_of_evaluations"]
+    target_return = config["experiment_parameters"]["target_return"]
+    stop_when_total_reward_exceeded = config["experiment_parameters"]["stop_when_total_reward_exceeded"]
+    time_limit = config["experiment_parameters"]["time_limit"]
+    max_generations = config["experiment_parameters"]["max_generations"]
+    cma_mode = config["experiment_parameters"]["cma_mode"]
+    evaluation_mode = config["experiment_parameters"]["evaluation_mode"]
+    es_mode = config["experiment_parameters"]["es_mode"]
+    use_noise_bank = config["experiment_parameters"]["use_noise_bank"]
+    fixed_evaluation_noise = config["experiment_parameters"]["fixed_evaluation_noise"]
+
+    evaluate_final_on_actual_environment = config["evaluation_parameters"]["evaluate_final_on_actual_environment"]
+    evaluation_stop_mode = config["evaluation_parameters"]["evaluation_stop_mode"]
+    evaluation_amount = config["evaluation_parameters"]["evaluation_amount"]
+    latent_cache_size = config["evaluation_parameters"]["latent_cache_size"]
+    pipelined_rollouts = config["evaluation_parameters"]["pipelined_rollouts"]
+
+    rnn_dir = config["rnn_parameters"]["rnn_dir"]
+    vae_dir = get_depending_model_path(model_type="rnn", model_dir=rnn_dir)
+
+    number_of_workers = config["trainer_parameters"]["num_workers"]
+    gpu_id = config["trainer_parameters"]["gpu"]
+    rollout_batch_size = config["trainer_parameters"]["rollout_batch_size"]
+    tasks_per_chunk = config["trainer_parameters"]["tasks_per_chunk"]
+    max_chunks_in_flight = config["trainer_parameters"]["max_chunks_in_flight"]
+    use_fused_dream_step = config["trainer_parameters"]["use_fused_dream_step"]
+    inference_precision = config["trainer_parameters"]["inference_precision"]
+    fitness_cache_size = config["trainer_parameters"]["fitness_cache_size"]
+    use_shared_memory_dispatch = config["trainer_parameters"]["use_shared_memory_dispatch"]
+
+    debug = config["logging_parameters"]["debug"]
+    save_dir = config["logging_parameters"]["save_dir"]
+    scalar_log_frequency = config["logging_parameters"]["scalar_log_frequency"]
+    save_model_checkpoints = config["logging_parameters"]["save_model_checkpoints"]
+    display_progress_bars = config["logging_parameters"]["display_progress_bars"]
+    enable_profiling = config["logging_parameters"]["enable_profiling"]
+
+    assert max_generations > 0, f"Maximum number of generations must be greater than 0"
+    assert rollout_batch_size > 0, f"Rollout batch size must be greater than 0"
+    assert tasks_per_chunk >= rollout_batch_size, f"Tasks per chunk must be at least the rollout batch size"
+    assert evaluation_mode == "fixed" and es_mode == "synchronous", ("Sweeps only support the evaluation mode fixed "
+                                                                     "and the ES mode synchronous")
+    assert use_noise_bank or not fixed_evaluation_noise, f"Fixed evaluation noise requires use_noise_bank"
+    # Options of train_controller.py that sweeps do not support, they are not part of the sweep config but could be
+    # copied over from a config of a single training
+    assert not config["trainer_parameters"].get("distributed", False), "Sweeps do not support distributed training"
+    assert config["logging_parameters"].get("es_checkpoint_frequency", 0) == 0, ("Sweeps do not support CMA-ES "
+                                                                                 "checkpoints")
+
+    # Seeds the processes as a whole, each CMA-ES instance is seeded with the manual_seed of its config
+    set_seeds(base_config["experiment_parameters"]["manual_seed"])
+
+    device = get_device(gpu_id)
+    controller = construct_controller(rnn_dir, vae_dir)
+
+    instances = []
+    for index, instance_config in enumerate(sweep_configs):
+        summary_writer = None
+
+        if not debug:
+            assert number_of_workers > 0, f"Number of workers must be greater than 0"
+
+            summary_writer = ImprovedSummaryWriter(
+                log_dir=save_dir,
+                comet_config={
+                    "project_name": "world-models/controller",
+                    "disabled": disable_comet
+                }
+            )
+            summary_writer.add_text("Hyperparameters", pretty_json(instance_config), global_step=0)
+
+            if not disable_comet:
+                # noinspection PyProtectedMember
+                summary_writer._get_comet_logger()._experiment.set_name(f"version_{summary_writer.version_number}")
+
+            save_yaml_config(os.path.join(summary_writer.get_logdir(), "config.yaml"), instance_config)
+
+        instances.append(SweepInstance(index, instance_config, summary_writer, controller, cma_mode))
+
+        logging.info(f"Sweep instance {index}: " + ", ".join(
+            f"{parameter} {instance_config[section][parameter]}" for parameter, section in SWEEP_PARAMETERS.items()
+        ) + (f" - version_{summary_writer.version_number}" if summary_writer is not None else ""))
+
+    tmp_dir = None
+    if not debug:
+        # The worker logs of the whole sweep are stored in the directory of the first instance
+        tmp_dir = os.path.join(instances[0].log_dir, "tmp")
+        if not os.path.exists(tmp_dir):
+            mkdir(tmp_dir)
+        else:
+            for fname in listdir(tmp_dir):
+                unlink(os.path.join(tmp_dir, fname))
+
+    initial_obs_path = generate_initial_observation_latent_vector(vae_dir, device, load_best=True)
+
+    # One M model in shared memory and one pool of workers for all instances
+    rnn_state_dict = load_shared_state_dict(rnn_dir, device, load_best=True)
+
+    worker_pool = RolloutWorkerPool(
+        number_of_workers=0 if debug else number_of_workers,
+        rollout_arguments={
+            "rnn_dir": rnn_dir,
+            "vae_dir": vae_dir,
+            "initial_obs_path": initial_obs_path,
+            "temperature": config["rnn_parameters"]["temperature"],
+            "time_limit": time_limit,
+            "device": device,
+            "stop_when_total_reward_exceeded": stop_when_total_reward_exceeded,
+            "rollout_batch_size": rollout_batch_size,
+            "rnn_state_dict": rnn_state_dict,
+            "use_fused_step": use_fused_dream_step,
+            "use_noise_bank": use_noise_bank,
+            "inference_precision": inference_precision
+        },
+        tmp_dir=tmp_dir,
+        tasks_per_chunk=tasks_per_chunk,
+        max_chunks_in_flight=max_chunks_in_flight,
+        # Room for the candidates of two generations of every instance and their evaluations
+        shared_memory_rows=len(instances) * (2 * population_size + 2) if use_shared_memory_dispatch else 0,
+        number_of_parameters=len(flatten_parameters(controller.parameters())),
+        enable_profiling=enable_profiling,
+        fitness_cache_size=fitness_cache_size
+    )
+    worker_pool.start()
+
+    # Shared by all instances, the keys are (instance index, generation)
+    pending_evaluations = {}
+
+    generation = 0
+    last_log_generation = -1
+    while generation < max_generations:
+        for instance in instances:
+            if not instance.finished and instance.es.stop():
+                logging.info(f"Sweep instance {instance.index} stopped at generation {generation}")
+                instance.finished = True
+
+        active_instances = [instance for instance in instances if not instance.finished]
+
+        if not active_instances:
+            break
+
+        if display_progress_bars:
+            progress_bar = tqdm(total=len(active_instances) * population_size * number_of_samples,
+                                desc=f"Generation {generation} - Rewards of {len(active_instances)} instances")
+        else:
+            progress_bar = None
+
+        population_solutions = [instance.es.ask() for instance in active_instances]
+
+        evaluation_start = time.perf_counter()
+        r_lists = evaluate_instances(worker_pool, active_instances, population_solutions, number_of_samples,
+                                     generation, use_noise_bank, progress_bar)
+        evaluation_time = time.perf_counter() - evaluation_start
+
+        if display_progress_bars:
+            progress_bar.close()
+
+        log_generation = generation % scalar_log_frequency == 0 or generation == max_generations - 1
+        pool_metrics = worker_pool.get_metrics(generation - last_log_generation) if log_generation else {}
+
+        if log_generation:
+            last_log_generation = generation
+
+        for instance, solutions, r_list in zip(active_instances, population_solutions, r_lists):
+            instance.es.tell(solutions, r_list)
+
+            if not log_generation:
+                continue
+
+            submit_evaluation(worker_pool, pending_evaluations, (instance.index, generation), solutions, r_list,
+                              rollouts=number_of_evaluations,
+                              noise_seeds=instance.get_evaluation_noise_seeds(number_of_evaluations,
+                                                                               fixed_evaluation_noise),
+                              temperature=instance.temperature)
+
+            if instance.summary_writer is not None:
+                # The pool is shared, therefore its metrics are the same for all instances
+                for metric_name, metric_value in pool_metrics.items():
+                    instance.summary_writer.add_scalar(metric_name, metric_value, global_step=generation)
+
+                instance.summary_writer.add_scalar("sweep_evaluation_time", evaluation_time, global_step=generation)
+                instance.summary_writer.add_scalar("min", -np.max(r_list), global_step=generation)
+                instance.summary_writer.add_scalar("max", -np.min(r_list), global_step=generation)
+                instance.summary_writer.add_scalar("mean", -np.mean(r_list), global_step=generation)
+
+        for (instance_index, evaluated_generation), best_params, best, std_best in collect_evaluations(
+                worker_pool, pending_evaluations, number_of_evaluations):
+            instance = instances[instance_index]
+            instance.current_best = save_evaluation(
+                instance.summary_writer, controller, instance.best_model_filename, save_model_checkpoints,
+                instance.current_best, evaluated_generation, best_params, best, std_best
+            )
+
+            if target_return is not None and -best > target_return and not instance.finished:
+                logging.info(f"Sweep instance {instance_index} achieved value {-best}, stopping it")
+                instance.finished = True
+
+        generation += 1
+
+    for (instance_index, evaluated_generation), best_params, best, std_best in collect_evaluations(
+            worker_pool, pending_evaluations, number_of_evaluations, block=True):
+        instance = instances[instance_index]
+        instance.current_best = save_evaluation(
+            instance.summary_writer, controller, instance.best_model_filename, save_model_checkpoints,
+            instance.current_best, evaluated_generation, best_params, best, std_best
+        )
+
+    worker_pool.shutdown()
+
+    gui_env_worker_pool = None
+
+    if evaluate_final_on_actual_environment and any(instance.summary_writer is not None for instance in instances):
+        # All instances use the same M and V model, therefore one set of warm environment workers evaluates all of them
+        gui_env_worker_pool = GUIEnvWorkerPool(
+            rnn_dir=rnn_dir,
+            vae_dir=vae_dir,
+            gpu=gpu_id,
+            stop_mode=evaluation_stop_mode,
+            amount=evaluation_amount,
+            number_of_workers=min(max(number_of_workers, 1), NUMBER_OF_FINAL_EVALUATIONS),
+            latent_cache_size=latent_cache_size,
+            pipelined=pipelined_rollouts,
+            enable_profiling=enable_profiling
+        )
+        gui_env_worker_pool.start()
+
+    for instance in instances:
+        logging.info(f"Sweep instance {instance.index}: best "
+                     f"{-instance.current_best if instance.current_best is not None else None}")
+
+        if instance.summary_writer is None:
+            continue
+
+        if evaluate_final_on_actual_environment:
+            evaluated_rewards = evaluate_controller(
+                controller_directory=instance.log_dir,
+                gpu=gpu_id,
+                stop_mode=evaluation_stop_mode,
+                amount=evaluation_amount,
+                number_of_evaluations=NUMBER_OF_FINAL_EVALUATIONS,
+                worker_pool=gui_env_worker_pool
+            )
+
+            instance.summary_writer.add_scalar("eval_mean", np.mean(evaluated_rewards), global_step=0)
+            instance.summary_writer.add_scalar("eval_std", np.std(evaluated_rewards), global_step=0)
+
+        instance.summary_writer.close()
+
+    if gui_env_worker_pool is not None:
+        gui_env_worker_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
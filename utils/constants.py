@@ -1,3 +1,4 @@
 GUI_ENV_INITIAL_STATE_FILE_PATH = "res/gui_env_initial_state.png"
 INITIAL_OBS_LATENT_VECTOR_FILE_NAME = "initial_obs_latent.hdf5"
+ES_CHECKPOINT_FILE_NAME = "es_checkpoint.pkl"
 MAX_COORDINATE = 448  # This results from the GUIEnv which is 448x448
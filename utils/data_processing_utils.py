@@ -2,10 +2,10 @@ import os
 
 import h5py
 import torch
-from PIL import Image
 from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 
+from data.observation_container import list_sequence_observations, load_observation_image
 from models.vae import BaseVAE
 from utils.training_utils import vae_transformation_functions
 
@@ -16,14 +16,14 @@ class PreprocessVAEDataset(Dataset):
         self.root_dir = root_dir
         self.transform_functions = transform_functions
 
-        self.image_files = os.listdir(os.path.join(self.root_dir, "observations"))
-        self.image_files.sort()
+        # Either the PNG files of the observations folder or the rows of the observations container
+        self.image_files = list_sequence_observations(self.root_dir)
 
     def __len__(self):
         return len(self.image_files)
 
     def __getitem__(self, index):
-        img = Image.open(os.path.join(self.root_dir, "observations", self.image_files[index]))
+        img = load_observation_image(self.image_files[index])
         img = self.transform_functions(img)
         return img
 
@@ -8,7 +8,16 @@ from tensorboardX import SummaryWriter
 
 class ImprovedSummaryWriter(SummaryWriter):
 
-    def __init__(self, log_dir: str, name: Optional[str] = None, **kwargs):
+    def __init__(self, log_dir: str, name: Optional[str] = None, resume_log_dir: Optional[str] = None, **kwargs):
+        """
+        If resume_log_dir is given (an existing version_X directory), the logs are written into that directory instead
+        of creating a new version
+        """
+
+        if resume_log_dir is not None:
+            self.version_number = int(os.path.basename(os.path.normpath(resume_log_dir)).split("version_")[-1])
+            super().__init__(log_dir=resume_log_dir, **kwargs)
+            return
 
         if name is not None:
             root_save_dir = os.path.join(log_dir, name)
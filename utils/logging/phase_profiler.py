@@ -0,0 +1,90 @@
+import time
+from collections import defaultdict
+from typing import Dict
+
+
+class _Measurement:
+
+    __slots__ = ["profiler", "phase", "start_time"]
+
+    def __init__(self, profiler: "PhaseProfiler", phase: str):
+        self.profiler = profiler
+        self.phase = phase
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.timings[self.phase] += time.perf_counter() - self.start_time
+
+
+class _NoMeasurement:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NO_MEASUREMENT = _NoMeasurement()
+
+
+class PhaseProfiler:
+    """
+    Accumulates the time spent in named phases (in seconds) and counters, until they are collected with pop().
+
+        with profiler.measure("rnn_forward"):
+            ...
+        profiler.count("env_steps")
+
+    If the profiler is disabled, measure() and count() do nothing, which keeps the overhead in the rollout loops at a
+    single function call. The times are wall clock times of the calling process, for CUDA devices they therefore only
+    include the time to launch the kernels, not necessarily the time to run them.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.timings = defaultdict(float)
+
+    def measure(self, phase: str):
+        if not self.enabled:
+            return _NO_MEASUREMENT
+
+        return _Measurement(self, phase)
+
+    def count(self, name: str, amount: int = 1):
+        if self.enabled:
+            self.timings[name] += amount
+
+    def add(self, phase: str, seconds: float):
+        """
+        Add a time that was measured outside of measure(), for example one that spans multiple phases.
+        """
+        if self.enabled:
+            self.timings[phase] += seconds
+
+    def merge(self, timings: Dict[str, float]):
+        """
+        Add the timings and counters of another profiler, for example of a worker process.
+        """
+        for name, value in timings.items():
+            self.timings[name] += value
+
+    def pop(self) -> Dict[str, float]:
+        """
+        Returns the accumulated timings and counters and resets them.
+        """
+        timings = dict(self.timings)
+        self.timings.clear()
+
+        return timings
+
+
+# One profiler per process, such that the rollouts and environments do not need to pass it around
+_profiler = PhaseProfiler()
+
+
+def get_profiler() -> PhaseProfiler:
+    return _profiler
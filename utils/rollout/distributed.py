@@ -0,0 +1,439 @@
+import hashlib
+import io
+import logging
+import os
+import queue
+import shutil
+import socket
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from os import getpid
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+from utils.constants import INITIAL_OBS_LATENT_VECTOR_FILE_NAME
+from utils.logging.phase_profiler import get_profiler
+from utils.rollout.dream_rollout import create_dream_rollout
+from utils.rollout.worker_pool import RolloutWorkerPool, evaluate_chunk, WORKER_SHUTDOWN_TIMEOUT
+
+# Interval in seconds in which the workers send a heartbeat, and after how many seconds without any message from a
+# worker it is considered lost, i.e. its chunks are dispatched to other workers. A worker only sends heartbeats while
+# it waits for chunks or finished a rollout (batch) within the heartbeat timeout, therefore one rollout (batch) must
+# not take longer than that. The coordinator sends its timeout to the workers, such that both use the same
+HEARTBEAT_INTERVAL = 5.0
+DEFAULT_HEARTBEAT_TIMEOUT = 30.0
+
+# Environment variable holding the key, with which workers authenticate at the coordinator
+AUTHKEY_ENVIRONMENT_VARIABLE = "ROLLOUT_WORKER_AUTHKEY"
+
+DEFAULT_MODEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "automatic-gui-testing", "rollout_models")
+
+# These rollout arguments are determined by the worker itself, the remaining ones are sent by the coordinator
+LOCAL_ROLLOUT_ARGUMENTS = ["rnn_dir", "vae_dir", "initial_obs_path", "device", "rnn_state_dict"]
+
+# File names inside a model bundle, i.e. everything a worker needs to do dream rollouts
+RNN_CONFIG_FILE = os.path.join("rnn", "config.yaml")
+VAE_CONFIG_FILE = os.path.join("vae", "config.yaml")
+RNN_STATE_DICT_FILE = "rnn_state_dict.pt"
+
+
+def get_authkey() -> bytes:
+    """
+    Key with which the workers authenticate at the coordinator, taken from the ROLLOUT_WORKER_AUTHKEY environment
+    variable. If it is not set, a random key is used, with which only the local workers can connect.
+    """
+    authkey = os.environ.get(AUTHKEY_ENVIRONMENT_VARIABLE)
+
+    if authkey is None:
+        logging.warning(f"{AUTHKEY_ENVIRONMENT_VARIABLE} is not set, using a random key. Only local rollout workers "
+                        "will be able to connect")
+        return os.urandom(32)
+
+    return authkey.encode()
+
+
+def create_model_bundle(rollout_arguments: dict) -> Tuple[str, Dict[str, bytes]]:
+    """
+    Collect the files that a worker needs for the dream rollouts: The configs of the M and V model, the initial
+    observation and the weights of the M model. Returns the content hash of these files and the files.
+    """
+    with open(os.path.join(rollout_arguments["rnn_dir"], "config.yaml"), "rb") as f:
+        rnn_config = f.read()
+
+    with open(os.path.join(rollout_arguments["vae_dir"], "config.yaml"), "rb") as f:
+        vae_config = f.read()
+
+    with open(rollout_arguments["initial_obs_path"], "rb") as f:
+        initial_obs = f.read()
+
+    rnn_state_dict = rollout_arguments["rnn_state_dict"]
+    if rnn_state_dict is None:
+        rnn_state_dict = torch.load(os.path.join(rollout_arguments["rnn_dir"], "best.pt"),
+                                    map_location="cpu")["state_dict"]
+
+    state_dict_buffer = io.BytesIO()
+    torch.save({k: v.cpu() for k, v in rnn_state_dict.items()}, state_dict_buffer)
+
+    bundle = {
+        RNN_CONFIG_FILE: rnn_config,
+        VAE_CONFIG_FILE: vae_config,
+        INITIAL_OBS_LATENT_VECTOR_FILE_NAME: initial_obs,
+        RNN_STATE_DICT_FILE: state_dict_buffer.getvalue()
+    }
+
+    content_hash = hashlib.sha256()
+    for file_name in sorted(bundle.keys()):
+        content_hash.update(file_name.encode())
+        content_hash.update(bundle[file_name])
+
+    return content_hash.hexdigest(), bundle
+
+
+def get_cached_model_hashes(cache_dir: str) -> List[str]:
+    if not os.path.exists(cache_dir):
+        return []
+
+    return [
+        model_hash for model_hash in os.listdir(cache_dir)
+        if os.path.exists(os.path.join(cache_dir, model_hash, RNN_STATE_DICT_FILE))
+    ]
+
+
+def cache_model_bundle(cache_dir: str, model_hash: str, bundle: Dict[str, bytes]):
+    """
+    Write the bundle into cache_dir/model_hash. The files are first written to a temporary directory, which is then
+    renamed, such that an interrupted worker never leaves an incomplete model in the cache.
+    """
+    model_dir = os.path.join(cache_dir, model_hash)
+    tmp_model_dir = os.path.join(cache_dir, f"{model_hash}.{getpid()}.tmp")
+
+    for file_name, content in bundle.items():
+        os.makedirs(os.path.dirname(os.path.join(tmp_model_dir, file_name)), exist_ok=True)
+        with open(os.path.join(tmp_model_dir, file_name), "wb") as f:
+            f.write(content)
+
+    try:
+        os.rename(tmp_model_dir, model_dir)
+    except OSError:
+        # Another worker on the same machine cached the same model in the meantime
+        shutil.rmtree(tmp_model_dir, ignore_errors=True)
+
+
+def distributed_worker_routine(host: str, port: int, authkey: bytes, device: torch.device,
+                               cache_dir: str = DEFAULT_MODEL_CACHE_DIR, tmp_dir: Optional[str] = None):
+    """
+    Routine of a worker that evaluates dream rollouts for a DistributedRolloutWorkerPool.
+
+    The worker connects to the coordinator and registers with the hashes of the M models in its cache. The coordinator
+    answers with the rollout arguments and, if the worker does not have it cached, with the model bundle. Then, chunks
+    (chunk_id, params, rows, noise_seeds, temperatures, result_slot) are evaluated and (chunk_id, results, wait_time,
+    compute_time, phase_timings) is sent back, until the coordinator sends a shutdown or closes the connection. A
+    background thread sends heartbeats, but only as long as the main loop makes progress within the heartbeat timeout
+    of the coordinator, such that a worker that hangs in a rollout is considered lost by the coordinator.
+    """
+    if tmp_dir is not None:
+        # redirect streams
+        sys.stdout = open(os.path.join(tmp_dir, str(getpid()) + '.out'), 'a')
+        sys.stderr = open(os.path.join(tmp_dir, str(getpid()) + '.err'), 'a')
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Workers may be started before the coordinator, therefore retry until it accepts connections. OSError includes
+    # refused connections, unreachable hosts and timeouts, EOFError a coordinator that closed the connection during the
+    # authentication
+    while True:
+        try:
+            connection = Client((host, port), authkey=authkey)
+            break
+        except (OSError, EOFError) as e:
+            logging.info(f"Coordinator {host}:{port} not reachable ({e!r}), retrying in {HEARTBEAT_INTERVAL} seconds")
+            time.sleep(HEARTBEAT_INTERVAL)
+    send_lock = threading.Lock()
+    stop_heartbeat = threading.Event()
+
+    # The main loop is idle while it waits for a chunk, otherwise last_progress is the time it last received a chunk
+    # or finished a rollout (batch)
+    progress = {"idle": True, "last_progress": time.perf_counter()}
+
+    def report_progress():
+        progress["last_progress"] = time.perf_counter()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    def heartbeat_routine():
+        while not stop_heartbeat.wait(HEARTBEAT_INTERVAL):
+            if not progress["idle"] and time.perf_counter() - progress["last_progress"] > heartbeat_timeout:
+                # The main loop hangs, stop the heartbeats such that the coordinator redispatches the chunks
+                logging.warning(f"No rollout finished for {heartbeat_timeout} seconds, stopped sending heartbeats")
+                continue
+
+            try:
+                send(("heartbeat",))
+            except OSError:
+                break
+
+    send(("register", socket.gethostname(), get_cached_model_hashes(cache_dir)))
+
+    _, model_hash, rollout_arguments, enable_profiling, heartbeat_timeout, bundle = connection.recv()
+
+    if bundle is not None:
+        cache_model_bundle(cache_dir, model_hash, bundle)
+
+    model_dir = os.path.join(cache_dir, model_hash)
+    rnn_state_dict = torch.load(os.path.join(model_dir, RNN_STATE_DICT_FILE), map_location=device)
+
+    profiler = get_profiler()
+    profiler.enabled = enable_profiling
+
+    heartbeat_thread = threading.Thread(target=heartbeat_routine, daemon=True)
+    heartbeat_thread.start()
+
+    try:
+        with torch.no_grad():
+            r_gen = create_dream_rollout(
+                rnn_dir=os.path.dirname(os.path.join(model_dir, RNN_CONFIG_FILE)),
+                vae_dir=os.path.dirname(os.path.join(model_dir, VAE_CONFIG_FILE)),
+                initial_obs_path=os.path.join(model_dir, INITIAL_OBS_LATENT_VECTOR_FILE_NAME),
+                device=device,
+                rnn_state_dict=rnn_state_dict,
+                **rollout_arguments
+            )
+            rollout_batch_size = rollout_arguments["rollout_batch_size"]
+
+            while True:
+                wait_start = time.perf_counter()
+                progress["idle"] = True
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    break
+                report_progress()
+                progress["idle"] = False
+                wait_time = time.perf_counter() - wait_start
+
+                if message[0] == "shutdown":
+                    break
+
+                _, (chunk_id, params, _, noise_seeds, temperatures, _) = message
+
+                compute_start = time.perf_counter()
+                results = evaluate_chunk(r_gen, params, rollout_batch_size, noise_seeds, temperatures,
+                                         progress_callback=report_progress)
+                compute_time = time.perf_counter() - compute_start
+
+                send(("result", chunk_id, results, wait_time, compute_time, profiler.pop()))
+    finally:
+        stop_heartbeat.set()
+        connection.close()
+
+
+class DistributedRolloutWorkerPool(RolloutWorkerPool):
+    """
+    RolloutWorkerPool whose workers connect over TCP, such that the rollouts can be spread across multiple machines.
+
+    The coordinator (this pool) listens on (host, port). Workers, started with rollout_worker.py or as local processes
+    with number_of_local_workers, register at any time and receive the M model, which they cache by its content hash
+    such that it is only transferred once per machine and model. Each worker gets up to max_chunks_in_flight chunks,
+    and a new one every time it sends back results. If a worker disconnects or does not send a heartbeat for
+    heartbeat_timeout seconds, its chunks are dispatched to the other workers. As a worker stops sending heartbeats if
+    it does not finish a rollout (batch) within heartbeat_timeout, it has to be larger than the time of the slowest
+    rollout batch, i.e. it has to grow with the rollout batch size and the time limit.
+
+    The shared memory of RolloutWorkerPool is not used, the parameters are always sent with the chunks.
+    """
+
+    def __init__(self, number_of_local_workers: int, rollout_arguments: dict, host: str, port: int, authkey: bytes,
+                 tmp_dir: Optional[str] = None, tasks_per_chunk: int = 1, max_chunks_in_flight: int = 2,
+                 cache_dir: str = DEFAULT_MODEL_CACHE_DIR, enable_profiling: bool = False, fitness_cache_size: int = 0,
+                 heartbeat_timeout: float = DEFAULT_HEARTBEAT_TIMEOUT):
+        assert heartbeat_timeout > HEARTBEAT_INTERVAL, ("The heartbeat timeout must be larger than the heartbeat "
+                                                        "interval")
+
+        super().__init__(number_of_workers=0, rollout_arguments=rollout_arguments, tmp_dir=tmp_dir,
+                         tasks_per_chunk=tasks_per_chunk, max_chunks_in_flight=max_chunks_in_flight,
+                         enable_profiling=enable_profiling, fitness_cache_size=fitness_cache_size)
+
+        self.evaluate_locally = False
+        self.number_of_local_workers = number_of_local_workers
+        self.host = host
+        self.port = port
+        self.authkey = authkey
+        self.cache_dir = cache_dir
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.remote_rollout_arguments = {
+            k: v for k, v in rollout_arguments.items() if k not in LOCAL_ROLLOUT_ARGUMENTS
+        }
+        self.model_hash, self.model_bundle = create_model_bundle(rollout_arguments)
+
+        self.listener = None
+        self.inbound_messages = queue.Queue()
+        self.connections = {}
+        self.last_seen = {}
+        self.next_worker_id = 0
+        self.shutting_down = False
+        self.last_liveness_check = time.perf_counter()
+
+    def start(self):
+        self.listener = Listener((self.host, self.port), authkey=self.authkey)
+        # With port 0 the operating system chooses a free port
+        self.host, self.port = self.listener.address
+
+        threading.Thread(target=self._accept_routine, daemon=True).start()
+        logging.info(f"Coordinator for distributed rollouts listening on {self.host}:{self.port}")
+
+        for _ in range(self.number_of_local_workers):
+            p = self.ctx.Process(
+                target=distributed_worker_routine,
+                args=(self.host, self.port, self.authkey, self.rollout_arguments["device"], self.cache_dir,
+                      self.tmp_dir)
+            )
+            p.start()
+            self.processes.append(p)
+
+    def shutdown(self):
+        self.shutting_down = True
+
+        for worker_id, connection in list(self.connections.items()):
+            try:
+                connection.send(("shutdown",))
+            except OSError:
+                pass
+
+        for p in self.processes:
+            p.join(timeout=WORKER_SHUTDOWN_TIMEOUT)
+            if p.is_alive():
+                p.kill()
+
+        for connection in self.connections.values():
+            connection.close()
+
+        if self.listener is not None:
+            self.listener.close()
+
+        self.processes = []
+        self.connections = {}
+        self.listener = None
+
+    def _accept_routine(self):
+        while not self.shutting_down:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError):
+                # Closed listener, or a client that failed to authenticate
+                if self.shutting_down:
+                    break
+                continue
+
+            worker_id = self.next_worker_id
+            self.next_worker_id += 1
+
+            threading.Thread(target=self._read_routine, args=(worker_id, connection), daemon=True).start()
+
+    def _read_routine(self, worker_id: int, connection):
+        while True:
+            try:
+                message = connection.recv()
+            except (OSError, EOFError):
+                self.inbound_messages.put((worker_id, connection, ("disconnected",)))
+                break
+
+            self.inbound_messages.put((worker_id, connection, message))
+
+    def _send_chunk(self, worker_id: Any, message: Tuple[Any, ...]):
+        try:
+            self.connections[worker_id].send(("chunk", message))
+        except OSError:
+            # The worker is removed as soon as its disconnect message is processed, which redispatches this chunk
+            logging.warning(f"Could not send chunk to rollout worker {worker_id}")
+
+    def _receive(self):
+        wait_start = time.perf_counter()
+        self._receive_message()
+        self.result_wait_time += time.perf_counter() - wait_start
+
+    def _receive_message(self):
+        while True:
+            # Check the liveness on a timer, as the messages of the other workers would otherwise prevent that a worker
+            # without heartbeats is ever detected
+            if time.perf_counter() - self.last_liveness_check > HEARTBEAT_INTERVAL:
+                self._check_workers_alive()
+
+            try:
+                worker_id, connection, message = self.inbound_messages.get(timeout=HEARTBEAT_INTERVAL)
+                break
+            except queue.Empty:
+                self._check_workers_alive()
+
+                if not self.connections:
+                    logging.warning("Waiting for rollout workers to connect")
+
+        if message[0] == "register":
+            self._register_worker(worker_id, connection, message[1], message[2])
+            return
+
+        if worker_id not in self.connections:
+            # Late message of a worker that was already removed, its chunks were already redispatched
+            return
+
+        self.last_seen[worker_id] = time.perf_counter()
+
+        if message[0] == "result":
+            _, chunk_id, results, wait_time, compute_time, phase_timings = message
+            self._finish_chunk(worker_id, chunk_id, results, wait_time, compute_time, phase_timings)
+        elif message[0] == "disconnected":
+            self._remove_worker(worker_id, "disconnected")
+
+    def _register_worker(self, worker_id: int, connection, worker_name: str, cached_model_hashes: List[str]):
+        bundle = None if self.model_hash in cached_model_hashes else self.model_bundle
+
+        try:
+            connection.send(("setup", self.model_hash, self.remote_rollout_arguments, self.enable_profiling,
+                             self.heartbeat_timeout, bundle))
+        except OSError:
+            return
+
+        self.connections[worker_id] = connection
+        self.chunks_in_flight[worker_id] = {}
+        self.last_seen[worker_id] = time.perf_counter()
+        self.number_of_workers = len(self.connections)
+
+        logging.info(f"Rollout worker {worker_id} on {worker_name} registered "
+                     f"({'model was cached' if bundle is None else 'sent model'})")
+
+        self._dispatch()
+
+    def _remove_worker(self, worker_id: int, reason: str):
+        logging.warning(f"Rollout worker {worker_id} {reason}, dispatching its chunks to the other workers")
+
+        connection = self.connections.pop(worker_id)
+        connection.close()
+        del self.last_seen[worker_id]
+        self.number_of_workers = len(self.connections)
+
+        # Put the tasks back to the front, such that they are evaluated next
+        for chunk_id, (tasks, _) in reversed(list(self.chunks_in_flight.pop(worker_id).items())):
+            if chunk_id in self.low_priority_chunk_ids:
+                self.low_priority_chunk_ids.remove(chunk_id)
+                self.pending_low_priority_tasks.extendleft(reversed(tasks))
+            else:
+                self.pending_tasks.extendleft(reversed(tasks))
+
+        self._dispatch()
+
+    def _check_workers_alive(self):
+        now = time.perf_counter()
+        self.last_liveness_check = now
+
+        for worker_id, last_seen in list(self.last_seen.items()):
+            if now - last_seen > self.heartbeat_timeout:
+                self._remove_worker(worker_id, f"sent no heartbeat for {self.heartbeat_timeout} seconds")
+
+        for p in self.processes:
+            if not p.is_alive() and p.exitcode != 0:
+                logging.warning(f"Local rollout worker process {p.pid} died with exit code {p.exitcode}")
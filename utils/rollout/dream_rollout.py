@@ -1,10 +1,15 @@
 import os
+from typing import List, Optional
 
+import numpy as np
 import torch
 
 from envs.simulated_gui_env import SimulatedGUIEnv
+from envs.vectorized_simulated_gui_env import VectorizedSimulatedGUIEnv
 from models import Controller
+from utils.logging.phase_profiler import get_profiler
 from utils.misc import load_parameters
+from utils.rollout.noise_bank import NoiseBank
 from utils.setup_utils import load_yaml_config
 
 
@@ -13,7 +18,9 @@ class DreamRollout:
     def __init__(self, rnn_dir: str, vae_dir: str, initial_obs_path: str, max_coordinate_size_for_task: int,
                  temperature: float, device,
                  time_limit: int = 1000, load_best_rnn: bool = True, load_best_vae: bool = True,
-                 stop_when_total_reward_exceeded: bool = False, render: bool = False):
+                 stop_when_total_reward_exceeded: bool = False, render: bool = False,
+                 rnn_state_dict: Optional[dict] = None, use_fused_step: bool = False,
+                 inference_precision: str = "float32"):
         self.rnn_dir = rnn_dir
         self.vae_dir = vae_dir
         self.max_coordinate_size_for_task = max_coordinate_size_for_task
@@ -45,21 +52,34 @@ class DreamRollout:
             device=self.device,
             load_best_rnn=load_best_rnn,
             load_best_vae=load_best_vae,
-            render=self.render
+            render=self.render,
+            rnn_state_dict=rnn_state_dict,
+            use_fused_step=use_fused_step,
+            inference_precision=inference_precision
         )
 
-    def rollout(self, controller_parameters):
+    def rollout(self, controller_parameters, temperature: Optional[float] = None):
+        """
+        temperature optionally overrides the temperature given in the constructor for this rollout.
+        """
         load_parameters(controller_parameters, self.controller)
 
+        self.simulated_gui_env.temperature = torch.tensor(
+            temperature if temperature is not None else self.temperature, device=self.device
+        )
+
         latent_observation = self.simulated_gui_env.reset()
         total_reward = 0
+        profiler = get_profiler()
 
         for t in range(self.time_limit):
-            with torch.no_grad():
-                controller_output = self.controller(latent_observation, self.simulated_gui_env.rnn.hidden[0])
+            with torch.no_grad(), profiler.measure("controller_forward"):
+                # float() is a no-op, except for reduced precision inference of the M model
+                controller_output = self.controller(latent_observation, self.simulated_gui_env.rnn.hidden[0].float())
                 actions = self.controller.predict(controller_output)
 
             latent_observation, reward, done, info = self.simulated_gui_env.step(actions)
+            profiler.count("env_steps")
 
             total_reward += reward
 
@@ -69,3 +89,192 @@ class DreamRollout:
         # Return minus as the CMA-ES implementation minimizes the objective function
         # noinspection PyUnresolvedReferences
         return -total_reward.cpu().item()
+
+
+class PopulationDreamRollout:
+    """
+    Same as DreamRollout, but evaluates multiple controllers at once.
+
+    The controllers are stacked into one weight tensor, and each controller gets its own environment in a
+    VectorizedSimulatedGUIEnv with number_of_envs environments. Each time step is therefore one large matrix
+    multiplication instead of one small one per controller. The rewards are accumulated per controller.
+
+    With use_noise_bank, rollouts can be given a noise seed, which determines all random numbers of the rollout, see
+    NoiseBank.
+    """
+
+    def __init__(self, number_of_envs: int, rnn_dir: str, vae_dir: str, initial_obs_path: str,
+                 max_coordinate_size_for_task: int, temperature: float, device,
+                 time_limit: int = 1000, load_best_rnn: bool = True, stop_when_total_reward_exceeded: bool = False,
+                 rnn_state_dict: Optional[dict] = None, use_fused_step: bool = False, use_noise_bank: bool = False,
+                 inference_precision: str = "float32"):
+        self.rnn_dir = rnn_dir
+        self.vae_dir = vae_dir
+        self.max_coordinate_size_for_task = max_coordinate_size_for_task
+        self.temperature = temperature
+        self.device = device
+        self.time_limit = time_limit
+        self.stop_when_total_reward_exceeded = stop_when_total_reward_exceeded
+
+        rnn_config = load_yaml_config(os.path.join(self.rnn_dir, "config.yaml"))
+        vae_config = load_yaml_config(os.path.join(self.vae_dir, "config.yaml"))
+        if vae_config["model_parameters"]["apply_value_range_when_kld_disabled"]:
+            raise RuntimeError(f"VAE used apply_value_range_when_kld_disabled but this is not properly implemented "
+                               "in the dream rollout")
+
+        self.latent_size = vae_config["model_parameters"]["latent_size"]
+        self.hidden_size = rnn_config["model_parameters"]["hidden_size"]
+        self.action_size = rnn_config["model_parameters"]["action_size"]
+
+        self.environment_arguments = {
+            "rnn_dir": self.rnn_dir,
+            "vae_dir": self.vae_dir,
+            "initial_obs_path": initial_obs_path,
+            "max_coordinate_size_for_task": self.max_coordinate_size_for_task,
+            "temperature": self.temperature,
+            "device": self.device,
+            "load_best_rnn": load_best_rnn,
+            "rnn_state_dict": rnn_state_dict,
+            "use_fused_step": use_fused_step,
+            "inference_precision": inference_precision
+        }
+
+        self.simulated_gui_env = VectorizedSimulatedGUIEnv(number_of_envs=number_of_envs, **self.environment_arguments)
+
+        # Smaller environments for populations with fewer controllers than number_of_envs (for example the last chunk
+        # of a generation), created when first needed
+        self.partial_simulated_gui_envs = {}
+
+        self.noise_bank = None
+        if use_noise_bank:
+            self.noise_bank = NoiseBank(self.time_limit, self.latent_size, self.device)
+
+    def rollout(self, population_parameters: np.ndarray, noise_seeds: Optional[List[int]] = None,
+                temperatures: Optional[List[float]] = None) -> np.ndarray:
+        """
+        population_parameters is a (N, NUM_PARAMETERS) matrix, where each row are the flattened parameters of one
+        controller. Returns the N (negated) total rewards.
+
+        temperatures are optionally N temperatures, one per controller. Without, the temperature given in the
+        constructor is used.
+
+        noise_seeds are optionally N seeds of the noise bank, one per controller. Without, new random numbers are drawn.
+
+        N must not be larger than the number of environments. If it is smaller, the controllers are evaluated with a
+        VectorizedSimulatedGUIEnv of N environments, such that no computation is spent on unused environments.
+        """
+        population_parameters = torch.as_tensor(np.asarray(population_parameters), dtype=torch.float32,
+                                                device=self.device)
+        population_size = population_parameters.size(0)
+
+        number_of_envs = self.simulated_gui_env.num_envs
+
+        assert population_size <= number_of_envs, (f"Cannot evaluate {population_size} controllers with "
+                                                   f"{number_of_envs} environments")
+
+        simulated_gui_env = self._get_simulated_gui_env(population_size)
+
+        weights, biases = Controller.unflatten_population(
+            population_parameters, self.latent_size + self.hidden_size, self.action_size
+        )
+
+        if noise_seeds is not None:
+            assert self.noise_bank is not None, "Noise seeds were given, but the noise bank is not used"
+            simulated_gui_env.set_noise(self.noise_bank.get(noise_seeds))
+        else:
+            simulated_gui_env.set_noise(None)
+
+        if temperatures is not None:
+            simulated_gui_env.set_temperature(temperatures)
+        else:
+            simulated_gui_env.set_temperature(self.temperature)
+
+        profiler = get_profiler()
+
+        with torch.no_grad():
+            latent_observations = simulated_gui_env.reset()
+
+            total_rewards = torch.zeros(population_size, device=self.device)
+            active = torch.ones(population_size, dtype=torch.bool, device=self.device)
+
+            for t in range(self.time_limit):
+                with profiler.measure("controller_forward"):
+                    controller_output = Controller.population_forward(
+                        weights, biases, latent_observations, simulated_gui_env.hidden_state
+                    )
+                    actions = Controller.predict(controller_output)
+
+                latent_observations, rewards, _, _ = simulated_gui_env.step(actions)
+                if profiler.enabled:
+                    # Controllers that stopped are still stepped, but only the steps of the active ones are counted.
+                    # Checked before, as the sum synchronizes with the device
+                    profiler.count("env_steps", int(active.sum()))
+
+                # Controllers that already exceeded the total reward do not collect further rewards. This is the same
+                # as stopping their rollout, which DreamRollout does
+                total_rewards += rewards * active
+
+                if self.stop_when_total_reward_exceeded:
+                    active &= total_rewards < 1.0
+
+                    if not active.any():
+                        break
+
+        # Return minus as the CMA-ES implementation minimizes the objective function
+        return -total_rewards.cpu().numpy()
+
+    def _get_simulated_gui_env(self, number_of_envs: int) -> VectorizedSimulatedGUIEnv:
+        if number_of_envs == self.simulated_gui_env.num_envs:
+            return self.simulated_gui_env
+
+        if number_of_envs not in self.partial_simulated_gui_envs:
+            self.partial_simulated_gui_envs[number_of_envs] = VectorizedSimulatedGUIEnv(
+                number_of_envs=number_of_envs, **self.environment_arguments
+            )
+
+        return self.partial_simulated_gui_envs[number_of_envs]
+
+
+def create_dream_rollout(rnn_dir: str, vae_dir: str, initial_obs_path: str, temperature: float, time_limit: int,
+                         device, stop_when_total_reward_exceeded: bool, rollout_batch_size: int,
+                         rnn_state_dict: Optional[dict] = None, use_fused_step: bool = False,
+                         use_noise_bank: bool = False, inference_precision: str = "float32"):
+    """
+    Returns a PopulationDreamRollout if multiple rollouts shall be evaluated at once (rollout_batch_size > 1) or if the
+    noise bank is used, otherwise a DreamRollout. If rnn_state_dict is given, the M model uses these weights instead of
+    loading them from rnn_dir.
+    """
+    if rollout_batch_size > 1 or use_noise_bank:
+        return PopulationDreamRollout(
+            number_of_envs=rollout_batch_size,
+            rnn_dir=rnn_dir,
+            vae_dir=vae_dir,
+            initial_obs_path=initial_obs_path,
+            max_coordinate_size_for_task=448,
+            temperature=temperature,
+            device=device,
+            time_limit=time_limit,
+            load_best_rnn=True,
+            stop_when_total_reward_exceeded=stop_when_total_reward_exceeded,
+            rnn_state_dict=rnn_state_dict,
+            use_fused_step=use_fused_step,
+            use_noise_bank=use_noise_bank,
+            inference_precision=inference_precision
+        )
+
+    return DreamRollout(
+        rnn_dir=rnn_dir,
+        vae_dir=vae_dir,
+        initial_obs_path=initial_obs_path,
+        max_coordinate_size_for_task=448,
+        temperature=temperature,
+        device=device,
+        time_limit=time_limit,
+        load_best_rnn=True,
+        load_best_vae=True,
+        stop_when_total_reward_exceeded=stop_when_total_reward_exceeded,
+        render=False,
+        rnn_state_dict=rnn_state_dict,
+        use_fused_step=use_fused_step,
+        inference_precision=inference_precision
+    )
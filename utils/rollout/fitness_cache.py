@@ -0,0 +1,89 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+class FitnessCache:
+    """
+    Bounded cache of rollout results, keyed by (parameter vector, temperature, time limit, noise seed).
+
+    Only rollouts with a noise seed are deterministic (see NoiseBank), rollouts without one draw new random numbers and
+    are therefore never cached. The parameter vector is hashed over its exact float64 bytes, i.e. only exact repeats
+    hit the cache. If the cache is full, the least recently used result is evicted.
+    """
+
+    def __init__(self, max_size: int):
+        assert max_size > 0, "The maximum size of the fitness cache must be greater than 0"
+
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(params: np.ndarray, temperature: float, time_limit: int,
+                noise_seed: Optional[int]) -> Optional[Tuple[Hashable, ...]]:
+        """
+        Returns the key of the rollout, or None if it cannot be cached.
+        """
+        if noise_seed is None:
+            return None
+
+        params_hash = hashlib.blake2b(np.ascontiguousarray(params, dtype=np.float64).tobytes(),
+                                      digest_size=16).digest()
+
+        return params_hash, temperature, time_limit, noise_seed
+
+    def get(self, key: Optional[Tuple[Hashable, ...]]) -> Optional[float]:
+        if key is None:
+            return None
+
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key: Optional[Tuple[Hashable, ...]], result: float):
+        if key is None:
+            return
+
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def get_state(self) -> List[Tuple[Tuple[Hashable, ...], float]]:
+        """
+        Returns the cached (key, result) pairs from the least to the most recently used, e.g. to save them in a
+        checkpoint.
+        """
+        return list(self.cache.items())
+
+    def set_state(self, state: List[Tuple[Tuple[Hashable, ...], float]]):
+        """
+        Restores the pairs of get_state(). If there are more than max_size, the most recently used ones are kept.
+        """
+        self.cache = OrderedDict(state[-self.max_size:])
+
+    def get_metrics(self) -> Dict[str, float]:
+        """
+        Returns the hits and the hit rate since the last call of this function and resets them.
+        """
+        lookups = self.hits + self.misses
+
+        metrics = {
+            "fitness_cache_hits": self.hits,
+            "fitness_cache_hit_rate": self.hits / lookups if lookups > 0 else 0.0
+        }
+
+        self.hits = 0
+        self.misses = 0
+
+        return metrics
@@ -1,18 +1,22 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
 
 import gym
 # noinspection PyUnresolvedReferences
 import gym_gui_environments
+import numpy as np
 import torch
-from PIL import Image
 
 from models import Controller
 from utils.constants import MAX_COORDINATE
+from utils.logging.phase_profiler import get_profiler
 from utils.misc import load_parameters
+from utils.rollout.latent_cache import ObservationLatentCache
 from utils.setup_utils import load_yaml_config
 from utils.training_utils.training_utils import (
-    load_rnn_architecture, load_vae_architecture, vae_transformation_functions, get_rnn_action_transformation_function
+    load_rnn_architecture, load_vae_architecture, get_rnn_action_transformation_function, ObservationPreprocessor
 )
 
 POSSIBLE_STOP_MODES = ["time", "iterations"]
@@ -21,7 +25,8 @@ POSSIBLE_STOP_MODES = ["time", "iterations"]
 class GUIEnvRollout:
 
     def __init__(self, rnn_dir: str, vae_dir: str, device, stop_mode: str, amount: int = 1000,
-                 load_best_rnn: bool = True, load_best_vae: bool = True):
+                 load_best_rnn: bool = True, load_best_vae: bool = True, latent_cache_size: int = 0,
+                 pipelined: bool = False):
         self.rnn_dir = rnn_dir
         self.vae_dir = vae_dir
         self.device = device
@@ -50,10 +55,11 @@ class GUIEnvRollout:
         img_size = vae_config["experiment_parameters"]["img_size"]
         dataset = vae_config["experiment_parameters"]["dataset"]
         output_activation_function = vae_config["model_parameters"]["output_activation_function"]
-        self.vae_transformation_functions = vae_transformation_functions(
+        self.observation_preprocessor = ObservationPreprocessor(
             img_size=img_size,
             dataset=dataset,
-            output_activation_function=output_activation_function
+            output_activation_function=output_activation_function,
+            device=self.device
         )
 
         self.env: gym.Env = gym.make("PySideGUI-v0")
@@ -68,6 +74,50 @@ class GUIEnvRollout:
 
         self.cpu_device = torch.device("cpu")
 
+        # Identical observations are only encoded once, see ObservationLatentCache
+        self.latent_cache = ObservationLatentCache(latent_cache_size) if latent_cache_size > 0 else None
+
+        # With pipelining, the M model updates its hidden state with (z_t, a_t) in a background thread while the
+        # environment executes a_t in the main thread (Qt requires this), as both only depend on a_t. The update is
+        # awaited before the next controller output, therefore the steps are the same as without pipelining
+        self.rnn_executor = ThreadPoolExecutor(max_workers=1) if pipelined else None
+
+    def encode_observation(self, ob: np.ndarray) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.latent_cache is None:
+            return self.vae.encode(self.observation_preprocessor(ob))
+
+        key = self.latent_cache.get_key(ob)
+        cached = self.latent_cache.get(key)
+
+        if cached is not None:
+            return cached
+
+        start_time = time.perf_counter()
+        mu, log_var = self.vae.encode(self.observation_preprocessor(ob))
+
+        if self.device.type == "cuda":
+            # Wait for the encoder, otherwise only the time to queue the kernels would be measured
+            torch.cuda.synchronize(self.device)
+
+        self.latent_cache.put(key, mu, log_var, time.perf_counter() - start_time)
+
+        return mu, log_var
+
+    def get_latent_cache_metrics(self) -> Dict[str, float]:
+        """
+        Returns the metrics of the latent cache since the last call (see ObservationLatentCache.get_metrics()), or an
+        empty dict if the cache is disabled.
+        """
+        if self.latent_cache is None:
+            return {}
+
+        return self.latent_cache.get_metrics()
+
+    def update_hidden_state(self, z: torch.Tensor, actions: torch.Tensor):
+        with torch.no_grad(), get_profiler().measure("rnn_forward"):
+            # Updates hidden state internally
+            self.rnn(z, actions)
+
     def rollout(self, controller_parameters, return_reward_list: bool = False):
         self.rnn.initialize_hidden()
         load_parameters(controller_parameters, self.controller)
@@ -82,6 +132,8 @@ class GUIEnvRollout:
         t = 0
         start_time = time.time()
 
+        profiler = get_profiler()
+
         while True:
             if self.stop_mode == "time":
                 if time.time() >= start_time + self.amount:
@@ -90,25 +142,41 @@ class GUIEnvRollout:
                 if t >= self.amount:
                     break
 
-            ob = self.vae_transformation_functions(Image.fromarray(ob)).unsqueeze(0).to(self.device)
+            step_start_time = time.perf_counter()
+
             with torch.no_grad():
-                mu, log_var = self.vae.encode(ob)
-                z = self.vae.reparameterize(
-                    mu, log_var, self.vae.disable_kld, self.vae.apply_value_range_when_kld_disabled
-                ).unsqueeze(0)
+                with profiler.measure("encoder"):
+                    mu, log_var = self.encode_observation(ob)
+                    z = self.vae.reparameterize(
+                        mu, log_var, self.vae.disable_kld, self.vae.apply_value_range_when_kld_disabled
+                    ).unsqueeze(0)
 
-                # controller_output is in tanh range, controller.predict() will transfer into [0, 447] range
-                controller_output = self.controller(z, self.rnn.hidden[0])
-                actions = self.controller.predict(controller_output)
+                with profiler.measure("controller_forward"):
+                    # controller_output is in tanh range, controller.predict() will transfer into [0, 447] range
+                    controller_output = self.controller(z, self.rnn.hidden[0])
+                    actions = self.controller.predict(controller_output)
 
-                # Updates hidden state internally
                 # Transform integer actions into the format that the RNN was trained on
-                self.rnn(z, self.actions_transformation_function_for_rnn_input(actions))
+                rnn_actions = self.actions_transformation_function_for_rnn_input(actions)
 
             # Move actions to CPU to avoid memory leak in the environment when using GPU to calculate the model outputs
             actions = actions.squeeze().to(self.cpu_device)
 
-            ob, rew, done, info = self.env.step((actions[0], actions[1]))
+            if self.rnn_executor is not None:
+                hidden_state_update = self.rnn_executor.submit(self.update_hidden_state, z, rnn_actions)
+            else:
+                self.update_hidden_state(z, rnn_actions)
+
+            with profiler.measure("env_step"):
+                ob, rew, done, info = self.env.step((actions[0], actions[1]))
+
+            if self.rnn_executor is not None:
+                with profiler.measure("rnn_wait"):
+                    hidden_state_update.result()
+
+            if profiler.enabled:
+                profiler.add("step", time.perf_counter() - step_start_time)
+                profiler.count("real_env_steps")
 
             # Transform to [0, 1] range
             rew /= 100.0
@@ -130,6 +198,9 @@ class GUIEnvRollout:
         return total_reward
 
     def __del__(self):
+        if self.rnn_executor is not None:
+            self.rnn_executor.shutdown()
+
         self.env.close()
 
 
@@ -0,0 +1,207 @@
+import logging
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+from multiprocessing.connection import Listener, wait
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.logging.phase_profiler import PhaseProfiler
+
+# Environment variable through which the workers get the key to authenticate at the pool
+GUI_ENV_WORKER_AUTHKEY_ENVIRONMENT_VARIABLE = "GUI_ENV_WORKER_AUTHKEY"
+
+# Time in seconds the workers have to load the models and start the environment
+GUI_ENV_WORKER_STARTUP_TIMEOUT = 300.0
+
+# Interval in seconds after which waiting for a worker returns to check if the workers are still alive
+GUI_ENV_WORKER_LIVENESS_CHECK_INTERVAL = 5.0
+
+# Time in seconds a worker has to gracefully shut down before it is killed
+GUI_ENV_WORKER_SHUTDOWN_TIMEOUT = 10.0
+
+
+class GUIEnvWorkerPool:
+    """
+    Pool of persistent workers that evaluate controllers on the actual GUI environment.
+
+    Each worker is a subprocess with its own virtual X server (started with xvfb-run), which loads the V and M model and
+    starts the environment once, and then evaluates one controller after another with GUIEnvRollout. The controller
+    parameters and the rewards are exchanged over a local connection, see evaluation/controller/_evaluation_worker.py.
+    The number of workers is bounded by the number of CPU cores, as each environment runs its own Qt application.
+
+    Each worker runs in its own process group, such that a worker that does not shut down can be killed together with
+    its X server and Python process.
+    """
+
+    def __init__(self, rnn_dir: str, vae_dir: str, gpu: int, stop_mode: str, amount: int,
+                 number_of_workers: Optional[int] = None, latent_cache_size: int = 0, pipelined: bool = False,
+                 enable_profiling: bool = False):
+        self.rnn_dir = rnn_dir
+        self.vae_dir = vae_dir
+        self.gpu = gpu
+        self.stop_mode = stop_mode
+        self.amount = amount
+        self.latent_cache_size = latent_cache_size
+        self.pipelined = pipelined
+        self.enable_profiling = enable_profiling
+
+        cpu_count = os.cpu_count() or 1
+        self.number_of_workers = min(number_of_workers, cpu_count) if number_of_workers is not None else cpu_count
+        assert self.number_of_workers > 0, "Number of workers must be greater than 0"
+
+        self.authkey = os.urandom(32)
+        self.listener = None
+        self.processes = []
+        self.connections = []
+
+        # Latent cache metrics of the workers, summed up until get_metrics() is called
+        self.latent_cache_metrics = {}
+        self.phase_profiler = PhaseProfiler(enabled=enable_profiling)
+
+    def start(self):
+        self.listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
+        _, port = self.listener.address
+
+        accepted_connections = queue.Queue()
+
+        def accept_routine():
+            for _ in range(self.number_of_workers):
+                try:
+                    accepted_connections.put(self.listener.accept())
+                except (OSError, EOFError):
+                    return
+
+        threading.Thread(target=accept_routine, daemon=True).start()
+
+        command = [
+            "xvfb-run", "-a", "-s", "-screen 0 448x448x24",
+            "python", "-m", "evaluation.controller._evaluation_worker",
+            f"--rnn-dir={self.rnn_dir}",
+            f"--vae-dir={self.vae_dir}",
+            f"--gpu={self.gpu}",
+            f"--stop-mode={self.stop_mode}",
+            f"--amount={self.amount}",
+            f"--latent-cache-size={self.latent_cache_size}",
+            "--pipelined" if self.pipelined else "--no-pipelined",
+            "--enable-profiling" if self.enable_profiling else "--no-enable-profiling",
+            f"--port={port}"
+        ]
+        env = dict(os.environ, **{GUI_ENV_WORKER_AUTHKEY_ENVIRONMENT_VARIABLE: self.authkey.hex()})
+
+        for _ in range(self.number_of_workers):
+            # Sleep a bit before starting a new process, to avoid getting a duplicate server number
+            time.sleep(0.25)
+            self.processes.append(subprocess.Popen(command, env=env, start_new_session=True))
+
+        logging.info(f"Started {self.number_of_workers} GUI environment workers with command {command}")
+
+        start_time = time.time()
+        while len(self.connections) < self.number_of_workers:
+            try:
+                self.connections.append(accepted_connections.get(timeout=GUI_ENV_WORKER_LIVENESS_CHECK_INTERVAL))
+            except queue.Empty:
+                self._check_workers_alive()
+
+                if time.time() - start_time > GUI_ENV_WORKER_STARTUP_TIMEOUT:
+                    self.shutdown()
+                    raise RuntimeError(f"GUI environment workers did not start within {GUI_ENV_WORKER_STARTUP_TIMEOUT} "
+                                       "seconds")
+
+    def evaluate(self, list_of_parameters: List[np.ndarray]) -> List[Tuple[float, List[float]]]:
+        """
+        Evaluates each flattened controller parameter vector once on the environment, at most number_of_workers at
+        the same time. Returns (reward_sum, all_rewards) per parameter vector, in the same order.
+        """
+        results = [None] * len(list_of_parameters)
+        next_task = 0
+        busy_connections = {}
+
+        while next_task < len(list_of_parameters) or busy_connections:
+            for connection in self.connections:
+                if connection not in busy_connections and next_task < len(list_of_parameters):
+                    try:
+                        connection.send((next_task, list_of_parameters[next_task]))
+                    except OSError as e:
+                        raise RuntimeError("Lost the connection to a GUI environment worker") from e
+
+                    busy_connections[connection] = next_task
+                    next_task += 1
+
+            ready_connections = wait(list(busy_connections.keys()), timeout=GUI_ENV_WORKER_LIVENESS_CHECK_INTERVAL)
+
+            if not ready_connections:
+                self._check_workers_alive()
+
+            for connection in ready_connections:
+                try:
+                    task_id, reward_sum, all_rewards, latent_cache_metrics, phase_timings = connection.recv()
+                except (EOFError, OSError) as e:
+                    # The worker died or closed the connection, its exit code is logged if it already terminated
+                    self._check_workers_alive()
+                    raise RuntimeError("Lost the connection to a GUI environment worker") from e
+
+                results[task_id] = (reward_sum, all_rewards)
+
+                self.phase_profiler.merge(phase_timings)
+
+                for k, v in latent_cache_metrics.items():
+                    self.latent_cache_metrics[k] = self.latent_cache_metrics.get(k, 0) + v
+                del busy_connections[connection]
+
+        return results
+
+    def get_metrics(self) -> Dict[str, float]:
+        """
+        Returns the latent cache metrics and the summed phase timings (profiling/<phase>, in seconds) of all workers
+        since the last call and resets them. Empty if neither the latent cache nor profiling is enabled.
+        """
+        metrics = self.latent_cache_metrics
+        self.latent_cache_metrics = {}
+
+        if metrics:
+            lookups = metrics["latent_cache_hits"] + metrics["latent_cache_misses"]
+            metrics["latent_cache_hit_rate"] = metrics["latent_cache_hits"] / lookups if lookups > 0 else 0.0
+
+        for phase, value in self.phase_profiler.pop().items():
+            metrics[f"profiling/{phase}"] = value
+
+        return metrics
+
+    def shutdown(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+
+        for p in self.processes:
+            try:
+                p.wait(timeout=GUI_ENV_WORKER_SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                # Kill the whole process group, i.e. also the X server and the worker started by xvfb-run
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                p.wait()
+
+        for connection in self.connections:
+            connection.close()
+
+        if self.listener is not None:
+            self.listener.close()
+
+        self.processes = []
+        self.connections = []
+        self.listener = None
+
+    def _check_workers_alive(self):
+        for worker_id, p in enumerate(self.processes):
+            if p.poll() is not None:
+                logging.error(f"GUI environment worker {worker_id} died with exit code {p.returncode}")
+                raise RuntimeError(f"GUI environment worker {worker_id} died with exit code {p.returncode}")
@@ -0,0 +1,73 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+class ObservationLatentCache:
+    """
+    Bounded cache of the encoded (mu, log_var) of raw observations of the actual environment, keyed by a hash of the
+    observation bytes.
+
+    Consecutive screenshots of a GUI are often identical (for example after a click on an inert area), for them the
+    preprocessing and the V model encoder are skipped, only z is sampled again from the cached distribution. If the
+    cache is full, the least recently used entry is evicted. The time of the encodings is measured to estimate the
+    time saved by the hits.
+    """
+
+    def __init__(self, max_size: int):
+        assert max_size > 0, "The maximum size of the latent cache must be greater than 0"
+
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.encoder_time = 0.0
+
+    @staticmethod
+    def get_key(observation: np.ndarray) -> Tuple[Hashable, ...]:
+        observation_hash = hashlib.blake2b(np.ascontiguousarray(observation), digest_size=16).digest()
+
+        return observation_hash, observation.shape
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple[Hashable, ...], mu: torch.Tensor, log_var: torch.Tensor, encoder_time: float):
+        self.encoder_time += encoder_time
+
+        self.cache[key] = (mu, log_var)
+        self.cache.move_to_end(key)
+
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def get_metrics(self) -> Dict[str, float]:
+        """
+        Returns the hits, the misses and the time of the encodings, and the time saved by the hits since the last call
+        of this function, and resets them. The saved time assumes that each hit would have taken the mean time of the
+        encodings.
+        """
+        metrics = {
+            "latent_cache_hits": self.hits,
+            "latent_cache_misses": self.misses,
+            "encoder_time": self.encoder_time,
+            "saved_encoder_time": self.hits * self.encoder_time / self.misses if self.misses > 0 else 0.0
+        }
+
+        self.hits = 0
+        self.misses = 0
+        self.encoder_time = 0.0
+
+        return metrics
+
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+def get_noise_seed(base_seed: int, generation: int, sample_index: int) -> int:
+    """
+    Seed of the noise bank for the sample_index-th rollout of a candidate in the given generation. All candidates of a
+    generation therefore see the same environment stochasticity for the same sample index.
+    """
+    return int(np.random.SeedSequence([base_seed, generation, sample_index]).generate_state(1)[0])
+
+
+def get_evaluation_noise_seed(base_seed: int, sample_index: int) -> int:
+    """
+    Seed of the noise bank for the sample_index-th rollout when evaluating the best candidate of a generation. The same
+    seeds are used in every generation, independent of the seeds of get_noise_seed().
+    """
+    return int(np.random.SeedSequence([base_seed, sample_index], spawn_key=(1,)).generate_state(1)[0])
+
+
+class NoiseBank:
+    """
+    Pre-generated random numbers for dream rollouts (common random numbers).
+
+    For a seed, all random numbers that a rollout of time_limit steps needs are generated at once: the noise for
+    sampling the initial latent vector, and per step the uniform and the standard normal noise for sampling the next
+    latent vector from the MDN. The same seed always results in the same noise, independent of the device. The most
+    recently used banks are cached, such that candidates evaluated with the same seed do not generate them again.
+    """
+
+    def __init__(self, time_limit: int, latent_size: int, device: torch.device, cache_size: int = 16):
+        self.time_limit = time_limit
+        self.latent_size = latent_size
+        self.device = device
+        self.cache_size = cache_size
+
+        self.cache = OrderedDict()
+
+    def get(self, seeds: Sequence[int]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns the noise for a batch of rollouts, one seed per batch entry:
+        initial_noise: (BATCH_SIZE, L_SIZE), uniform_noise and normal_noise: (TIME_LIMIT, BATCH_SIZE, L_SIZE)
+        """
+        banks = [self._get_bank(seed) for seed in seeds]
+
+        initial_noise = torch.stack([bank[0] for bank in banks])
+        uniform_noise = torch.stack([bank[1] for bank in banks], dim=1)
+        normal_noise = torch.stack([bank[2] for bank in banks], dim=1)
+
+        return initial_noise, uniform_noise, normal_noise
+
+    def _get_bank(self, seed: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if seed in self.cache:
+            self.cache.move_to_end(seed)
+            return self.cache[seed]
+
+        # Generate on the CPU, such that the noise does not depend on the device
+        generator = torch.Generator().manual_seed(seed)
+        bank = (
+            torch.randn(self.latent_size, generator=generator).to(self.device),
+            torch.rand((self.time_limit, self.latent_size), generator=generator).to(self.device),
+            torch.randn((self.time_limit, self.latent_size), generator=generator).to(self.device)
+        )
+
+        self.cache[seed] = bank
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return bank
@@ -0,0 +1,560 @@
+import logging
+import os
+import queue
+import sys
+import time
+from collections import deque
+from os import getpid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from utils.logging.phase_profiler import PhaseProfiler, get_profiler
+from utils.rollout.dream_rollout import create_dream_rollout, PopulationDreamRollout
+from utils.rollout.fitness_cache import FitnessCache
+
+# Interval in seconds after which a blocking get on the result queue returns to check if the workers are still alive.
+# This does not add latency, as a get returns immediately as soon as a result arrives
+WORKER_LIVENESS_CHECK_INTERVAL = 5.0
+
+# Time in seconds a worker has to gracefully shut down before it is killed
+WORKER_SHUTDOWN_TIMEOUT = 1.0
+
+
+def evaluate_chunk(r_gen, params: np.ndarray, rollout_batch_size: int, noise_seeds: Optional[List[int]] = None,
+                   temperatures: Optional[List[float]] = None,
+                   progress_callback: Optional[Callable[[], None]] = None) -> List[float]:
+    """
+    Evaluate all parameter vectors of a chunk (rows of params). If r_gen is a PopulationDreamRollout, the chunk is
+    evaluated in batches of rollout_batch_size, optionally with one noise seed per parameter vector. temperatures are
+    optionally the temperatures per parameter vector, otherwise the temperature of r_gen is used.
+
+    progress_callback is optionally called after each rollout (batch), e.g. to signal that the worker is still making
+    progress.
+    """
+    if not isinstance(r_gen, PopulationDreamRollout):
+        results = []
+        for i, p in enumerate(params):
+            results.append(r_gen.rollout(p) if temperatures is None else r_gen.rollout(p, temperatures[i]))
+
+            if progress_callback is not None:
+                progress_callback()
+
+        return results
+
+    results = []
+    for i in range(0, len(params), rollout_batch_size):
+        batch_noise_seeds = noise_seeds[i:i + rollout_batch_size] if noise_seeds is not None else None
+        batch_temperatures = temperatures[i:i + rollout_batch_size] if temperatures is not None else None
+        results.extend(r_gen.rollout(params[i:i + rollout_batch_size], batch_noise_seeds, batch_temperatures).tolist())
+
+        if progress_callback is not None:
+            progress_callback()
+
+    return results
+
+
+def worker_routine(worker_id: int, task_queue, result_queue, tmp_dir: Optional[str], rollout_arguments: dict,
+                   shared_solutions: Optional[torch.Tensor] = None, shared_results: Optional[torch.Tensor] = None,
+                   enable_profiling: bool = False):
+    """
+    Routine of one worker process.
+
+    The worker blocks on its own task_queue until a chunk (chunk_id, params, rows, noise_seeds, temperatures,
+    result_slot) arrives,
+    evaluates it, and puts (worker_id, chunk_id, results, wait_time, compute_time, phase_timings) on the shared
+    result_queue. wait_time is the time the worker was idle waiting for this chunk, compute_time the time it took to
+    evaluate it. phase_timings are the timings of the PhaseProfiler during the evaluation (empty if enable_profiling is
+    False). A None on the task_queue terminates the worker.
+
+    If the chunk contains rows instead of params, the parameters are read from these rows of shared_solutions. If it
+    contains a result_slot, the results are written to this row of shared_results instead of sending them back.
+    """
+    if tmp_dir is not None:
+        # redirect streams
+        sys.stdout = open(os.path.join(tmp_dir, str(getpid()) + '.out'), 'a')
+        sys.stderr = open(os.path.join(tmp_dir, str(getpid()) + '.err'), 'a')
+
+    profiler = get_profiler()
+    profiler.enabled = enable_profiling
+
+    with torch.no_grad():
+        r_gen = create_dream_rollout(**rollout_arguments)
+        rollout_batch_size = rollout_arguments["rollout_batch_size"]
+
+        while True:
+            wait_start = time.perf_counter()
+            chunk = task_queue.get()
+            wait_time = time.perf_counter() - wait_start
+
+            if chunk is None:
+                break
+
+            chunk_id, params, rows, noise_seeds, temperatures, result_slot = chunk
+
+            if rows is not None:
+                params = shared_solutions[rows].numpy()
+
+            compute_start = time.perf_counter()
+            results = evaluate_chunk(r_gen, params, rollout_batch_size, noise_seeds, temperatures)
+            compute_time = time.perf_counter() - compute_start
+
+            if result_slot is not None:
+                shared_results[result_slot, :len(results)] = torch.tensor(results, dtype=shared_results.dtype)
+                results = None
+
+            result_queue.put((worker_id, chunk_id, results, wait_time, compute_time, profiler.pop()))
+
+
+class RolloutWorkerPool:
+    """
+    Pool of dream rollout workers, fed through blocking queues instead of polling them.
+
+    Tasks are (s_id, params), (s_id, params, noise_seed) or (s_id, params, noise_seed, temperature) tuples, where s_id
+    can be any picklable identifier and noise_seed is the seed of the noise bank used for the rollout (requires
+    use_noise_bank in the rollout arguments, can be None). temperature overrides the temperature of the rollout
+    arguments for this task, which allows for example trainings with different temperatures to share one pool.
+    Submitted tasks are grouped into chunks of tasks_per_chunk tasks and dispatched to the worker queues, such that each
+    worker has at most max_chunks_in_flight chunks assigned at once. New chunks are dispatched as soon as results come
+    back. Results are returned individually as (s_id, result) tuples by get_result(), in the order in which they finish.
+
+    Tasks can also be submitted with low priority. These are only dispatched when no normal tasks are pending, and their
+    results are not returned by get_result() but by get_low_priority_results(). This allows running for example
+    evaluations in the background, without delaying the normal tasks. Submitting low priority tasks does not dispatch
+    them by itself, they only use the room that is left on the workers when normal tasks are submitted or finish (or
+    when waiting for them with get_low_priority_results()). Low priority tasks submitted while the workers are idle, for
+    example between two generations, therefore do not run ahead of the normal tasks that are submitted next.
+
+    With shared_memory_rows > 0, the parameters are not pickled for every task. Instead, each distinct parameter vector
+    of a submit is written once into a shared memory matrix with shared_memory_rows rows, and the workers only receive
+    the row indices. The results are also written into a shared memory array, the result queue then only carries small
+    notifications. If all rows are in use, the parameters of further tasks are sent as before.
+
+    With number_of_workers = 0 no subprocesses are started and the chunks are evaluated in the calling process, which is
+    useful for debugging.
+
+    With enable_profiling, the workers measure the phases of the rollouts (see PhaseProfiler), which are then returned
+    together with the other metrics by get_metrics().
+
+    With fitness_cache_size > 0, the results of tasks with a noise seed are cached (see FitnessCache). A submitted task
+    that was already evaluated with the same parameters and noise seed is then not dispatched, its cached result is
+    returned instead.
+    """
+
+    def __init__(self, number_of_workers: int, rollout_arguments: dict, tmp_dir: Optional[str] = None,
+                 tasks_per_chunk: int = 1, max_chunks_in_flight: int = 2, shared_memory_rows: int = 0,
+                 number_of_parameters: Optional[int] = None, enable_profiling: bool = False,
+                 fitness_cache_size: int = 0):
+        assert number_of_workers >= 0, "Number of workers must not be negative"
+        assert tasks_per_chunk > 0, "Number of tasks per chunk must be greater than 0"
+        assert max_chunks_in_flight > 0, "Maximum number of chunks in flight must be greater than 0"
+        assert shared_memory_rows == 0 or number_of_parameters is not None, ("The number of parameters is required for "
+                                                                             "the shared memory")
+
+        self.number_of_workers = number_of_workers
+        self.evaluate_locally = number_of_workers == 0
+        self.rollout_arguments = rollout_arguments
+        self.rollout_batch_size = rollout_arguments["rollout_batch_size"]
+        self.tmp_dir = tmp_dir
+        self.tasks_per_chunk = tasks_per_chunk
+        self.max_chunks_in_flight = max_chunks_in_flight
+        self.enable_profiling = enable_profiling
+        # Timings of all workers, accumulated until get_metrics() is called
+        self.phase_profiler = PhaseProfiler(enabled=enable_profiling)
+
+        # To share CUDA tensors between subprocesses we have to use "spawn" as the starting method for the
+        # subprocesses. Compare also with https://docs.python.org/3/library/multiprocessing.html
+        # Also use the get_context method, as globally defining the start method messes with comet_ml and the stdout
+        # log is no longer shown for some reason
+        self.ctx = torch.multiprocessing.get_context("spawn")
+
+        self.processes = []
+        self.task_queues = []
+        self.result_queue = None
+
+        self.pending_tasks = deque()
+        self.finished_results = deque()
+        self.pending_low_priority_tasks = deque()
+        self.finished_low_priority_results = deque()
+        self.low_priority_chunk_ids = set()
+        # worker_id -> {chunk_id -> (tasks, result_slot)}
+        self.chunks_in_flight: Dict[Any, Dict[int, Tuple[Any, ...]]] = {
+            worker_id: {} for worker_id in range(number_of_workers)
+        }
+        self.next_chunk_id = 0
+        self.outstanding_tasks = 0
+        self.outstanding_low_priority_tasks = 0
+
+        # Shared memory is only useful with subprocesses
+        self.shared_solutions = None
+        self.shared_results = None
+        if shared_memory_rows > 0 and number_of_workers > 0:
+            self.shared_solutions = torch.zeros((shared_memory_rows, number_of_parameters),
+                                                dtype=torch.float64).share_memory_()
+            # One row of results per chunk that can be in flight
+            self.shared_results = torch.zeros((number_of_workers * max_chunks_in_flight, tasks_per_chunk),
+                                              dtype=torch.float64).share_memory_()
+
+            self.free_rows = deque(range(shared_memory_rows))
+            self.row_references = [0] * shared_memory_rows
+            self.free_result_slots = deque(range(number_of_workers * max_chunks_in_flight))
+
+        self.fitness_cache = FitnessCache(fitness_cache_size) if fitness_cache_size > 0 else None
+
+        # Only used when number_of_workers = 0
+        self.local_r_gen = None
+
+        self._reset_metrics()
+
+    def start(self):
+        if self.evaluate_locally:
+            return
+
+        self.result_queue = self.ctx.Queue()
+
+        for worker_id in range(self.number_of_workers):
+            task_queue = self.ctx.Queue()
+            p = self.ctx.Process(
+                target=worker_routine,
+                args=(worker_id, task_queue, self.result_queue, self.tmp_dir, self.rollout_arguments,
+                      self.shared_solutions, self.shared_results, self.enable_profiling)
+            )
+            p.start()
+
+            self.task_queues.append(task_queue)
+            self.processes.append(p)
+
+    def submit(self, tasks: List[Tuple[Any, ...]], low_priority: bool = False):
+        if low_priority:
+            self.outstanding_low_priority_tasks += len(tasks)
+        else:
+            self.outstanding_tasks += len(tasks)
+
+        if self.fitness_cache is not None:
+            tasks = self._resolve_cached_tasks(tasks, low_priority)
+
+        tasks = self._prepare_tasks(tasks)
+
+        if low_priority:
+            self.pending_low_priority_tasks.extend(tasks)
+        else:
+            self.pending_tasks.extend(tasks)
+            self._dispatch()
+
+    def get_result(self) -> Tuple[Any, float]:
+        """
+        Blocks until the next result is available and returns it as (s_id, result).
+        """
+        if not self.finished_results and self.outstanding_tasks == 0:
+            raise RuntimeError("No tasks were submitted for which a result could be returned")
+
+        while not self.finished_results:
+            if self.evaluate_locally:
+                self._evaluate_locally()
+            else:
+                self._receive()
+
+        self.outstanding_tasks -= 1
+        return self.finished_results.popleft()
+
+    def get_low_priority_results(self, block: bool = False) -> List[Tuple[Any, float]]:
+        """
+        Returns the (s_id, result) tuples of all low priority tasks that finished since the last call. With block, this
+        waits until all submitted low priority tasks are finished.
+
+        With number_of_workers = 0, the pending low priority tasks are always evaluated during this call.
+        """
+        if self.evaluate_locally:
+            while self.pending_low_priority_tasks:
+                self._evaluate_locally()
+        elif block:
+            self._dispatch()
+
+            while len(self.finished_low_priority_results) < self.outstanding_low_priority_tasks:
+                self._receive()
+
+        results = list(self.finished_low_priority_results)
+        self.finished_low_priority_results.clear()
+        self.outstanding_low_priority_tasks -= len(results)
+
+        return results
+
+    def get_metrics(self, number_of_generations: int = 1) -> Dict[str, float]:
+        """
+        Returns the metrics accumulated since the last call of this function (or the start of the pool) and resets them.
+
+        - queue_wait_time: Summed time in seconds the workers waited for new tasks
+        - result_wait_time: Time in seconds the main process was blocked waiting for results
+        - worker_utilization: Fraction of the elapsed time (over all workers) that was spent evaluating rollouts
+        - pickled_tasks: Number of tasks whose parameters were pickled, i.e. not sent through the shared memory
+
+        With profiling enabled, additionally:
+        - profiling/<phase>: Summed time in seconds of all workers in this phase of the rollouts (controller_forward,
+          rnn_forward and mdn_sampling, or fused_step), and profiling/env_steps the number of simulated steps. These
+          are divided by number_of_generations, i.e. the generations since the last call, such that they are per
+          generation even if the metrics are not collected in every generation
+        - steps_per_second_per_worker: Simulated environment steps per second of compute time of a worker
+
+        With the fitness cache, additionally fitness_cache_hits and fitness_cache_hit_rate (of the tasks with a noise
+        seed).
+        """
+        elapsed_time = time.perf_counter() - self.metrics_start_time
+        number_of_workers = max(self.number_of_workers, 1)
+
+        metrics = {
+            "queue_wait_time": self.queue_wait_time,
+            "result_wait_time": self.result_wait_time,
+            "worker_utilization": self.compute_time / (elapsed_time * number_of_workers) if elapsed_time > 0 else 0.0,
+            "pickled_tasks": self.pickled_tasks
+        }
+
+        if self.enable_profiling:
+            phase_timings = self.phase_profiler.pop()
+
+            for phase, value in phase_timings.items():
+                metrics[f"profiling/{phase}"] = value / number_of_generations
+
+            metrics["steps_per_second_per_worker"] = (
+                phase_timings.get("env_steps", 0) / self.compute_time if self.compute_time > 0 else 0.0
+            )
+
+        if self.fitness_cache is not None:
+            metrics.update(self.fitness_cache.get_metrics())
+
+        self._reset_metrics()
+
+        return metrics
+
+    def shutdown(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+
+        for p in self.processes:
+            # Give some time to gracefully shutdown, otherwise just kill the process as it is no longer in use anyway
+            p.join(timeout=WORKER_SHUTDOWN_TIMEOUT)
+            if p.is_alive():
+                p.kill()
+
+        for q in self.task_queues + ([self.result_queue] if self.result_queue is not None else []):
+            q.close()
+            q.join_thread()
+
+        self.processes = []
+        self.task_queues = []
+        self.result_queue = None
+
+    def _reset_metrics(self):
+        self.metrics_start_time = time.perf_counter()
+        self.queue_wait_time = 0.0
+        self.result_wait_time = 0.0
+        self.compute_time = 0.0
+        self.pickled_tasks = 0
+
+    def _get_cache_key(self, params: np.ndarray, noise_seed: Optional[int], temperature: Optional[float]):
+        if temperature is None:
+            temperature = self.rollout_arguments["temperature"]
+
+        return FitnessCache.get_key(params, temperature, self.rollout_arguments["time_limit"], noise_seed)
+
+    def _resolve_cached_tasks(self, tasks: List[Tuple[Any, ...]], low_priority: bool) -> List[Tuple[Any, ...]]:
+        """
+        Moves the results of the tasks that are in the fitness cache directly to the finished results. Returns the
+        remaining tasks, which have to be evaluated.
+        """
+        finished_results = self.finished_low_priority_results if low_priority else self.finished_results
+        remaining_tasks = []
+
+        for task in tasks:
+            result = self.fitness_cache.get(self._get_cache_key(
+                task[1], task[2] if len(task) > 2 else None, task[3] if len(task) > 3 else None
+            ))
+
+            if result is not None:
+                finished_results.append((task[0], result))
+            else:
+                remaining_tasks.append(task)
+
+        return remaining_tasks
+
+    def _complete_tasks(self, tasks: List[Tuple[Any, ...]], results: List[float], low_priority: bool):
+        if self.fitness_cache is not None:
+            for (_, params, noise_seed, _, temperature), result in zip(tasks, results):
+                self.fitness_cache.put(self._get_cache_key(params, noise_seed, temperature), result)
+
+        finished_results = self.finished_low_priority_results if low_priority else self.finished_results
+        finished_results.extend(zip([task[0] for task in tasks], results))
+
+    def _prepare_tasks(self, tasks: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+        """
+        Converts the tasks to (s_id, params, noise_seed, row, temperature) tuples. row is the row of the shared memory
+        matrix that holds params, or None if params have to be sent directly. Tasks with the same params object share a
+        row.
+        """
+        prepared_tasks = []
+        rows = {}
+
+        for task in tasks:
+            s_id, params = task[0], task[1]
+            noise_seed = task[2] if len(task) > 2 else None
+            temperature = task[3] if len(task) > 3 else None
+
+            row = None
+            if self.shared_solutions is not None:
+                if id(params) in rows:
+                    row = rows[id(params)]
+                elif self.free_rows:
+                    row = self.free_rows.popleft()
+                    self.shared_solutions[row] = torch.from_numpy(np.asarray(params, dtype=np.float64))
+                    rows[id(params)] = row
+
+                if row is not None:
+                    self.row_references[row] += 1
+
+            if row is None and not self.evaluate_locally:
+                self.pickled_tasks += 1
+
+            prepared_tasks.append((s_id, params, noise_seed, row, temperature))
+
+        return prepared_tasks
+
+    def _release_chunk(self, tasks: List[Tuple[Any, ...]], result_slot: Optional[int]):
+        for _, _, _, row, _ in tasks:
+            if row is not None:
+                self.row_references[row] -= 1
+
+                if self.row_references[row] == 0:
+                    self.free_rows.append(row)
+
+        if result_slot is not None:
+            self.free_result_slots.append(result_slot)
+
+    def _next_chunk(self) -> Tuple[int, List[Tuple[Any, ...]]]:
+        # Chunks never mix normal and low priority tasks, low priority tasks are only used if no normal ones are pending
+        if self.pending_tasks:
+            pending_tasks = self.pending_tasks
+            low_priority = False
+        else:
+            pending_tasks = self.pending_low_priority_tasks
+            low_priority = True
+
+        # A chunk either has a noise seed for every task or for none, see _create_message(). Tasks with and without a
+        # noise seed (for example of different trainings sharing the pool) are therefore put into separate chunks
+        has_noise_seed = pending_tasks[0][2] is not None
+        tasks = []
+        while (pending_tasks and len(tasks) < self.tasks_per_chunk
+               and (pending_tasks[0][2] is not None) == has_noise_seed):
+            tasks.append(pending_tasks.popleft())
+
+        chunk_id = self.next_chunk_id
+        self.next_chunk_id += 1
+
+        if low_priority:
+            self.low_priority_chunk_ids.add(chunk_id)
+
+        return chunk_id, tasks
+
+    def _create_message(self, chunk_id: int, tasks: List[Tuple[Any, ...]],
+                        result_slot: Optional[int]) -> Tuple[Any, ...]:
+        # Either all tasks of a chunk have a noise seed or none, see _next_chunk()
+        noise_seeds = [task[2] for task in tasks] if tasks[0][2] is not None else None
+
+        temperatures = None
+        if any(task[4] is not None for task in tasks):
+            temperatures = [
+                task[4] if task[4] is not None else self.rollout_arguments["temperature"] for task in tasks
+            ]
+
+        rows = [task[3] for task in tasks]
+        if all(row is not None for row in rows):
+            return chunk_id, None, rows, noise_seeds, temperatures, result_slot
+
+        return chunk_id, np.stack([task[1] for task in tasks]), None, noise_seeds, temperatures, result_slot
+
+    def _dispatch(self):
+        if self.evaluate_locally:
+            return
+
+        # Fill up the workers round-robin, one chunk at a time, to spread the chunks evenly across the workers
+        while self.pending_tasks or self.pending_low_priority_tasks:
+            dispatched = False
+
+            for worker_id in list(self.chunks_in_flight.keys()):
+                if not self.pending_tasks and not self.pending_low_priority_tasks:
+                    break
+
+                if len(self.chunks_in_flight[worker_id]) < self.max_chunks_in_flight:
+                    chunk_id, tasks = self._next_chunk()
+                    result_slot = self.free_result_slots.popleft() if self.shared_results is not None else None
+
+                    self.chunks_in_flight[worker_id][chunk_id] = (tasks, result_slot)
+                    self._send_chunk(worker_id, self._create_message(chunk_id, tasks, result_slot))
+                    dispatched = True
+
+            if not dispatched:
+                break
+
+    def _receive(self):
+        wait_start = time.perf_counter()
+
+        while True:
+            try:
+                message = self.result_queue.get(timeout=WORKER_LIVENESS_CHECK_INTERVAL)
+                break
+            except queue.Empty:
+                self._check_workers_alive()
+
+        self.result_wait_time += time.perf_counter() - wait_start
+
+        self._finish_chunk(*message)
+
+    def _send_chunk(self, worker_id: Any, message: Tuple[Any, ...]):
+        self.task_queues[worker_id].put(message)
+
+    def _finish_chunk(self, worker_id: Any, chunk_id: int, results: Optional[List[float]], wait_time: float,
+                      compute_time: float, phase_timings: Dict[str, float]):
+        tasks, result_slot = self.chunks_in_flight[worker_id].pop(chunk_id)
+
+        if result_slot is not None:
+            results = self.shared_results[result_slot, :len(tasks)].tolist()
+
+        self._release_chunk(tasks, result_slot)
+
+        self.queue_wait_time += wait_time
+        self.compute_time += compute_time
+        self.phase_profiler.merge(phase_timings)
+
+        low_priority = chunk_id in self.low_priority_chunk_ids
+        self.low_priority_chunk_ids.discard(chunk_id)
+
+        self._complete_tasks(tasks, results, low_priority)
+
+        self._dispatch()
+
+    def _evaluate_locally(self):
+        if self.local_r_gen is None:
+            get_profiler().enabled = self.enable_profiling
+            self.local_r_gen = create_dream_rollout(**self.rollout_arguments)
+
+        # Same as for the workers, normal tasks are evaluated before low priority tasks
+        chunk_id, tasks = self._next_chunk()
+        low_priority = chunk_id in self.low_priority_chunk_ids
+        self.low_priority_chunk_ids.discard(chunk_id)
+
+        # Without subprocesses, no shared memory is used
+        _, params, _, noise_seeds, temperatures, _ = self._create_message(chunk_id, tasks, None)
+
+        compute_start = time.perf_counter()
+        with torch.no_grad():
+            results = evaluate_chunk(self.local_r_gen, params, self.rollout_batch_size, noise_seeds, temperatures)
+        self.compute_time += time.perf_counter() - compute_start
+        self.phase_profiler.merge(get_profiler().pop())
+
+        self._complete_tasks(tasks, results, low_priority)
+
+    def _check_workers_alive(self):
+        for worker_id, p in enumerate(self.processes):
+            if not p.is_alive():
+                logging.error(f"Rollout worker {worker_id} died with exit code {p.exitcode}")
+                raise RuntimeError(f"Rollout worker {worker_id} died with exit code {p.exitcode}, see the log files "
+                                   f"in {self.tmp_dir} for more information")
@@ -1 +1,3 @@
-from utils.training_utils.training_utils import vae_transformation_functions, save_checkpoint, load_vae_architecture
+from utils.training_utils.training_utils import (
+    vae_transformation_functions, ObservationPreprocessor, save_checkpoint, load_vae_architecture
+)
@@ -1,9 +1,14 @@
 import logging
 import os
-from typing import Tuple, Union
+import pickle
+import random
+from typing import Optional, Tuple, Union
 
+import cma
 import h5py
+import numpy as np
 import torch
+from cma.restricted_gaussian_sampler import GaussVDSampler, GaussVkDSampler
 from PIL import Image
 from torchvision import transforms
 
@@ -11,7 +16,7 @@ from models import select_vae_model, select_rnn_model, Controller
 from models.vae import BaseVAE
 from utils.setup_utils import load_yaml_config
 from utils.constants import (
-    GUI_ENV_INITIAL_STATE_FILE_PATH, INITIAL_OBS_LATENT_VECTOR_FILE_NAME, MAX_COORDINATE
+    GUI_ENV_INITIAL_STATE_FILE_PATH, INITIAL_OBS_LATENT_VECTOR_FILE_NAME, ES_CHECKPOINT_FILE_NAME, MAX_COORDINATE
 )
 
 
@@ -44,9 +49,83 @@ def vae_transformation_functions(img_size: int, dataset: str, output_activation_
     return transformation_functions
 
 
-def get_rnn_action_transformation_function(max_coordinate_size_for_task: int, reduce_action_coordinate_space_by: int,
-                                           action_transformation_function_type: str):
+class ObservationPreprocessor:
+    """
+    Tensor counterpart of vae_transformation_functions() for raw observations, i.e. uint8 RGB arrays of shape
+    (H, W, 3) as returned by the environment, without the detour through a PIL image.
+
+    The observation is copied into a preallocated uint8 buffer in CHW layout and resized in tensor space with bilinear
+    antialiasing, which replicates the filter of the PIL resize in transforms.Resize(). The conversion to float, the
+    division by 255 and the normalization of the dataset or the output activation function (see
+    vae_transformation_functions()) then happen in place in a preallocated buffer on the device. The rounding of the
+    resized image can differ by one intensity step (1/255 before normalization) from PIL for single pixels, without a
+    resize (img_size equals the observation size) the output is identical.
+
+    Calling the preprocessor returns a tensor of shape (1, 3, img_size, img_size) on the device. This tensor is the
+    output buffer, it is overwritten by the next call.
+    """
+
+    def __init__(self, img_size: int, dataset: str, output_activation_function: str, device: torch.device):
+        self.img_size = img_size
+        self.device = device
+
+        self.mean, self.std = None, None
+
+        if dataset == "gui_env_image_dataset_500k_normalize":
+            mean, std = get_dataset_mean_std(dataset)
+            self.mean = torch.tensor(mean, device=self.device).view(3, 1, 1)
+            self.std = torch.tensor(std, device=self.device).view(3, 1, 1)
+        elif output_activation_function not in ["sigmoid", "tanh"]:
+            raise RuntimeError(f"Output activation function {output_activation_function} unknown")
+
+        self.output_activation_function = output_activation_function
+
+        # Allocated on the first call, as the size of the observation is only known then
+        self.input_buffer = None
+        self.device_buffer = None
+        self.output_buffer = torch.empty((1, 3, self.img_size, self.img_size), device=self.device)
+
+    def __call__(self, observation: np.ndarray) -> torch.Tensor:
+        height, width = observation.shape[:2]
+
+        if self.input_buffer is None or self.input_buffer.size()[2:] != (height, width):
+            self.input_buffer = torch.empty((1, 3, height, width), dtype=torch.uint8)
+
+        self.input_buffer[0].copy_(torch.from_numpy(observation).permute(2, 0, 1))
+
+        if (height, width) != (self.img_size, self.img_size):
+            resized = transforms.functional.resize(
+                self.input_buffer, [self.img_size, self.img_size],
+                interpolation=transforms.InterpolationMode.BILINEAR, antialias=True
+            )
+        else:
+            resized = self.input_buffer
+
+        if self.device.type != "cpu":
+            # Transfer the image as uint8, which is a quarter of the size of the float image
+            if self.device_buffer is None:
+                self.device_buffer = torch.empty((1, 3, self.img_size, self.img_size), dtype=torch.uint8,
+                                                 device=self.device)
+            self.device_buffer.copy_(resized)
+            resized = self.device_buffer
+
+        # Same operations as transforms.ToTensor(), then transforms.Normalize() or the Lambda for the tanh range
+        torch.div(resized, 255, out=self.output_buffer)
+
+        if self.mean is not None:
+            self.output_buffer.sub_(self.mean).div_(self.std)
+        elif self.output_activation_function == "tanh":
+            self.output_buffer.mul_(2.0).sub_(1.0)
+
+        return self.output_buffer
+
 
+def get_rnn_action_transformation_parameters(max_coordinate_size_for_task: int,
+                                             reduce_action_coordinate_space_by: int) -> Tuple[float, float]:
+    """
+    Returns the factor by which the action coordinates are reduced (0.0 if they are not reduced) and the maximum
+    coordinate after this reduction.
+    """
     if reduce_action_coordinate_space_by > 0:
         already_reduced_factor = MAX_COORDINATE // max_coordinate_size_for_task
         assert isinstance(already_reduced_factor, int), ("For simplicity used_max_coordinate_size must be a multiple "
@@ -55,13 +134,26 @@ def get_rnn_action_transformation_function(max_coordinate_size_for_task: int, re
         reduce_factor = reduce_action_coordinate_space_by / already_reduced_factor
         # -1.0 because coordinates start at 0
         new_max_coordinate = (max_coordinate_size_for_task / reduce_factor) - 1.0
+    else:
+        reduce_factor = 0.0
+        new_max_coordinate = max_coordinate_size_for_task - 1.0
+
+    return reduce_factor, new_max_coordinate
+
+
+def get_rnn_action_transformation_function(max_coordinate_size_for_task: int, reduce_action_coordinate_space_by: int,
+                                           action_transformation_function_type: str):
 
+    reduce_factor, new_max_coordinate = get_rnn_action_transformation_parameters(
+        max_coordinate_size_for_task, reduce_action_coordinate_space_by
+    )
+
+    if reduce_factor > 0:
         rnn_action_transformation_functions = [
             transforms.Lambda(lambda x: torch.div(x, reduce_factor, rounding_mode="floor"))
         ]
     else:
         rnn_action_transformation_functions = []
-        new_max_coordinate = max_coordinate_size_for_task - 1.0
 
     if action_transformation_function_type == "tanh":
         rnn_action_transformation_functions.append(
@@ -108,7 +200,7 @@ def save_checkpoint(state: dict, is_best: bool, checkpoint_filename: str, best_f
 
 
 def load_architecture(model_type: str, model_dir: str, device, load_best: bool = True, load_optimizer: bool = False,
-                      rnn_batch_size=None, vae_directory=None):
+                      rnn_batch_size=None, vae_directory=None, shared_state_dict: Optional[dict] = None):
     config = load_yaml_config(os.path.join(model_dir, "config.yaml"))
     model_name = config["model_parameters"]["name"]
 
@@ -127,12 +219,12 @@ def load_architecture(model_type: str, model_dir: str, device, load_best: bool =
     else:
         raise RuntimeError(f"Model type {model_type} unknown")
 
-    if load_best:
-        state_dict_file_name = "best.pt"
-    else:
-        state_dict_file_name = "checkpoint.pt"
+    if shared_state_dict is not None:
+        assert not load_optimizer, "The optimizer state is not part of a shared state dict"
+        attach_shared_state_dict(model, shared_state_dict)
+        return model, model_name
 
-    checkpoint = torch.load(os.path.join(model_dir, state_dict_file_name), map_location=device)
+    checkpoint = torch.load(os.path.join(model_dir, get_state_dict_file_name(load_best)), map_location=device)
     model.load_state_dict(checkpoint["state_dict"])
 
     if load_optimizer:
@@ -140,6 +232,49 @@ def load_architecture(model_type: str, model_dir: str, device, load_best: bool =
     return model, model_name
 
 
+def get_state_dict_file_name(load_best: bool) -> str:
+    if load_best:
+        return "best.pt"
+
+    return "checkpoint.pt"
+
+
+def load_shared_state_dict(model_dir: str, device: torch.device, load_best: bool = True) -> dict:
+    """
+    Load the weights of a trained model into shared memory, such that subprocesses (started with the "spawn" method
+    of torch.multiprocessing) can use them without loading the checkpoint again or having their own copy of the
+    weights. The optimizer state of the checkpoint is dropped.
+
+    Pass the returned dictionary as shared_state_dict to load_architecture() in the subprocess.
+    """
+    checkpoint = torch.load(os.path.join(model_dir, get_state_dict_file_name(load_best)), map_location=device)
+    state_dict = checkpoint["state_dict"]
+    del checkpoint
+
+    # share_memory_() is a no-op for CUDA tensors, these are shared through CUDA IPC anyway
+    return {name: tensor.detach().share_memory_() for name, tensor in state_dict.items()}
+
+
+def attach_shared_state_dict(model: torch.nn.Module, shared_state_dict: dict):
+    """
+    Let the parameters and buffers of model point to the (shared) tensors of shared_state_dict instead of copying
+    them. The model must only be used for inference afterwards, as an update of the weights would be visible in all
+    processes.
+    """
+    model_state = model.state_dict(keep_vars=True)
+
+    missing_keys = set(model_state.keys()) - set(shared_state_dict.keys())
+    if missing_keys:
+        raise RuntimeError(f"Shared state dict does not match the model, missing keys: {missing_keys}")
+
+    with torch.no_grad():
+        for name, tensor in model_state.items():
+            tensor.data = shared_state_dict[name]
+
+    # Do not call flatten_parameters() on the RNN modules afterwards: On CUDA this would copy the weights into a new
+    # contiguous buffer, which is then no longer shared
+
+
 def load_vae_architecture(vae_directory: str, device: torch.device, load_best: bool = True,
                           load_optimizer: bool = False) -> Union[Tuple[BaseVAE, str], Tuple[BaseVAE, str, dict]]:
     return load_architecture(
@@ -152,8 +287,9 @@ def load_vae_architecture(vae_directory: str, device: torch.device, load_best: b
 
 
 def load_rnn_architecture(rnn_directory: str, vae_directory: str, device: torch.device, batch_size=None,
-                          load_best: bool = True,
-                          load_optimizer: bool = False) -> Union[Tuple[BaseVAE, str], Tuple[BaseVAE, str, dict]]:
+                          load_best: bool = True, load_optimizer: bool = False,
+                          shared_state_dict: Optional[dict] = None
+                          ) -> Union[Tuple[BaseVAE, str], Tuple[BaseVAE, str, dict]]:
     return load_architecture(
         "rnn",
         model_dir=rnn_directory,
@@ -161,7 +297,8 @@ def load_rnn_architecture(rnn_directory: str, vae_directory: str, device: torch.
         load_best=load_best,
         load_optimizer=load_optimizer,
         rnn_batch_size=batch_size,
-        vae_directory=vae_directory
+        vae_directory=vae_directory,
+        shared_state_dict=shared_state_dict
     )
 
 
@@ -189,6 +326,81 @@ def load_controller_parameters(controller, controller_directory: str, device: to
     return controller, current_best
 
 
+def create_cma_evolution_strategy(initial_parameters, sigma: float, population_size: int, seed: int,
+                                  cma_mode: str = "full") -> cma.CMAEvolutionStrategy:
+    """
+    cma_mode selects how the covariance matrix of the CMA-ES is modelled, which matters for large controllers (the
+    number of parameters grows with the hidden size of the M model):
+
+    - full: Full covariance matrix, O(n^2) memory and time per sample and update
+    - diagonal: sep-CMA-ES, only the diagonal of the covariance matrix is adapted, O(n)
+    - vd: VD-CMA, diagonal plus a rank one matrix, O(n)
+    - vkd: VkD-CMA, diagonal plus a low rank matrix whose rank is adapted during training, O(n * k)
+    """
+    options = {"popsize": population_size, "seed": seed}
+
+    if cma_mode == "full":
+        pass
+    elif cma_mode == "diagonal":
+        options["CMA_diagonal"] = True
+    elif cma_mode == "vd":
+        options = GaussVDSampler.extend_cma_options(options)
+    elif cma_mode == "vkd":
+        options = GaussVkDSampler.extend_cma_options(options)
+    else:
+        raise RuntimeError(f"CMA mode '{cma_mode}' unknown")
+
+    return cma.CMAEvolutionStrategy(initial_parameters, sigma, options)
+
+
+def save_es_checkpoint(log_dir: str, es: cma.CMAEvolutionStrategy, generation: int, current_best: Optional[float],
+                       additional_state: Optional[dict] = None):
+    """
+    Serialize the complete state of the controller training, i.e. the CMA-ES (covariance matrix, step size, generation
+    counter, ...), the next generation that shall be trained, which is also the logging step, the current best
+    evaluation and the states of the random number generators of this process. additional_state optionally holds
+    further picklable state of the training, for example the finished candidates of the asynchronous ES mode.
+
+    The file is first written to a temporary file which then replaces the previous checkpoint, therefore a crash while
+    saving never leaves a broken checkpoint behind.
+    """
+    checkpoint_filename = os.path.join(log_dir, ES_CHECKPOINT_FILE_NAME)
+    tmp_checkpoint_filename = f"{checkpoint_filename}.tmp"
+
+    state = {
+        "es": es,
+        "generation": generation,
+        "current_best": current_best,
+        "additional_state": additional_state if additional_state is not None else {},
+        "python_rng_state": random.getstate(),
+        "numpy_rng_state": np.random.get_state(),
+        "torch_rng_state": torch.get_rng_state()
+    }
+
+    with open(tmp_checkpoint_filename, "wb") as f:
+        pickle.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_checkpoint_filename, checkpoint_filename)
+
+
+def load_es_checkpoint(log_dir: str) -> Tuple[cma.CMAEvolutionStrategy, int, Optional[float], dict]:
+    """
+    Load a checkpoint written by save_es_checkpoint() and restore the random number generators of this process, such
+    that the training continues with the same candidate solutions as without the interruption. Returns the CMA-ES, the
+    generation to continue with, the current best evaluation and the additional state.
+    """
+    with open(os.path.join(log_dir, ES_CHECKPOINT_FILE_NAME), "rb") as f:
+        state = pickle.load(f)
+
+    random.setstate(state["python_rng_state"])
+    np.random.set_state(state["numpy_rng_state"])
+    torch.set_rng_state(state["torch_rng_state"])
+
+    return state["es"], state["generation"], state["current_best"], state.get("additional_state", {})
+
+
 def generate_initial_observation_latent_vector(vae_dir, device, load_best: bool = True):
     initial_obs_path = os.path.join(vae_dir, INITIAL_OBS_LATENT_VECTOR_FILE_NAME)
 